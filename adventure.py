@@ -1,15 +1,98 @@
+import io
+import os
+import re
 import sys
+import gzip
 import json
+import math
+import mmap
+import time
+import bisect
+import cProfile
+import argparse
+import contextlib
+import pickle
 import random
+import heapq
+import struct
+import weakref
+from array import array
+from collections import Counter, OrderedDict, deque
 
 
-def will_action_happen(chance):
-    random_float = random.randint(1, 10) * 0.1
+def will_action_happen(chance, rng=random):
+    random_float = rng.randint(1, 10) * 0.1
     return random_float <= float(chance)
 
 
-def unlock_chest(chest):
-    return random.choices(chest['items'], chest['chances'], k=chest.get("number_of_items_unlocked", 1))
+def hit_chance(chance):
+    """
+    The probability of will_action_happen(chance) being true
+    """
+
+    return sum(1 for roll in range(1, 11) if roll * 0.1 <= float(chance)) / 10
+
+
+def binomial(n, p, rng=random):
+    """
+    How many of n tries that each succeed with probability p succeed. Takes
+    about the same time however big n is: small means count geometric gaps
+    between successes, the rest use Hormann's BTRS rejection sampler.
+    """
+
+    if n <= 0 or p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    if p > 0.5:
+        return n - binomial(n, 1 - p, rng)
+    if n * p < 10:
+        successes = tries = 0
+        c = math.log(1 - p)
+        while True:
+            tries += math.floor(math.log(1 - rng.random()) / c) + 1
+            if tries > n:
+                return successes
+            successes += 1
+
+    spq = math.sqrt(n * p * (1 - p))
+    b = 1.15 + 2.53 * spq
+    a = -0.0873 + 0.0248 * b + 0.01 * p
+    c = n * p + 0.5
+    vr = 0.92 - 4.2 / b
+    alpha = (2.83 + 5.1 / b) * spq
+    lpq = math.log(p / (1 - p))
+    m = math.floor((n + 1) * p)
+    h = math.lgamma(m + 1) + math.lgamma(n - m + 1)
+    while True:
+        u = rng.random() - 0.5
+        us = 0.5 - abs(u)
+        if us <= 0:
+            continue
+        k = math.floor((2 * a / us + b) * u + c)
+        if k < 0 or k > n:
+            continue
+        v = rng.random()
+        if us >= 0.07 and v <= vr:
+            return k
+        v *= alpha / (a / (us * us) + b)
+        if v <= 0 or math.log(v) <= (
+            h - math.lgamma(k + 1) - math.lgamma(n - k + 1) + (k - m) * lpq
+        ):
+            return k
+
+
+def unlock_chest(chest, rng=random):
+    return compile_loot(chest, rolls_key="number_of_items_unlocked").draw(rng)
+
+
+CHEST_BANNER = "$" * 50
+ENEMY_BANNER = "*" * 50
+
+# Prerendered (kind, text, fields) messages, see GameEngine.say_all
+LAYOUT = ("layout", "", {})
+CHEST_BANNER_MESSAGE = ("layout", CHEST_BANNER, {})
+ENEMY_BANNER_MESSAGE = ("layout", ENEMY_BANNER, {})
 
 
 commands_args_map = {
@@ -21,6 +104,7 @@ commands_args_map = {
         "get_all",
         "open_chest",
         "hp",
+        "undo",
     ],
     1: [
         "get",
@@ -32,9 +116,1704 @@ commands_args_map = {
         "unlock",
         "ingredients",
         "use",
+        "save",
+        "load",
+        "travel",
     ],
 }
 
+# Commands that don't give the enemies in the room a turn to attack
+commands_without_turn = {"quit", "undo", "save", "load"}
+
+# Commands whose argument is used as typed instead of lowercased
+commands_keep_case = {"save", "load"}
+
+# Shortcuts for whole commands
+command_aliases = {
+    "n": "go north",
+    "s": "go south",
+    "e": "go east",
+    "w": "go west",
+    "ne": "go northeast",
+    "nw": "go northwest",
+    "se": "go southeast",
+    "sw": "go southwest",
+    "i": "inventory",
+    "l": "look",
+}
+
+
+class FrozenDict(dict):
+    """
+    A dict that refuses to change. Used for everything in a MapTemplate.
+    """
+
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Map template is read-only.")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    """
+    Deep copy parsed JSON into read-only dicts and tuples
+    """
+
+    if isinstance(value, dict):
+        return FrozenDict(
+            (sys.intern(key), freeze(item)) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def thaw(value, depth=1):
+    """
+    Make the top `depth` levels of a frozen value mutable again
+    """
+
+    if depth <= 0:
+        return value
+    if isinstance(value, dict):
+        return {key: thaw(item, depth - 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item, depth - 1) for item in value]
+    return value
+
+
+def copy_thawed(value):
+    """
+    Copy the mutable parts of a value, sharing the frozen ones
+    """
+
+    if isinstance(value, (FrozenDict, tuple)):
+        return value
+    if isinstance(value, EnemyRoster):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: copy_thawed(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_thawed(item) for item in value]
+    return value
+
+
+# How deep a location field has to be copied before the engine can change
+# it. Enemies are the only field where nested dicts (their hp) change.
+thaw_depth = {
+    "enemies": 2,
+}
+
+# Locations that start with at least this many enemies keep them in an
+# EnemyRoster, and the player hears about them as a crowd
+HORDE_SIZE = 50
+
+# The parts of a location's description that are rendered once and then
+# kept, and the location fields each one shows
+render_fragments = {
+    "look": ("name", "id", "desc", "items", "complex_items", "exits", "chest"),
+    "items": ("items", "complex_items"),
+    "enemies": ("enemies", "enemy_attack_desc"),
+}
+
+# location field -> the fragments showing it
+render_fragments_of = {
+    key: tuple(fragment for fragment, keys in render_fragments.items() if key in keys)
+    for keys in render_fragments.values() for key in keys
+}
+
+# How many rendered fragments of unchanged locations a map keeps
+RENDER_CACHE_SIZE = 4096
+
+# How many rosters of untouched hordes a map keeps
+ROSTER_CACHE_SIZE = 64
+
+
+class MapTemplate(object):
+    """
+    A parsed map frozen once so that any number of sessions can share it
+    """
+
+    def __init__(self, location_map):
+        if isinstance(location_map, LocationStore):
+            self.locations = location_map
+            self.has_enemies = location_map.has_enemies
+            return
+        if not isinstance(location_map, (list, tuple)):
+            raise LocationMapError("Map is not a list.")
+        self.locations = tuple(freeze(location) for location in location_map)
+        self.has_enemies = any(
+            len(location.get('enemies', {})) != 0
+            for location in self.locations
+        )
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, index):
+        return self.locations[index]
+
+    @property
+    def is_lazy(self):
+        return isinstance(self.locations, LocationStore)
+
+    @property
+    def analysis(self):
+        """
+        The MapAnalysis of this map, worked out the first time it's needed
+        """
+
+        analysis = self.__dict__.get("_analysis")
+        if analysis is None:
+            analysis = self._analysis = MapAnalysis(self.locations)
+        return analysis
+
+    @property
+    def routes(self):
+        """
+        The RouteIndex of this map, built the first time it's needed
+        """
+
+        routes = self.__dict__.get("_routes")
+        if routes is None:
+            routes = self._routes = RouteIndex(self.analysis)
+        return routes
+
+    def rendered(self, index, fragment, location, render):
+        """
+        A fragment of an unchanged location's description, rendered once
+        for every session on the map. The most recently used
+        RENDER_CACHE_SIZE of them are kept.
+        """
+
+        renders = self.__dict__.get("_renders")
+        if renders is None:
+            renders = self._renders = OrderedDict()
+        key = (index, fragment)
+        messages = renders.get(key)
+        if messages is not None:
+            renders.move_to_end(key)
+            return messages
+        messages = renders[key] = render(location)
+        if len(renders) > RENDER_CACHE_SIZE:
+            renders.popitem(last=False)
+        return messages
+
+    def roster(self, index):
+        """
+        The EnemyRoster of a horde nobody has hurt yet, built once and
+        read (never changed) by every session on the map. The most
+        recently used ROSTER_CACHE_SIZE of them are kept.
+        """
+
+        rosters = self.__dict__.get("_rosters")
+        if rosters is None:
+            rosters = self._rosters = OrderedDict()
+        roster = rosters.get(index)
+        if roster is not None:
+            rosters.move_to_end(index)
+            return roster
+        roster = rosters[index] = EnemyRoster(self[index]["enemies"])
+        if len(rosters) > ROSTER_CACHE_SIZE:
+            rosters.popitem(last=False)
+        return roster
+
+    @property
+    def loot(self):
+        """
+        The LootTables of this map's chests and enemies
+        """
+
+        loot = self.__dict__.get("_loot")
+        if loot is None:
+            loot = self._loot = LootTables(self)
+        return loot
+
+
+class MapAnalysis(object):
+    """
+    Graphs worked out from a map in a single pass over its locations: where
+    every exit leads, which key opens which lock and what every recipe
+    needs and where its ingredients come from. From those it finds the
+    rooms that can't be reached from the start, the locks that can't be
+    opened and the recipes that can't be crafted.
+    """
+
+    def __init__(self, locations):
+        self.count = len(locations)
+        # Exits in compressed rows: the exits of location i are
+        # exit_targets[exit_starts[i]:exit_starts[i + 1]]
+        self.exit_starts = array("Q", [0])
+        self.exit_targets = array("q")
+        self.exit_directions = []
+        self.ids = []
+        self.id_index = {}
+        self.name_index = {}
+        # locked location -> name of the key it needs
+        self.locks = {}
+        self.locked_exits = {}
+        # key name -> [(from id, to id, location index the key is found in)]
+        self.keys = {}
+        # item name -> [(how it's found, location index)]
+        self.item_sources = {}
+        # recipe name -> (ingredients, result name, location index)
+        self.recipes = {}
+        self.craftable = []
+        self.dangling_exits = []
+        # loot table name -> the table, as the map defines it
+        self.loot_tables = {}
+        # (table name, how, location index) of every use of a named table
+        self.loot_references = []
+        self.loot_errors = []
+        self._loot_things = {}
+
+        for index, location in enumerate(locations):
+            self.add_location(index, location)
+        for name, how, index in self.loot_references:
+            if name not in self.loot_tables:
+                self.loot_errors.append(
+                    f"Location {index} uses the loot table {name}, which doesn't exist."
+                )
+            for thing in self.loot_table_things(name):
+                self.add_thing(thing, how, index)
+
+        self.reachable = bytearray(self.count)
+        self.opened_locks = set()
+        self.solve()
+
+    def add_location(self, index, location):
+        location_id = location.get("id")
+        self.ids.append(location_id)
+        if location_id is not None:
+            self.id_index.setdefault(location_id, index)
+        self.name_index.setdefault(str(location.get("name", "")).lower(), index)
+
+        for direction, target in location.get("exits", {}).items():
+            if not isinstance(target, int) or not 0 <= target < self.count:
+                self.dangling_exits.append((index, direction, target))
+                continue
+            self.exit_targets.append(target)
+            self.exit_directions.append(direction)
+        self.exit_starts.append(len(self.exit_targets))
+
+        if location.get("locked"):
+            self.locks[index] = location.get("required_key")
+        if location.get("locked_exits"):
+            self.locked_exits[index] = frozenset(location["locked_exits"])
+        if location.get("craftable"):
+            self.craftable.append(index)
+
+        for item_name in location.get("items", ()):
+            self.add_item_source(item_name, "items", index)
+        for thing in location.get("complex_items", ()):
+            self.add_thing(thing, "complex_items", index)
+        for enemy in location.get("enemies", {}).values():
+            if enemy.get("drop"):
+                self.add_loot(enemy["drop"], "drop", index)
+        if location.get("chest"):
+            self.add_loot_table(location["chest"], "chest", index)
+        for name, table in location.get("loot_tables", {}).items():
+            if name in self.loot_tables:
+                self.loot_errors.append(
+                    f"Location {index} defines the loot table {name} a second time."
+                )
+            else:
+                self.loot_tables[name] = table
+
+    def add_loot(self, spec, how, index):
+        """
+        Add every thing a chest or drop can give, whether it's one thing or
+        a loot table
+        """
+
+        if "table" in spec and "type" not in spec:
+            self.loot_references.append((spec["table"], how, index))
+        elif is_loot_table(spec):
+            self.add_loot_table(spec, how, index)
+        else:
+            self.add_thing(spec, how, index)
+
+    def add_loot_table(self, table, how, index):
+        self.check_loot_table(table, f"A loot table in location {index}")
+        for entry in table.get("items", ()):
+            if entry is not None:
+                self.add_loot(entry, how, index)
+
+    def check_loot_table(self, table, where):
+        chances = table.get("chances")
+        if chances is not None and len(chances) != len(table.get("items", ())):
+            self.loot_errors.append(
+                f"{where} has {len(table.get('items', ()))} items but {len(chances)} chances."
+            )
+
+    def loot_table_things(self, name, using=()):
+        """
+        Every thing a named loot table can give
+        """
+
+        things = self._loot_things.get(name)
+        if things is not None:
+            return things
+        if name in using:
+            self.loot_errors.append(f"Loot table {name} contains itself.")
+            return ()
+        things = []
+        tables = [self.loot_tables.get(name, {})]
+        while tables:
+            table = tables.pop()
+            self.check_loot_table(table, f"Loot table {name}")
+            for entry in table.get("items", ()):
+                if entry is None:
+                    continue
+                if "table" in entry and "type" not in entry:
+                    if entry["table"] not in self.loot_tables:
+                        self.loot_errors.append(
+                            f"Loot table {name} uses the loot table {entry['table']}, which doesn't exist."
+                        )
+                    things.extend(self.loot_table_things(entry["table"], using + (name,)))
+                elif is_loot_table(entry):
+                    tables.append(entry)
+                else:
+                    things.append(entry)
+        self._loot_things[name] = things
+        return things
+
+    def add_item_source(self, item_name, how, index):
+        self.item_sources.setdefault(item_name, []).append((how, index))
+
+    def add_thing(self, thing, how, index):
+        kind = thing.get("type")
+        if kind == "item":
+            self.add_item_source(thing["name"], how, index)
+        elif kind == "key":
+            self.keys.setdefault(thing["name"], []).append(
+                (thing.get("from"), thing.get("to"), index)
+            )
+        elif kind == "recipe":
+            result = thing.get("result") or {}
+            self.recipes[thing["name"]] = (
+                tuple(thing.get("ingredients", ())), result.get("name"), index
+            )
+            if result:
+                self.add_thing(result, "crafted", index)
+
+    def exits(self, index):
+        """
+        (direction, target index) pairs for the exits of a location
+        """
+
+        start, end = self.exit_starts[index], self.exit_starts[index + 1]
+        return zip(self.exit_directions[start:end], self.exit_targets[start:end])
+
+    def solve(self):
+        """
+        Walk the map from the start, opening a lock as soon as its key has
+        been found somewhere reachable and the player can stand next to it
+        """
+
+        if self.count == 0:
+            return
+        found_keys = set()
+        # locked location -> [(location index, direction)] it's been seen from
+        blocked = {}
+        queue = deque([0])
+        self.reachable[0] = 1
+
+        def try_open(target):
+            required_key = self.locks[target]
+            for source, direction in blocked.get(target, ()):
+                if (
+                    direction in self.locked_exits.get(source, ())
+                    and (required_key, self.ids[source], self.ids[target]) in found_keys
+                ):
+                    self.opened_locks.add(target)
+                    self.reachable[target] = 1
+                    queue.append(target)
+                    return
+
+        keys_by_location = {}
+        for key_name, sources in self.keys.items():
+            for key_from, key_to, index in sources:
+                keys_by_location.setdefault(index, []).append(
+                    (key_name, key_from, key_to)
+                )
+
+        while queue:
+            index = queue.popleft()
+            for key in keys_by_location.get(index, ()):
+                found_keys.add(key)
+                target = self.id_index.get(key[2])
+                if (
+                    target is not None and target in blocked
+                    and not self.reachable[target]
+                ):
+                    try_open(target)
+            for direction, target in self.exits(index):
+                if self.reachable[target]:
+                    continue
+                if target in self.locks:
+                    blocked.setdefault(target, []).append((index, direction))
+                    try_open(target)
+                else:
+                    self.reachable[target] = 1
+                    queue.append(target)
+
+    @property
+    def unreachable(self):
+        return [index for index in range(self.count) if not self.reachable[index]]
+
+    @property
+    def unsolvable_locks(self):
+        return sorted(set(self.locks) - self.opened_locks)
+
+    @property
+    def missing_ingredients(self):
+        """
+        recipe name -> ingredients that can't be found anywhere on the map
+        """
+
+        missing = {}
+        for recipe_name, (ingredients, _, _) in self.recipes.items():
+            not_found = [i for i in ingredients if i not in self.item_sources]
+            if not_found:
+                missing[recipe_name] = not_found
+        return missing
+
+    def errors(self):
+        return [
+            f"Exit {direction} of location {index} leads to {target!r}, which doesn't exist."
+            for index, direction, target in self.dangling_exits
+        ] + self.loot_errors
+
+    def warnings(self):
+        warnings = [
+            f"Location {index} can't be reached from the start."
+            for index in self.unreachable
+        ]
+        warnings.extend(
+            f"Location {index} is locked and its key ({self.locks[index]}) can't be used on it."
+            for index in self.unsolvable_locks
+        )
+        warnings.extend(
+            f"Recipe {recipe_name} needs {', '.join(missing)}, which can't be found anywhere."
+            for recipe_name, missing in self.missing_ingredients.items()
+        )
+        return warnings
+
+
+# Distance to a location that can't be reached at all
+NO_ROUTE = 1 << 40
+
+# How many hubs a RouteIndex keeps per location on average before it gives
+# up, as maps like big grids need far too many
+ROUTE_LABEL_LIMIT = 32
+
+
+class RouteIndex(object):
+    """
+    Exact distances between any two locations, ignoring locks, as hub
+    labels (pruned landmark labeling). Every location keeps a short list of
+    hubs it can reach and a short list of hubs that reach it, built by one
+    pruned breadth first search per location once per map. The distance
+    from a to b is the shortest way through a hub both lists share. Locked
+    doors only ever make routes longer, so for a session the distances are
+    a lower bound that keeps an A* search on the shortest route. Maps that
+    need more than label_limit hubs per location drop the labels, and
+    searches there fall back to plain breadth first.
+    """
+
+    def __init__(self, analysis, label_limit=ROUTE_LABEL_LIMIT):
+        self.analysis = analysis
+        self.count = count = analysis.count
+        self.exit_starts = analysis.exit_starts
+        self.exit_targets = analysis.exit_targets
+        self.exit_directions = analysis.exit_directions
+
+        # The exits turned around, in compressed rows like the exits
+        incoming = array("Q", bytes(8 * (count + 1)))
+        for target in self.exit_targets:
+            incoming[target + 1] += 1
+        for index in range(count):
+            incoming[index + 1] += incoming[index]
+        sources = array("q", bytes(8 * len(self.exit_targets)))
+        filled = array("Q", incoming)
+        for index in range(count):
+            for position in range(self.exit_starts[index], self.exit_starts[index + 1]):
+                target = self.exit_targets[position]
+                sources[filled[target]] = index
+                filled[target] += 1
+        self.entrance_starts = incoming
+        self.entrance_sources = sources
+
+        # Whether every exit has a way back, so locations that reach each
+        # other form plain connected components
+        exits = set(zip(self._exit_sources(), self.exit_targets))
+        self.symmetric = all((target, source) in exits for source, target in exits)
+
+        # Busy crossroads first, they are the hubs most routes go through
+        order = sorted(range(count), key=lambda index: (
+            self.exit_starts[index] - self.exit_starts[index + 1]
+            + self.entrance_starts[index] - self.entrance_starts[index + 1]
+        ))
+        rank = array("q", bytes(8 * count))
+        for position, index in enumerate(order):
+            rank[index] = position
+
+        # leaving[a] are (hub, distance a -> hub), arriving[b] are
+        # (hub, distance hub -> b), both sorted by hub. When every exit has
+        # a way back they are the same.
+        leaving = [[] for _ in range(count)]
+        arriving = leaving if self.symmetric else [[] for _ in range(count)]
+        known = array("q", [NO_ROUTE]) * count
+        limit = label_limit * count * (1 if self.symmetric else 2)
+        for hub, index in enumerate(order):
+            limit -= self._label(index, hub, rank, leaving, arriving, known,
+                                 self.exit_starts, self.exit_targets)
+            if not self.symmetric:
+                limit -= self._label(index, hub, rank, arriving, leaving, known,
+                                     self.entrance_starts, self.entrance_sources)
+            if limit < 0:
+                leaving = arriving = None
+                break
+        self.leaving = leaving
+        self.arriving = arriving
+
+    def _exit_sources(self):
+        for index in range(self.count):
+            for _ in range(self.exit_starts[index], self.exit_starts[index + 1]):
+                yield index
+
+    @staticmethod
+    def _label(start, hub, rank, own, found, known, starts, targets):
+        """
+        Breadth first search from start, adding hub to the labels of the
+        locations it reaches unless the labels so far already know a route
+        as short. Returns how many labels it added to.
+        """
+
+        for other, distance in own[start]:
+            known[other] = distance
+        known[hub] = 0
+        added = 0
+        seen = {start}
+        layer = [start]
+        distance = 0
+        while layer:
+            following = []
+            for index in layer:
+                for other, through in found[index]:
+                    if known[other] + through <= distance:
+                        break
+                else:
+                    found[index].append((hub, distance))
+                    added += 1
+                    for position in range(starts[index], starts[index + 1]):
+                        target = targets[position]
+                        if target not in seen and rank[target] > hub:
+                            seen.add(target)
+                            following.append(target)
+            layer = following
+            distance += 1
+        for other, _ in own[start]:
+            known[other] = NO_ROUTE
+        known[hub] = NO_ROUTE
+        return added
+
+    def towards(self, target):
+        """
+        A function giving the distance from any location to target, or
+        just 0 when there are no labels to tell
+        """
+
+        if self.leaving is None:
+            return lambda source: 0
+        hubs = dict(self.arriving[target])
+        leaving = self.leaving
+
+        def distance(source):
+            best = NO_ROUTE
+            for hub, through in leaving[source]:
+                if hub in hubs and through + hubs[hub] < best:
+                    best = through + hubs[hub]
+            return best
+        return distance
+
+    def distance(self, source, target):
+        """
+        The length of the shortest route from source to target, ignoring
+        locks, or at least a lower bound of it. NO_ROUTE means there is no
+        route at all.
+        """
+
+        return self.towards(target)(source)
+
+
+# How many routes a session remembers
+ROUTE_CACHE_SIZE = 1024
+
+
+class Router(object):
+    """
+    Shortest routes for one session, around the locations it still has
+    locked. Routes are remembered until a door opens, and then only
+    forgotten if going through that door could make them shorter.
+    """
+
+    def __init__(self, routes, locked, cache_size=ROUTE_CACHE_SIZE):
+        self.routes = routes
+        self.locked = set(locked)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.parents = None
+
+    def route(self, source, target):
+        """
+        The shortest route as a list of (direction, location index) steps,
+        or None if every way there is locked
+        """
+
+        key = (source, target)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        route = self.search(source, target)
+        self.cache[key] = route
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return route
+
+    def search(self, source, target):
+        routes = self.routes
+        locked = self.locked
+        if target in locked or not self.connected(source, target):
+            return None
+        remaining = routes.towards(target)
+        distance = remaining(source)
+        if distance >= NO_ROUTE:
+            return None
+        exit_starts = routes.exit_starts
+        exit_targets = routes.exit_targets
+        exit_directions = routes.exit_directions
+
+        # With exact distances, step to any open location one closer to
+        # the target. Only when locks block every such step is it up to A*.
+        route = []
+        index = source
+        while distance:
+            distance -= 1
+            for position in range(exit_starts[index], exit_starts[index + 1]):
+                next_index = exit_targets[position]
+                if next_index not in locked and remaining(next_index) == distance:
+                    route.append((exit_directions[position], next_index))
+                    index = next_index
+                    break
+            else:
+                break
+        if index == target:
+            return route
+
+        best = {source: 0}
+        came_from = {}
+        heap = [(remaining(source), 0, source)]
+        while heap:
+            _, distance, index = heapq.heappop(heap)
+            distance = -distance
+            if index == target:
+                route = []
+                while index != source:
+                    previous, direction = came_from[index]
+                    route.append((direction, index))
+                    index = previous
+                route.reverse()
+                return route
+            if distance > best[index]:
+                continue
+            distance += 1
+            for position in range(exit_starts[index], exit_starts[index + 1]):
+                next_index = exit_targets[position]
+                if next_index in locked or distance >= best.get(next_index, NO_ROUTE):
+                    continue
+                bound = remaining(next_index)
+                if bound >= NO_ROUTE:
+                    continue
+                best[next_index] = distance
+                came_from[next_index] = (index, exit_directions[position])
+                heapq.heappush(heap, (distance + bound, -distance, next_index))
+        return None
+
+    def connected(self, source, target):
+        """
+        Whether target might be reachable from source without going
+        through a locked location. Only maps where every exit has a way
+        back are split into components, so on other maps this is always
+        true and the search finds out.
+        """
+
+        if not self.routes.symmetric:
+            return True
+        if self.parents is None:
+            self.parents = array("q", range(self.routes.count))
+            routes = self.routes
+            for index in range(routes.count):
+                if index not in self.locked:
+                    self.join(index)
+        return self.find(source) == self.find(target)
+
+    def find(self, index):
+        parents = self.parents
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    def join(self, index):
+        routes = self.routes
+        root = self.find(index)
+        for position in range(routes.exit_starts[index], routes.exit_starts[index + 1]):
+            target = routes.exit_targets[position]
+            if target not in self.locked:
+                other = self.find(target)
+                if other != root:
+                    self.parents[other] = root
+
+    def unlock(self, index):
+        """
+        Open a door, keeping the routes it can't make any shorter
+        """
+
+        if index not in self.locked:
+            return
+        self.locked.discard(index)
+        if self.parents is not None:
+            self.join(index)
+        distance = self.routes.distance
+        for key, route in list(self.cache.items()):
+            source, target = key
+            if route is None or (
+                distance(source, index) + distance(index, target) < len(route)
+            ):
+                del self.cache[key]
+
+
+def is_loot_table(spec):
+    """
+    Whether a drop is a loot table (inline or a reference to a named one)
+    rather than a single thing
+    """
+
+    return (
+        isinstance(spec, dict) and "type" not in spec
+        and ("items" in spec or "table" in spec)
+    )
+
+
+class LootTable(object):
+    """
+    Weighted entries compiled once into a Walker alias table, so a draw
+    takes one random number and constant time however many entries there
+    are. An entry is a thing, None for nothing at all, or another LootTable
+    whose own draws take its place. A unique table never draws the same
+    entry twice in one go.
+    """
+
+    __slots__ = ("entries", "weights", "rolls", "unique", "probability", "alias")
+
+    def __init__(self, entries, weights=None, rolls=1, unique=False):
+        self.entries = tuple(entries)
+        count = len(self.entries)
+        if weights is None:
+            weights = [1] * count
+        if len(weights) != count:
+            raise LocationMapError(
+                f"A loot table has {count} items but {len(weights)} chances."
+            )
+        if any(weight < 0 for weight in weights):
+            raise LocationMapError("A loot table has a negative chance.")
+        self.weights = tuple(weights)
+        self.rolls = rolls
+        self.unique = unique
+
+        # Every column holds probability of its own entry and the rest of
+        # the alias entry's, so each one adds up to the average weight
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        total = sum(self.weights)
+        if total <= 0:
+            self.entries = ()
+            return
+        scaled = [weight * count / total for weight in self.weights]
+        small = [index for index, weight in enumerate(scaled) if weight < 1]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less = small.pop()
+            more = large[-1]
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            if scaled[more] < 1:
+                small.append(large.pop())
+        # Whatever is left over is 1 give or take rounding
+
+    def pick(self, rng):
+        """
+        The index of one entry
+        """
+
+        count = len(self.entries)
+        column = rng.random() * count
+        index = int(column)
+        if index == count:
+            index -= 1
+        if column - index < self.probability[index]:
+            return index
+        return self.alias[index]
+
+    def picks(self, rng, rolls):
+        if not self.unique:
+            return [self.pick(rng) for _ in range(rolls)]
+
+        rolls = min(rolls, sum(1 for weight in self.weights if weight > 0))
+        chosen = []
+        taken = set()
+        misses = 0
+        while len(chosen) < rolls:
+            if misses > 4 * rolls:
+                # Mostly taken already, so go over what's left instead
+                left = [
+                    i for i, weight in enumerate(self.weights)
+                    if weight > 0 and i not in taken
+                ]
+                target = rng.random() * sum(self.weights[i] for i in left)
+                for index in left:
+                    target -= self.weights[index]
+                    if target < 0:
+                        break
+            else:
+                index = self.pick(rng)
+                if index in taken:
+                    misses += 1
+                    continue
+            taken.add(index)
+            chosen.append(index)
+        return chosen
+
+    def draw(self, rng, rolls=None):
+        """
+        A list of the things found in `rolls` draws (the table's own
+        number of rolls by default)
+        """
+
+        if not self.entries:
+            return []
+        things = []
+        for index in self.picks(rng, self.rolls if rolls is None else rolls):
+            entry = self.entries[index]
+            if isinstance(entry, LootTable):
+                things.extend(entry.draw(rng))
+            elif entry is not None:
+                things.append(entry)
+        return things
+
+
+def compile_loot(spec, named=None, rolls_key="rolls", compiled=None, using=()):
+    """
+    Compile a loot table from a map. Entries can be tables of their own,
+    inline or named ({"table": name}) from `named`, a dict of the tables
+    the map defines. `compiled` shares named tables between calls.
+    """
+
+    if "table" in spec:
+        name = spec["table"]
+        if compiled is not None and name in compiled:
+            return compiled[name]
+        if named is None or name not in named:
+            raise LocationMapError(f"There's no loot table called {name}.")
+        if name in using:
+            raise LocationMapError(f"Loot table {name} contains itself.")
+        table = compile_loot(named[name], named, "rolls", compiled, using + (name,))
+        if compiled is not None:
+            compiled[name] = table
+        return table
+
+    entries = [
+        compile_loot(entry, named, "rolls", compiled, using)
+        if is_loot_table(entry) else entry
+        for entry in spec.get("items", ())
+    ]
+    return LootTable(
+        entries, spec.get("chances"), spec.get(rolls_key, 1), bool(spec.get("unique"))
+    )
+
+
+class LootTables(object):
+    """
+    The chests and enemy drop tables of a map, each compiled the first time
+    it's used and then shared by every session playing the map
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.tables = {}
+        # Named tables, compiled once however many chests and enemies use them
+        self.shared = {}
+
+    def compile(self, spec, rolls_key):
+        return compile_loot(
+            spec, self.template.analysis.loot_tables, rolls_key, self.shared
+        )
+
+    def chest(self, index):
+        key = (index, None)
+        table = self.tables.get(key)
+        if table is None:
+            chest = self.template[index]["chest"]
+            table = self.tables[key] = self.compile(chest, "number_of_items_unlocked")
+        return table
+
+    def drop(self, index, enemy):
+        key = (index, enemy)
+        table = self.tables.get(key)
+        if table is None:
+            drop = self.template[index]["enemies"][enemy]["drop"]
+            table = self.tables[key] = self.compile(drop, "rolls")
+        return table
+
+
+def enemy_kind(name, enemy):
+    """
+    What kind of enemy this is, for counting a horde by kind: its type, or
+    its name without a number at the end
+    """
+
+    return enemy.get("type") or name.rstrip("0123456789") or name
+
+
+def enemies_count(count):
+    return "1 enemy" if count == 1 else f"{count} enemies"
+
+
+def is_horde(location):
+    return len(location.get("enemies", ())) >= HORDE_SIZE
+
+
+def thaw_field(key, value, base):
+    """
+    A mutable copy of a field of the `base` template location. The
+    enemies of a horde become an EnemyRoster.
+    """
+
+    if key == "enemies" and is_horde(base):
+        return EnemyRoster(value)
+    return thaw(value, thaw_depth.get(key, 1))
+
+
+class EnemyRoster(object):
+    """
+    The enemies of a horde, kept in parallel arrays instead of a dict per
+    enemy. Reads like the enemies dict it replaces, except that an enemy
+    read from it is a copy: change hp with damage() or set_hp().
+
+    The arrays are built from the map and shared by every copy. A roster
+    only keeps what changed since: the hp of enemies hurt one at a time,
+    the enemies killed that way and the damage everyone took at once. A
+    copy, like the one undo takes every turn, costs as much as what
+    changed, not as much as the horde.
+
+    Living enemies are counted by (attack, chance), so their attacks on the
+    player take one binomial draw per group. Damage dealt to every enemy
+    at once only moves a shared offset. The enemies it killed are found
+    by walking the map's enemies in order of hp, and a heap of the ones
+    whose hp changed. A turn costs about the same for ten enemies or ten
+    thousand.
+    """
+
+    __slots__ = (
+        "names", "positions", "specs", "attack", "chance", "evasion",
+        "base_hp", "by_base_hp", "passed", "changed", "by_hp", "killed",
+        "count", "damage_taken", "groups", "kinds",
+    )
+
+    def __init__(self, enemies):
+        self.names = tuple(enemies)
+        self.positions = {name: position for position, name in enumerate(self.names)}
+        self.specs = tuple(enemies.values())
+        self.attack = [enemy["attack"] for enemy in self.specs]
+        self.chance = array("d", (float(enemy.get("chance", 1)) for enemy in self.specs))
+        self.evasion = array("d", (
+            float(enemy.get("evasion_chance", 0)) for enemy in self.specs
+        ))
+        # An enemy's hp is its entry in changed, or else in base_hp, less
+        # damage_taken
+        self.base_hp = tuple(enemy["hp"] for enemy in self.specs)
+        self.by_base_hp = tuple(sorted(
+            range(len(self.names)), key=self.base_hp.__getitem__
+        ))
+        # How many of by_base_hp the damage dealt to everyone has gone past
+        self.passed = 0
+        self.damage_taken = 0
+        self.changed = {}
+        self.by_hp = []
+        # Enemies killed that the damage dealt to everyone doesn't account for
+        self.killed = set()
+        self.count = len(self.names)
+        self.groups = Counter(zip(self.attack, self.chance))
+        self.kinds = Counter(
+            enemy_kind(name, enemy) for name, enemy in zip(self.names, self.specs)
+        )
+
+    def copy(self):
+        roster = EnemyRoster.__new__(EnemyRoster)
+        for name in (
+            "names", "positions", "specs", "attack", "chance", "evasion",
+            "base_hp", "by_base_hp", "passed", "damage_taken", "count",
+        ):
+            setattr(roster, name, getattr(self, name))
+        roster.changed = dict(self.changed)
+        roster.by_hp = list(self.by_hp)
+        roster.killed = set(self.killed)
+        roster.groups = Counter(self.groups)
+        roster.kinds = Counter(self.kinds)
+        return roster
+
+    def __len__(self):
+        return self.count
+
+    def is_alive(self, position):
+        if position in self.killed:
+            return False
+        return position in self.changed or self.base_hp[position] > self.damage_taken
+
+    def __contains__(self, name):
+        position = self.positions.get(name)
+        return position is not None and self.is_alive(position)
+
+    def __iter__(self):
+        is_alive = self.is_alive
+        return (name for position, name in enumerate(self.names) if is_alive(position))
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def position(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return self.positions[name]
+
+    def hp(self, position):
+        return self.changed.get(position, self.base_hp[position]) - self.damage_taken
+
+    def __getitem__(self, name):
+        position = self.position(name)
+        return dict(self.specs[position], hp=self.hp(position))
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def __delitem__(self, name):
+        self.kill(self.position(name))
+
+    def kill(self, position):
+        self.killed.add(position)
+        self.forget(position)
+
+    def forget(self, position):
+        """
+        Stop counting a dead enemy
+        """
+
+        self.count -= 1
+        group = (self.attack[position], self.chance[position])
+        self.groups[group] -= 1
+        if not self.groups[group]:
+            del self.groups[group]
+        kind = enemy_kind(self.names[position], self.specs[position])
+        self.kinds[kind] -= 1
+        if not self.kinds[kind]:
+            del self.kinds[kind]
+
+    def spec(self, name):
+        """
+        The template entry of an enemy, dead or alive
+        """
+
+        return self.specs[self.positions[name]]
+
+    def set_hp(self, name, hp):
+        position = self.position(name)
+        self.changed[position] = hp + self.damage_taken
+        heapq.heappush(self.by_hp, (self.changed[position], position))
+        # Drop the entries left behind by hp that has changed since, so
+        # the heap stays the size of what changed
+        if len(self.by_hp) > 2 * len(self.changed) + 16:
+            self.by_hp = [
+                (value, i) for i, value in self.changed.items()
+                if i not in self.killed
+            ]
+            heapq.heapify(self.by_hp)
+        return hp
+
+    def damage(self, name, amount):
+        """
+        Damage one enemy, returning its hp. It stays in the roster until
+        it's deleted, even once its hp is gone.
+        """
+
+        position = self.position(name)
+        return self.set_hp(name, self.hp(position) - amount)
+
+    def area_damage(self, amount):
+        """
+        Damage every enemy, returning the names of the ones killed (and
+        removed) in the order they were met
+        """
+
+        self.damage_taken += amount
+        killed = []
+        base_hp = self.base_hp
+        by_base_hp = self.by_base_hp
+        changed = self.changed
+        while (
+            self.passed < len(by_base_hp)
+            and base_hp[by_base_hp[self.passed]] <= self.damage_taken
+        ):
+            position = by_base_hp[self.passed]
+            self.passed += 1
+            if position not in changed and position not in self.killed:
+                self.forget(position)
+                killed.append(position)
+        by_hp = self.by_hp
+        while by_hp and by_hp[0][0] <= self.damage_taken:
+            hp, position = heapq.heappop(by_hp)
+            # Entries left behind by hp that has changed since are skipped
+            if position not in self.killed and changed.get(position) == hp:
+                self.kill(position)
+                killed.append(position)
+        killed.sort()
+        return [self.names[position] for position in killed]
+
+    def attacks(self, rng=random):
+        """
+        Roll the attacks of every enemy on the player. Returns how many hit
+        and the damage they deal together.
+        """
+
+        hits = damage = 0
+        for (attack, chance), count in self.groups.items():
+            group_hits = binomial(count, hit_chance(chance), rng)
+            hits += group_hits
+            damage += group_hits * attack
+        return hits, damage
+
+    def as_dict(self):
+        """
+        The living enemies as the enemies dict of a location
+        """
+
+        return {name: self[name] for name in self}
+
+
+class LocationOverlay(object):
+    """
+    A session's view of one template location. Reads fall through to the
+    template until the session changes a field, which is then copied into
+    the overlay.
+    """
+
+    __slots__ = ("world", "index", "base", "changes", "renders", "__weakref__")
+
+    def __init__(self, world, index):
+        self.world = world
+        self.index = index
+        self.base = world.template[index]
+        self.changes = {}
+        self.renders = {}
+
+    def get(self, key, default=None):
+        if key in self.changes:
+            return self.changes[key]
+        return self.base.get(key, default)
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            return self.changes[key]
+        return self.base[key]
+
+    def __contains__(self, key):
+        return key in self.changes or key in self.base
+
+    def __setitem__(self, key, value):
+        self.world.touch(self)
+        self.changes[key] = value
+        if self.renders:
+            self.forget_renders(key)
+
+    def writable(self, key, default=()):
+        """
+        Return a mutable copy of a field, copying it on first use. Whatever
+        was rendered from the field is forgotten, as it's about to change.
+        """
+
+        if self.renders:
+            self.forget_renders(key)
+        if key not in self.changes:
+            self.world.touch(self)
+            self.changes[key] = thaw_field(key, self.base.get(key, default), self.base)
+        return self.changes[key]
+
+    def forget_renders(self, key):
+        for fragment in render_fragments_of.get(key, ()):
+            self.renders.pop(fragment, None)
+
+    def rendered(self, fragment, render):
+        """
+        The messages of a fragment of this location's description. They
+        are rendered with render(location) only when the fields they show
+        have changed. Until the session changes any of those, the
+        rendering is shared with every session on the map.
+        """
+
+        if any(key in self.changes for key in render_fragments[fragment]):
+            renders = self.renders
+            messages = renders.get(fragment)
+            if messages is None:
+                messages = renders[fragment] = render(self)
+            return messages
+        return self.world.template.rendered(self.index, fragment, self, render)
+
+
+class World(object):
+    """
+    One session's state on top of a shared MapTemplate. Only the locations
+    the session has changed are kept around.
+    """
+
+    # Whether more than one session plays in the world
+    shared = False
+
+    def __init__(self, template):
+        self.template = template
+        self.touched = {}
+        self.live = weakref.WeakValueDictionary()
+        # Built on the first `travel`
+        self.router = None
+
+    def __len__(self):
+        return len(self.template)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.template)
+        location = self.touched.get(index) or self.live.get(index)
+        if location is None:
+            location = LocationOverlay(self, index)
+            self.live[index] = location
+        return location
+
+    def touch(self, location):
+        self.touched[location.index] = location
+
+    def changes(self):
+        """
+        A copy of everything the session changed, by location index
+        """
+
+        return {
+            index: {key: copy_thawed(value) for key, value in location.changes.items()}
+            for index, location in self.touched.items()
+        }
+
+    def restore(self, changes):
+        """
+        Go back to the state changes() returned. Locations handed out
+        before are no longer part of the world.
+        """
+
+        self.touched = {}
+        self.live = weakref.WeakValueDictionary()
+        for index, location_changes in changes.items():
+            location = LocationOverlay(self, index)
+            location.changes = {
+                key: copy_thawed(value) for key, value in location_changes.items()
+            }
+            self.touched[index] = location
+        # Doors may have been locked again
+        self.router = None
+
+    def route(self, start, target):
+        """
+        The shortest way between two locations that doesn't go through a
+        locked door, see Router.route()
+        """
+
+        if self.router is None:
+            self.router = Router(self.template.routes, (
+                index for index in self.template.analysis.locks
+                if self[index].get("locked")
+            ))
+        return self.router.route(start, target)
+
+    def unlock(self, index):
+        self[index]["locked"] = False
+        if self.router is not None:
+            self.router.unlock(index)
+
+
+class SharedWorld(World):
+    """
+    A World every session in it plays in at once: what one player picks
+    up, kills or unlocks is gone, dead or open for everyone. Turns can't
+    be taken back in it, as they'd take back other players' turns too.
+    The world can be written to a file and read back, so it outlives the
+    process hosting it.
+    """
+
+    shared = True
+
+    def write(self, file_name):
+        """
+        Save every change to the map as gzipped JSON
+        """
+
+        with gzip.open(file_name, 'wt', encoding="utf-8") as f:
+            json.dump({
+                "version": SAVE_GAME_VERSION,
+                "map": map_fingerprint(self.template),
+                "changes": changes_as_list(self.changes()),
+            }, f, separators=(",", ":"))
+
+    def read(self, file_name):
+        """
+        Go back to the world saved in a file by write()
+        """
+
+        try:
+            with gzip.open(file_name, 'rt', encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, EOFError, ValueError):
+            raise SaveGameError(f"Error: Could not read world {file_name}")
+        if data.get("version") != SAVE_GAME_VERSION:
+            raise SaveGameError("Error: Saved world is from another version")
+        if data.get("map") != map_fingerprint(self.template):
+            raise SaveGameError("Error: Saved world is for another map")
+        try:
+            self.restore(changes_from_list(data["changes"], self.template))
+        except (KeyError, TypeError, ValueError):
+            raise SaveGameError("Error: Saved world is corrupt")
+
+
+# Layout of a compiled map:
+#   magic, then location count and metadata size as two little-endian u64s,
+#   then count + 1 u64 record offsets, the pickled metadata (shared string
+#   table and whether there are enemies) and one pickled record per location.
+COMPILED_MAP_MAGIC = b"ADVMAPC\x02"
+COMPILED_MAP_HEADER = struct.Struct("<QQ")
+
+# Strings up to this long that show up more than once go in the shared
+# string table, so every location refers to the same string object.
+INTERN_MAX_LENGTH = 64
+
+
+def _walk_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield key
+            yield from _walk_strings(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _walk_strings(item)
+
+
+class _RecordPickler(pickle.Pickler):
+    def __init__(self, f, string_ids):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.string_ids = string_ids
+
+    def persistent_id(self, obj):
+        if type(obj) is str:
+            return self.string_ids.get(obj)
+        return None
+
+
+class _RecordUnpickler(pickle.Unpickler):
+    """
+    Only lets a compiled map build FrozenDicts, whichever module name
+    (adventure or __main__) they were pickled under
+    """
+
+    def __init__(self, f, strings):
+        super().__init__(f)
+        self.strings = strings
+
+    def persistent_load(self, pid):
+        return self.strings[pid]
+
+    def find_class(self, module, name):
+        if module in ("adventure", "__main__") and name == "FrozenDict":
+            return FrozenDict
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a map")
+
+
+def compile_map(location_map, output_name):
+    """
+    Write a map in compiled form, so it can be loaded without parsing JSON
+    or freezing it again. Works on lazily loaded maps too, a location at a
+    time. Returns the number of locations written.
+    """
+
+    if not isinstance(location_map, (list, tuple, LocationStore)):
+        raise LocationMapError("Map is not a list.")
+
+    count = len(location_map)
+    seen = Counter()
+    has_enemies = False
+    for location in location_map:
+        for direction, index in location.get("exits", {}).items():
+            if not isinstance(index, int) or not 0 <= index < count:
+                raise LocationMapError(
+                    f"Exit {direction} of {location.get('name')} leads nowhere."
+                )
+        seen.update(
+            string for string in _walk_strings(location)
+            if len(string) <= INTERN_MAX_LENGTH
+        )
+        has_enemies = has_enemies or len(location.get('enemies', {})) != 0
+    strings = tuple(string for string, used in seen.items() if used > 1)
+    string_ids = {string: i for i, string in enumerate(strings)}
+    del seen
+
+    meta = pickle.dumps(
+        {"strings": strings, "has_enemies": has_enemies},
+        protocol=pickle.HIGHEST_PROTOCOL,
+    )
+    offsets = array("Q", [0])
+    with open(output_name, 'wb') as f:
+        f.write(COMPILED_MAP_MAGIC)
+        f.write(COMPILED_MAP_HEADER.pack(count, len(meta)))
+        offsets_at = f.tell()
+        f.write(bytes((count + 1) * 8))
+        f.write(meta)
+        records_at = f.tell()
+        for location in location_map:
+            _RecordPickler(f, string_ids).dump(freeze(location))
+            offsets.append(f.tell() - records_at)
+        f.seek(offsets_at)
+        f.write(offsets.tobytes())
+    return count
+
+
+# How many locations a lazily loaded map keeps in memory
+LOCATION_CACHE_SIZE = 1024
+
+# JSON maps bigger than this are indexed and loaded lazily
+LAZY_MAP_SIZE = 64 * 1024 * 1024
+
+# Layout of the index kept next to a lazily loaded JSON map (<map>.idx):
+#   magic, then the map's size and mtime (to notice a stale index), the
+#   location count and whether there are enemies, then the start and end
+#   byte offsets of every location.
+MAP_INDEX_MAGIC = b"ADVMAPI\x01"
+MAP_INDEX_HEADER = struct.Struct("<QQQQ")
+
+
+class LocationStore(object):
+    """
+    A read-only sequence of locations that are only built when asked for.
+    The most recently used `cache_size` of them stay in memory, so memory
+    stays bounded however big the map is.
+    """
+
+    def __init__(self, count, has_enemies, cache_size=LOCATION_CACHE_SIZE):
+        self.count = count
+        self.has_enemies = has_enemies
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        location = self.cache.get(index)
+        if location is not None:
+            self.cache.move_to_end(index)
+            return location
+        if not 0 <= index < self.count:
+            raise IndexError("location index out of range")
+        location = self.cache[index] = self.load(index)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return location
+
+    def __iter__(self):
+        """
+        Go over every location without pushing them through the cache
+        """
+
+        for index in range(self.count):
+            location = self.cache.get(index)
+            yield location if location is not None else self.load(index)
+
+    def load(self, index):
+        raise NotImplementedError
+
+
+class CompiledLocations(LocationStore):
+    """
+    The locations of a memory-mapped compiled map
+    """
+
+    def __init__(self, f, cache_size=LOCATION_CACHE_SIZE):
+        self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(COMPILED_MAP_MAGIC)
+        count, meta_size = COMPILED_MAP_HEADER.unpack_from(self.data, start)
+        start += COMPILED_MAP_HEADER.size
+        if start + (count + 1) * 8 + meta_size > len(self.data):
+            raise pickle.UnpicklingError("Compiled map is truncated.")
+        self.offsets = memoryview(self.data)[
+            start:start + (count + 1) * 8
+        ].cast("Q")
+        start += (count + 1) * 8
+        meta = pickle.loads(self.data[start:start + meta_size])
+        self.records_start = start + meta_size
+        if self.records_start + self.offsets[count] != len(self.data):
+            raise pickle.UnpicklingError("Compiled map is truncated.")
+        self.strings = meta["strings"]
+        super().__init__(count, meta["has_enemies"], cache_size)
+
+    def load(self, index):
+        start = self.records_start + self.offsets[index]
+        end = self.records_start + self.offsets[index + 1]
+        return _RecordUnpickler(
+            io.BytesIO(self.data[start:end]), self.strings
+        ).load()
+
+
+def index_json_map(f, chunk_size=1 << 24):
+    """
+    Find the byte range of every location in a JSON map, reading it a chunk
+    at a time. Returns (starts, ends, has_enemies).
+    """
+
+    decoder = json.JSONDecoder()
+    separators = re.compile(r"[\s,]*")
+    starts = array("Q")
+    ends = array("Q")
+    has_enemies = False
+
+    # Latin-1 keeps one character per byte, so string positions are byte
+    # offsets. Only the structure matters here, not the decoded text.
+    buffer = ""
+    base = 0
+    opened = False
+    while True:
+        chunk = f.read(chunk_size)
+        buffer += chunk.decode("latin-1")
+        position = 0
+        if not opened:
+            position = separators.match(buffer).end()
+            if position >= len(buffer):
+                if not chunk:
+                    raise ValueError("Map file is empty.")
+                continue
+            if buffer[position] != "[":
+                raise ValueError("Map is not a list.")
+            position += 1
+            opened = True
+        while True:
+            position = separators.match(buffer, position).end()
+            if position >= len(buffer):
+                break
+            if buffer[position] == "]":
+                return starts, ends, has_enemies
+            try:
+                location, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if not chunk:
+                    raise
+                break
+            starts.append(base + position)
+            ends.append(base + end)
+            if not has_enemies and isinstance(location, dict):
+                has_enemies = len(location.get("enemies", {})) != 0
+            position = end
+        if not chunk:
+            raise ValueError("Map list is not closed.")
+        base += position
+        buffer = buffer[position:]
+
+
+class JsonLocations(LocationStore):
+    """
+    The locations of a memory-mapped JSON map, found through a byte offset
+    index. The index is saved next to the map so it's only built once.
+    """
+
+    def __init__(self, f, index_name=None, cache_size=LOCATION_CACHE_SIZE):
+        self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stat = os.fstat(f.fileno())
+        index = self.read_index(index_name, stat) if index_name else None
+        if index is None:
+            index = index_json_map(f)
+            if index_name:
+                self.write_index(index_name, stat, index)
+        self.starts, self.ends, has_enemies = index
+        super().__init__(len(self.starts), has_enemies, cache_size)
+
+    @staticmethod
+    def read_index(index_name, stat):
+        try:
+            with open(index_name, 'rb') as f:
+                if f.read(len(MAP_INDEX_MAGIC)) != MAP_INDEX_MAGIC:
+                    return None
+                size, mtime, count, has_enemies = MAP_INDEX_HEADER.unpack(
+                    f.read(MAP_INDEX_HEADER.size)
+                )
+                if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+                    return None
+                starts = array("Q")
+                ends = array("Q")
+                starts.fromfile(f, count)
+                ends.fromfile(f, count)
+                return starts, ends, bool(has_enemies)
+        except (OSError, EOFError, struct.error):
+            return None
+
+    @staticmethod
+    def write_index(index_name, stat, index):
+        starts, ends, has_enemies = index
+        try:
+            with open(index_name, 'wb') as f:
+                f.write(MAP_INDEX_MAGIC)
+                f.write(MAP_INDEX_HEADER.pack(
+                    stat.st_size, stat.st_mtime_ns, len(starts), has_enemies
+                ))
+                starts.tofile(f)
+                ends.tofile(f)
+        except OSError:
+            pass
+
+    def load(self, index):
+        return freeze(json.loads(
+            self.data[self.starts[index]:self.ends[index]].decode("utf-8")
+        ))
+
 
 class MapParsor(object):
     def __init__(self, map_name):
@@ -43,29 +1822,169 @@ class MapParsor(object):
 
     def parse(self):
         try:
-            self.map = json.load(open(self.map_name, 'r'))
-        except:
+            with open(self.map_name, 'rb') as f:
+                if f.read(len(COMPILED_MAP_MAGIC)) == COMPILED_MAP_MAGIC:
+                    self.map = CompiledLocations(f)
+                    return
+                f.seek(0)
+                index_name = self.map_name + ".idx"
+                if (
+                    os.fstat(f.fileno()).st_size > LAZY_MAP_SIZE
+                    or os.path.exists(index_name)
+                ):
+                    self.map = JsonLocations(f, index_name)
+                else:
+                    self.map = json.load(f)
+        except OSError as e:
+            print(f"Error: Could not read map file: {e.strerror}")
+        except (pickle.UnpicklingError, EOFError, struct.error):
+            print("Error: Compiled map file is corrupt")
+        except ValueError:
             print("Error: Map file is not valid JSON")
 
     def is_valid(self):
         return self.map is not None
 
 
+def load_map(map_name):
+    """
+    Parse a map file into a MapTemplate, exiting if it can't be played
+    """
+
+    map_parsor = MapParsor(map_name)
+    map_parsor.parse()
+    if not map_parsor.is_valid():
+        sys.exit(1)
+    try:
+        return MapTemplate(map_parsor.map)
+    except LocationMapError as e:
+        print(e)
+        sys.exit(1)
+
+
+class InventoryBag(object):
+    """
+    An ordered multiset of things keyed by name. Iterates in the order
+    things were added, like a list, but looks up, counts and removes by
+    name in O(1).
+    """
+
+    __slots__ = ("entries", "by_name", "next_token", "version")
+
+    def __init__(self):
+        self.entries = {}
+        self.by_name = {}
+        self.next_token = 0
+        # Goes up with every change, so renders of the bag know they're stale
+        self.version = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def count(self, name):
+        tokens = self.by_name.get(name)
+        return len(tokens) if tokens else 0
+
+    def add(self, name, value):
+        token = self.next_token
+        self.next_token += 1
+        self.version += 1
+        self.entries[token] = value
+        tokens = self.by_name.get(name)
+        if tokens is None:
+            tokens = self.by_name[name] = deque()
+        tokens.append(token)
+
+    def get(self, name):
+        """
+        Return the first thing added under this name
+        """
+
+        tokens = self.by_name.get(name)
+        return self.entries[tokens[0]] if tokens else None
+
+    def pop(self, name):
+        """
+        Remove and return the first thing added under this name
+        """
+
+        tokens = self.by_name.get(name)
+        if not tokens:
+            return None
+        self.version += 1
+        value = self.entries.pop(tokens.popleft())
+        if not tokens:
+            del self.by_name[name]
+        return value
+
+    def copy(self):
+        bag = InventoryBag()
+        bag.entries = dict(self.entries)
+        bag.by_name = {name: deque(tokens) for name, tokens in self.by_name.items()}
+        bag.next_token = self.next_token
+        bag.version = self.version
+        return bag
+
+    def remove(self, name, value=None):
+        """
+        Remove a thing, raising ValueError if it isn't there like list.remove
+        """
+
+        if value is None:
+            if self.pop(name) is None:
+                raise ValueError(f"{name} is not in the inventory")
+            return
+        tokens = self.by_name.get(name, ())
+        for token in tokens:
+            if self.entries[token] == value:
+                self.version += 1
+                tokens.remove(token)
+                del self.entries[token]
+                if not tokens:
+                    del self.by_name[name]
+                return
+        raise ValueError(f"{name} is not in the inventory")
+
+
 class Player(object):
+    __slots__ = (
+        "items", "weapons", "recipies", "spells", "keys", "hp", "total_capacity",
+        "inventory_render",
+    )
+
     def __init__(self, hasEnemies):
-        self.items = []
-        self.weapons = ([{
-            "name": "punch",
-            "type": "weapon",
-            "desc": "Deals 1 damage",
-            "damage": 1,
-            "chance": 0.9
-        }] if hasEnemies else [])
-        self.recipies = []
-        self.spells = []
-        self.keys = []
+        self.items = InventoryBag()
+        self.weapons = InventoryBag()
+        self.recipies = InventoryBag()
+        self.spells = InventoryBag()
+        self.keys = InventoryBag()
+        if hasEnemies:
+            self.pick_weapon({
+                "name": "punch",
+                "type": "weapon",
+                "desc": "Deals 1 damage",
+                "damage": 1,
+                "chance": 0.9
+            })
         self.hp = 100
         self.total_capacity = 10 if hasEnemies else float('inf')
+        # (bag versions, messages) of the last `inventory`
+        self.inventory_render = None
+
+    def copy(self):
+        player = Player.__new__(Player)
+        for bag in ("items", "weapons", "recipies", "spells", "keys"):
+            setattr(player, bag, getattr(self, bag).copy())
+        player.hp = self.hp
+        player.total_capacity = self.total_capacity
+        player.inventory_render = self.inventory_render
+        return player
 
     def total_items(self):
         return len(self.items) + len(self.spells) + len(self.weapons)
@@ -80,34 +1999,41 @@ class Player(object):
         self.hp = min(100, self.hp + hp_gained)
 
     def pick_item(self, item):
-        self.items.append(item)
+        self.items.add(item, item)
 
     def pick_recipe(self, recipe):
-        self.recipies.append(recipe)
+        self.recipies.add(recipe['name'], recipe)
 
     def pick_spell(self, spell):
-        self.spells.append(spell)
+        self.spells.add(spell['name'], spell)
 
     def pick_weapon(self, weapon):
-        self.weapons.append(weapon)
+        self.weapons.add(weapon['name'], weapon)
 
     def pick_key(self, key):
-        self.keys.append(key)
+        self.keys.add(key['name'], key)
 
     def get_recipe(self, recipe_name):
-        for recipe in self.recipies:
-            if recipe['name'] == recipe_name:
-                return recipe
+        return self.recipies.get(recipe_name)
 
     def get_weapon(self, weapon_name):
-        for weapon in self.weapons:
-            if weapon['name'] == weapon_name:
-                return weapon
+        return self.weapons.get(weapon_name)
 
     def get_key(self, key_name):
-        for key in self.keys:
-            if key['name'] == key_name:
-                return key
+        return self.keys.get(key_name)
+
+    def has_item(self, item_name):
+        return item_name in self.items
+
+    def has_ingredients(self, ingredients):
+        return all(
+            self.items.count(item_name) >= needed
+            for item_name, needed in Counter(ingredients).items()
+        )
+
+    def use_ingredients(self, ingredients):
+        for item_name in ingredients:
+            self.items.remove(item_name)
 
     def can_pick_item(self):
         return not self.exceeded_max_capacity()
@@ -116,7 +2042,18 @@ class Player(object):
         return not self.exceeded_max_capacity() or complex_item['type'] in ['recipe', 'key']
 
     def my_complex_items(self):
-        return self.weapons + self.recipies + self.spells
+        return list(self.weapons) + list(self.recipies) + list(self.spells)
+
+    def find_complex_item(self, item_name):
+        """
+        Find a droppable weapon, recipe or spell by name
+        """
+
+        return (
+            self.weapons.get(item_name)
+            or self.recipies.get(item_name)
+            or self.spells.get(item_name)
+        )
 
     def pick_complex_item(self, complex_item):
         if complex_item and complex_item['type'] in ['item', 'recipe', 'spell', 'weapon', 'key']:
@@ -134,82 +2071,1172 @@ class Player(object):
         else:
             return False
 
-    def remove_complex_item(self, complex_item):
-        if complex_item and complex_item['type'] in ['item', 'recipe', 'spell', 'weapon', 'key']:
-            if complex_item['type'] == 'item':
-                self.remove_item(complex_item['name'])
-            elif complex_item['type'] == 'recipe':
-                self.remove_recipe(complex_item)
-            elif complex_item['type'] == 'spell':
-                self.remove_spell(complex_item)
-            elif complex_item['type'] == 'weapon':
-                self.remove_weapon(complex_item)
-            else:
-                self.remove_key(complex_item)
-            return True
-        else:
-            return False
+    def remove_complex_item(self, complex_item):
+        if complex_item and complex_item['type'] in ['item', 'recipe', 'spell', 'weapon', 'key']:
+            if complex_item['type'] == 'item':
+                self.remove_item(complex_item['name'])
+            elif complex_item['type'] == 'recipe':
+                self.remove_recipe(complex_item)
+            elif complex_item['type'] == 'spell':
+                self.remove_spell(complex_item)
+            elif complex_item['type'] == 'weapon':
+                self.remove_weapon(complex_item)
+            else:
+                self.remove_key(complex_item)
+            return True
+        else:
+            return False
+
+    def delete_spell(self, spell_name):
+        return self.spells.pop(spell_name)
+
+    def remove_item(self, item):
+        self.items.remove(item)
+
+    def remove_recipe(self, recipe):
+        self.recipies.remove(recipe['name'], recipe)
+
+    def remove_spell(self, spell):
+        self.spells.remove(spell['name'], spell)
+
+    def remove_weapon(self, weapon):
+        self.weapons.remove(weapon['name'], weapon)
+
+    def remove_key(self, key):
+        self.keys.remove(key['name'], key)
+
+
+class GameEngineError(Exception):
+    pass
+
+
+class LocationMapError(GameEngineError):
+    pass
+
+
+class InvalidCommand(GameEngineError):
+    pass
+
+
+class CommandArgumentError(GameEngineError):
+    pass
+
+
+class MaxCapacityError(GameEngineError):
+    pass
+
+
+class StopGameEngine(GameEngineError):
+    pass
+
+
+class SaveGameError(GameEngineError):
+    pass
+
+
+class JournalError(GameEngineError):
+    pass
+
+
+class RandomStreamError(GameEngineError):
+    pass
+
+
+RANDOM_STREAM_MAGIC = b"ADVRNG\x01"
+
+
+class RecordingRandom(random.Random):
+    """
+    A random.Random that writes every draw the game makes to a stream, so
+    the session can be replayed exactly with ReplayRandom.
+
+    The game only draws through randint() and random() (choices() calls
+    random()). An integer is written as a varint of its zigzag encoding
+    shifted left by one, so a die roll takes a single byte. A float is a
+    varint 1 followed by its 8 bytes.
+    """
+
+    def __init__(self, seed=None, stream=None):
+        super().__init__(seed)
+        self.stream = stream if stream is not None else io.BytesIO()
+        self.stream.write(RANDOM_STREAM_MAGIC)
+
+    def _write_varint(self, value):
+        data = bytearray()
+        while value > 0x7f:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+        data.append(value)
+        self.stream.write(data)
+
+    def getrandbits(self, k):
+        # Only here so randint() keeps drawing the way random.Random does.
+        # Subclasses that override random() alone get a different randint.
+        return super().getrandbits(k)
+
+    def randint(self, a, b):
+        value = super().randint(a, b)
+        zigzag = value << 1 if value >= 0 else (-value << 1) - 1
+        self._write_varint(zigzag << 1)
+        return value
+
+    def random(self):
+        value = super().random()
+        self._write_varint(1)
+        self.stream.write(struct.pack("<d", value))
+        return value
+
+
+class ReplayRandom(random.Random):
+    """
+    Hands out the draws recorded by RecordingRandom, in order. Raises
+    RandomStreamError once the session asks for something the recording
+    doesn't have.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        if stream.read(len(RANDOM_STREAM_MAGIC)) != RANDOM_STREAM_MAGIC:
+            raise RandomStreamError("Error: Not a recorded random stream")
+
+    def _read_varint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self.stream.read(1)
+            if not byte:
+                raise RandomStreamError("Error: The recorded random stream ran out")
+            value |= (byte[0] & 0x7f) << shift
+            if byte[0] < 0x80:
+                return value
+            shift += 7
+
+    def randint(self, a, b):
+        tag = self._read_varint()
+        if tag & 1:
+            raise RandomStreamError("Error: Expected a number in the recorded random stream")
+        zigzag = tag >> 1
+        value = zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1)
+        if not a <= value <= b:
+            raise RandomStreamError(
+                f"Error: Recorded draw {value} is outside {a}..{b}"
+            )
+        return value
+
+    def random(self):
+        if self._read_varint() != 1:
+            raise RandomStreamError("Error: Expected a float in the recorded random stream")
+        data = self.stream.read(8)
+        if len(data) < 8:
+            raise RandomStreamError("Error: The recorded random stream ran out")
+        return struct.unpack("<d", data)[0]
+
+
+class SessionResult(object):
+    """
+    Summary of a finished (or abandoned) session
+    """
+
+    def __init__(self, outcome, hp, inventory, visited, turns):
+        self.outcome = outcome
+        self.hp = hp
+        self.inventory = inventory
+        self.visited = visited
+        self.turns = turns
+
+    def as_dict(self):
+        return {
+            "outcome": self.outcome,
+            "hp": self.hp,
+            "inventory": self.inventory,
+            "visited": self.visited,
+            "turns": self.turns,
+        }
+
+
+class OutputSink(object):
+    """
+    Where the engine sends its messages. Every message has a kind (like
+    "pick_up" or "enemy_attack"), the text shown to the player and any
+    structured fields. Sinks buffer messages until flush() is called, which
+    drivers do once per turn. Rendered descriptions are sent again and
+    again with the same fields, so sinks must not change them.
+    """
+
+    def message(self, kind, text, fields):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+
+class TextSink(OutputSink):
+    """
+    Buffers the text of every message and writes it out in one go
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lines = []
+
+    def message(self, kind, text, fields):
+        self.lines.append(text)
+
+    def flush(self):
+        if not self.lines:
+            return ""
+        text = "\n".join(self.lines) + "\n"
+        self.lines.clear()
+        if self.stream is not None:
+            self.stream.write(text)
+            self.stream.flush()
+        return text
+
+
+class NullSink(OutputSink):
+    """
+    Throws every message away. Useful for simulations and benchmarks.
+    """
+
+    def message(self, kind, text, fields):
+        pass
+
+    def flush(self):
+        return ""
+
+
+class EventSink(OutputSink):
+    """
+    Keeps message records instead of text. Layout messages (blank lines
+    and banners) are skipped. On flush the turn's records are handed to
+    `handler`, if there is one, and returned.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.events = []
+
+    def message(self, kind, text, fields):
+        if kind != "layout":
+            self.events.append({"kind": kind, "text": text, "data": fields})
+
+    def flush(self):
+        events = self.events
+        self.events = []
+        if events and self.handler is not None:
+            self.handler(events)
+        return events
+
+
+# Upper bounds of the latency histogram buckets in seconds, doubling from
+# 1us to about 8s. Slower calls land in one last open bucket.
+LATENCY_BUCKETS = tuple(1e-6 * 2 ** i for i in range(24))
+
+
+class LatencyHistogram(object):
+    """
+    Counts of how long calls took, in fixed buckets so memory doesn't grow
+    with the number of calls. Percentiles are the upper bound of the
+    bucket they fall in.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                if bucket < len(LATENCY_BUCKETS):
+                    return min(LATENCY_BUCKETS[bucket], self.max)
+                break
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+class Instrumentation(object):
+    """
+    Call counts and latency histograms for every verb and for the enemy
+    attacks at the start of every turn. Hand one to any number of
+    GameEngines to collect their numbers together.
+
+    With a profile_threshold every call is run under cProfile and the
+    profiles of calls slower than the threshold are kept, as .prof files
+    in profile_dir if there is one. At most profile_limit are kept.
+    """
+
+    PRE_TURN = "pre_turn"
+
+    def __init__(self, profile_threshold=None, profile_dir=None,
+                 profile_limit=20):
+        self.verbs = {}
+        self.pre_turn = LatencyHistogram()
+        self.profile_threshold = profile_threshold
+        self.profile_dir = profile_dir
+        self.profile_limit = profile_limit
+        self.slow_calls = []
+
+    def timed(self, verb, function, args):
+        """
+        Run function(*args) as a call of verb (or of the pre-turn attacks
+        when verb is None), timing it even if it raises
+        """
+
+        if verb is None:
+            histogram = self.pre_turn
+            verb = self.PRE_TURN
+        else:
+            histogram = self.verbs.get(verb)
+            if histogram is None:
+                histogram = self.verbs[verb] = LatencyHistogram()
+        profiler = None
+        if (
+            self.profile_threshold is not None
+            and len(self.slow_calls) < self.profile_limit
+        ):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                if elapsed >= self.profile_threshold:
+                    self.keep_profile(verb, elapsed, profiler)
+            histogram.add(elapsed)
+
+    def keep_profile(self, verb, elapsed, profiler):
+        slow_call = {"verb": verb, "seconds": elapsed, "profile": None}
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(
+                self.profile_dir, f"{verb}-{len(self.slow_calls)}.prof"
+            )
+            profiler.dump_stats(path)
+            slow_call["profile"] = path
+        else:
+            slow_call["profile"] = profiler
+        self.slow_calls.append(slow_call)
+
+    def as_dict(self):
+        return {
+            "verbs": {
+                verb: histogram.as_dict()
+                for verb, histogram in sorted(self.verbs.items())
+            },
+            "pre_turn": self.pre_turn.as_dict(),
+            "slow_calls": [
+                dict(
+                    slow_call,
+                    profile=slow_call["profile"]
+                    if isinstance(slow_call["profile"], str) else None,
+                )
+                for slow_call in self.slow_calls
+            ],
+        }
+
+    def prometheus(self, prefix="adventure"):
+        """
+        The histograms in the Prometheus text exposition format
+        """
+
+        lines = []
+
+        def histogram_lines(name, labels, histogram):
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram.buckets):
+                seen += count
+                lines.append(f'{name}_bucket{{{labels}le="{bound:g}"}} {seen}')
+            lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+            labels = labels.rstrip(",")
+            labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{labels} {histogram.total!r}")
+            lines.append(f"{name}_count{labels} {histogram.count}")
+
+        name = f"{prefix}_command_seconds"
+        lines.append(f"# HELP {name} Time taken by every verb.")
+        lines.append(f"# TYPE {name} histogram")
+        for verb, histogram in sorted(self.verbs.items()):
+            histogram_lines(name, f'verb="{verb}",', histogram)
+
+        name = f"{prefix}_pre_turn_seconds"
+        lines.append(f"# HELP {name} Time taken by enemy attacks at the start of turns.")
+        lines.append(f"# TYPE {name} histogram")
+        histogram_lines(name, "", self.pre_turn)
+        return "\n".join(lines) + "\n"
+
+
+class Command(object):
+    """
+    A verb, the function running it (called with the engine first),
+    whether it takes an argument, whether the enemies around get to
+    attack before it and whether its argument keeps its case
+    """
+
+    __slots__ = ("verb", "handler", "arity", "takes_turn", "keep_case")
+
+    def __init__(self, verb, handler, arity, takes_turn=True, keep_case=False):
+        self.verb = verb
+        self.handler = handler
+        self.arity = arity
+        self.takes_turn = takes_turn
+        self.keep_case = keep_case
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "verbs")
+
+    def __init__(self):
+        self.children = {}
+        self.verbs = []
+
+
+class CommandRegistry(object):
+    """
+    Every verb the engine understands. Verbs, aliases and every prefix
+    that only one verb starts with (found through a trie of the verbs) are
+    put in one table when something is registered, so reading a command
+    takes a single lookup. Input like `goblin:sword` with no verb runs
+    pair_verb with the whole input as its argument.
+    """
+
+    def __init__(self, pair_verb=None):
+        self.commands = {}
+        self.aliases = {}
+        self.pair_verb = pair_verb
+        self.trie = _TrieNode()
+        self.table = {}
+
+    def register(self, verb, handler, arity=0, aliases=(), takes_turn=True,
+                 keep_case=False):
+        """
+        Add a verb, or replace one. handler is called with the engine and
+        then the argument, if arity is 1. The argument is lowercased
+        unless keep_case is set.
+        """
+
+        if arity not in (0, 1):
+            raise ValueError("Commands take no argument or one.")
+        verb = verb.lower()
+        if verb not in self.commands:
+            node = self.trie
+            for letter in verb:
+                node = node.children.setdefault(letter, _TrieNode())
+                node.verbs.append(verb)
+        self.commands[verb] = Command(verb, handler, arity, takes_turn, keep_case)
+        for alias in aliases:
+            self.aliases[alias.lower()] = verb
+        self.build()
+
+    def alias(self, alias, command):
+        """
+        Make alias run a whole command, like "n" for "go north"
+        """
+
+        self.aliases[alias.lower()] = command.lower()
+        self.build()
+
+    def build(self):
+        table = {}
+
+        def add_prefixes(node, prefix):
+            if len(node.verbs) == 1:
+                table[prefix] = (self.commands[node.verbs[0]], None)
+            for letter, child in node.children.items():
+                add_prefixes(child, prefix + letter)
+
+        for letter, child in self.trie.children.items():
+            add_prefixes(child, letter)
+        for alias, command in self.aliases.items():
+            verb, _, argument = command.partition(" ")
+            if verb in self.commands:
+                table[alias] = (
+                    self.commands[verb], [argument.strip()] if argument else None
+                )
+        for verb, command in self.commands.items():
+            table[verb] = (command, None)
+        self.table = table
+
+    def copy(self):
+        registry = CommandRegistry(self.pair_verb)
+        for command in self.commands.values():
+            registry.register(
+                command.verb, command.handler, command.arity,
+                takes_turn=command.takes_turn, keep_case=command.keep_case,
+            )
+        for alias, command in self.aliases.items():
+            registry.aliases[alias] = command
+        registry.build()
+        return registry
+
+    def find(self, line):
+        """
+        The Command a line of input runs and its arguments, or None. Only
+        the verb is lowercased here, arguments are for verbs that don't
+        keep their case.
+        """
+
+        words = line.split(" ", 1)
+        verb = words[0].lower()
+        found = self.table.get(verb)
+        if found is None:
+            if self.pair_verb and ":" in verb and self.pair_verb in self.commands:
+                return self.commands[self.pair_verb], [line.lower().strip()]
+            return None
+        command, arguments = found
+        if command.arity == 0:
+            return command, []
+        if arguments is not None:
+            return command, arguments
+        if len(words) < 2:
+            return command, [None]
+        argument = words[1].strip()
+        return command, [argument if command.keep_case else argument.lower()]
+
+    def unknown(self, line):
+        """
+        The InvalidCommand for a line find() couldn't make sense of
+        """
+
+        word = line.lower().split(" ", 1)[0]
+        node = self.trie
+        for letter in word:
+            node = node.children.get(letter)
+            if node is None:
+                break
+        if word and node is not None and len(node.verbs) > 1:
+            return InvalidCommand(
+                f"Ambiguous command: {word} could be {', '.join(sorted(node.verbs))}"
+            )
+        return InvalidCommand("Unknown command: " + word)
+
+
+# Clocks whose effects do something on every tick (healing over time,
+# poison). Effects on the other clocks only change how the game goes
+# while they last, and are only due once they run out.
+EVERY_TICK_CLOCKS = frozenset(["turn", "round"])
+
+
+class EffectScheduler(object):
+    """
+    The timed spells in effect on the player and the enemies. Every
+    effect counts down on a clock of its own: "turn" ticks every turn,
+    "round" every turn spent among enemies and "hit" every attack that
+    lands. An effect waits in its clock's heap until it's next due: the
+    next tick for the effects of EVERY_TICK_CLOCKS, the tick it runs out
+    for the others. Moving a clock on only touches the effects due on it.
+    Effects are kept by name, so casting a spell that's still in effect
+    starts it over instead of stacking it.
+    """
+
+    __slots__ = ("clocks", "heaps", "entries", "sequence")
+
+    def __init__(self):
+        self.clocks = {}
+        self.heaps = {}
+        # name -> [clock, due, sequence, effect], in the order they were cast
+        self.entries = {}
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        return (entry[3] for entry in self.entries.values())
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        return entry[3] if entry is not None else None
+
+    def now(self, clock):
+        return self.clocks.get(clock, 0)
+
+    def add(self, effect, clock, due=None):
+        """
+        Put an effect in force. Unless told otherwise, it's due on the
+        next tick of its clock, or once its turns have run out on a clock
+        that isn't one of EVERY_TICK_CLOCKS.
+        """
+
+        if due is None:
+            due = self.now(clock) + (
+                1 if clock in EVERY_TICK_CLOCKS else effect["turns"]
+            )
+        self.sequence += 1
+        self.entries.pop(effect["name"], None)
+        self.entries[effect["name"]] = [clock, due, self.sequence, effect]
+        heapq.heappush(
+            self.heaps.setdefault(clock, []), (due, self.sequence, effect["name"])
+        )
+        return effect
+
+    def remove(self, name):
+        # Its heap entry is skipped once it comes up
+        return self.entries.pop(name, None)
+
+    def set_turns(self, name, turns):
+        """
+        Set the turns an effect has left. One that's only due once it runs
+        out is due again from now.
+        """
+
+        clock, _, _, effect = self.entries[name]
+        effect["turns"] = turns
+        if clock not in EVERY_TICK_CLOCKS:
+            self.add(effect, clock)
+
+    def advance(self, clock):
+        """
+        Move a clock on by one tick. Returns the effects due, in the order
+        they were cast. Those of EVERY_TICK_CLOCKS are due again on the
+        next tick unless they're removed, the others have run out.
+        """
+
+        now = self.clocks[clock] = self.now(clock) + 1
+        heap = self.heaps.get(clock)
+        due = []
+        while heap and heap[0][0] <= now:
+            _, sequence, name = heapq.heappop(heap)
+            entry = self.entries.get(name)
+            # Effects removed or cast again since leave stale entries
+            if entry is not None and entry[2] == sequence:
+                due.append(entry)
+        if clock in EVERY_TICK_CLOCKS:
+            for entry in due:
+                entry[1] = now + 1
+                heapq.heappush(heap, (entry[1], entry[2], entry[3]["name"]))
+        return [entry[3] for entry in due]
+
+    def as_list(self):
+        """
+        [clock, ticks until due, effect] of every effect, in the order they
+        were cast. Only the ticks left count, so the clocks start over.
+        """
+
+        return [
+            [clock, due - self.now(clock), dict(effect)]
+            for clock, due, _, effect in self.entries.values()
+        ]
+
+    @classmethod
+    def from_list(cls, effects_list):
+        effects = cls()
+        for clock, due, effect in effects_list:
+            # Older saves had every effect due on the next tick
+            if clock not in EVERY_TICK_CLOCKS:
+                due = None
+            effects.add(dict(effect), clock, due)
+        return effects
+
+    def copy(self):
+        return EffectScheduler.from_list(self.as_list())
+
+
+SAVE_GAME_VERSION = 2
+
+DEFAULT_SAVE_FILE = "adventure.sav"
+
+# The inventory bags of a Player, in the order they're saved
+PLAYER_BAGS = ("items", "weapons", "recipies", "spells", "keys")
+
+
+def changes_as_list(changes):
+    """
+    What World.changes() returned, as JSON-friendly data
+    """
+
+    return [
+        [index, {
+            key: value.as_dict() if isinstance(value, EnemyRoster) else value
+            for key, value in location_changes.items()
+        }]
+        for index, location_changes in sorted(changes.items())
+    ]
+
+
+def changes_from_list(data, template):
+    return {
+        index: {
+            key: thaw_field(key, freeze(value), template[index])
+            for key, value in location_changes.items()
+        }
+        for index, location_changes in data
+    }
+
+
+class GameSnapshot(object):
+    """
+    Everything a session changed: the locations it touched (and nothing
+    from the map it didn't), the player, the spells in effect and the
+    state of the dice. Taking one only copies what changed, so it's cheap enough
+    to take every turn. Restoring one doesn't change it, so it can be
+    restored any number of times.
+    """
+
+    __slots__ = (
+        "changes", "player", "current_index", "effects", "visited",
+        "turns", "outcome", "pending_confirmation", "rng_state",
+    )
+
+    def __init__(self, engine):
+        self.changes = engine.location_map.changes()
+        self.player = engine.player.copy()
+        self.current_index = engine.current_index
+        self.effects = engine.effects.copy()
+        self.visited = dict(engine.visited)
+        self.turns = engine.turns
+        self.outcome = engine.outcome
+        self.pending_confirmation = engine.pending_confirmation
+        self.rng_state = engine.rng.getstate()
+
+    def restore(self, engine):
+        engine.location_map.restore(self.changes)
+        engine.player = self.player.copy()
+        engine.effects = self.effects.copy()
+        engine.visited = dict(self.visited)
+        engine.turns = self.turns
+        engine.outcome = self.outcome
+        engine.pending_confirmation = self.pending_confirmation
+        engine.rng.setstate(self.rng_state)
+        if self.current_index is None:
+            engine.current_index = engine.current_location = None
+        else:
+            engine.move_to(self.current_index)
+
+    def as_dict(self, template):
+        """
+        The snapshot as JSON-friendly data. A question waiting for an
+        answer can't be saved, so it's left out.
+        """
+
+        version, state, gauss = self.rng_state
+        return {
+            "version": SAVE_GAME_VERSION,
+            "map": map_fingerprint(template),
+            "changes": changes_as_list(self.changes),
+            "player": dict(
+                {bag: list(getattr(self.player, bag)) for bag in PLAYER_BAGS},
+                hp=self.player.hp,
+            ),
+            "current_index": self.current_index,
+            "effects": self.effects.as_list(),
+            "visited": list(self.visited),
+            "turns": self.turns,
+            "outcome": self.outcome,
+            "rng": [version, list(state), gauss],
+        }
+
+    @classmethod
+    def from_dict(cls, data, template):
+        if data.get("version") != SAVE_GAME_VERSION:
+            raise SaveGameError("Error: Saved game is from another version")
+        if data.get("map") != map_fingerprint(template):
+            raise SaveGameError("Error: Saved game is for another map")
+        try:
+            snapshot = cls.__new__(cls)
+            snapshot.changes = changes_from_list(data["changes"], template)
+            player = snapshot.player = Player(template.has_enemies)
+            for bag in PLAYER_BAGS:
+                contents = InventoryBag()
+                for thing in data["player"][bag]:
+                    thing = freeze(thing)
+                    contents.add(thing if bag == "items" else thing["name"], thing)
+                setattr(player, bag, contents)
+            player.hp = data["player"]["hp"]
+            snapshot.current_index = data["current_index"]
+            snapshot.effects = EffectScheduler.from_list(data["effects"])
+            snapshot.visited = dict.fromkeys(data["visited"], True)
+            snapshot.turns = data["turns"]
+            snapshot.outcome = data["outcome"]
+            snapshot.pending_confirmation = None
+            version, state, gauss = data["rng"]
+            snapshot.rng_state = (version, tuple(state), gauss)
+        except (KeyError, TypeError, ValueError):
+            raise SaveGameError("Error: Saved game is corrupt")
+        return snapshot
+
+    def write(self, file_name, template):
+        """
+        Save the snapshot as gzipped JSON
+        """
+
+        with gzip.open(file_name, 'wt', encoding="utf-8") as f:
+            json.dump(self.as_dict(template), f, separators=(",", ":"))
+
+    @classmethod
+    def read(cls, file_name, template):
+        try:
+            with gzip.open(file_name, 'rt', encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, EOFError, ValueError):
+            raise SaveGameError(f"Error: Could not read saved game {file_name}")
+        return cls.from_dict(data, template)
+
+
+def map_fingerprint(template):
+    """
+    Enough about a map to notice a saved game being loaded on another one
+    """
+
+    return {"locations": len(template), "start": template[0].get("name")}
+
+# Layout of a journal: magic, then records that are each a little-endian
+# u32 length followed by that many bytes of JSON. A record is either an
+# event or a snapshot of the whole session.
+JOURNAL_MAGIC = b"ADVLOG\x01"
+JOURNAL_RECORD = struct.Struct("<I")
+
+
+class Journal(object):
+    """
+    An append-only log of every change to one session's state, so the
+    session can be rebuilt after a crash or audited later. Every
+    `compact_every` events the log is rewritten as one snapshot of the
+    session, which keeps replaying it quick however long the session runs.
+    With sync every turn is forced to disk before the next one starts.
+    """
+
+    def __init__(self, file_name, template, compact_every=None, sync=False):
+        self.file_name = file_name
+        self.template = template
+        self.compact_every = compact_every
+        self.sync = sync
+        self.since_compaction = 0
+        # The turn of the last record written, see end_turn()
+        self.turn = None
+        self.f = open(file_name, 'ab')
+        self.empty = self.f.tell() == 0
+        if self.empty:
+            self.f.write(JOURNAL_MAGIC)
+
+    def write_record(self, record):
+        data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+        self.f.write(JOURNAL_RECORD.pack(len(data)))
+        self.f.write(data)
+        self.empty = False
+
+    def append(self, kind, turn, fields):
+        fields["type"] = kind
+        fields["turn"] = turn
+        self.write_record(fields)
+        self.turn = turn
+        self.since_compaction += 1
+
+    def write_snapshot(self, snapshot):
+        self.write_record({
+            "type": "snapshot",
+            "state": snapshot.as_dict(self.template),
+        })
+        self.turn = snapshot.turns
+
+    def end_turn(self, engine):
+        """
+        Called after every command: records the turn if nothing else did,
+        so a rebuilt session counts turns that changed nothing, compacts
+        the log if it's time to, and makes sure the turn is written
+        """
+
+        if engine.turns != self.turn:
+            self.append("turn", engine.turns, {})
+        if (
+            self.compact_every
+            and self.since_compaction >= self.compact_every
+            and engine.pending_confirmation is None
+        ):
+            self.compact(engine.snapshot())
+        self.f.flush()
+        if self.sync:
+            os.fsync(self.f.fileno())
+
+    def compact(self, snapshot):
+        """
+        Replace everything in the log with one snapshot. The new log is
+        written next to the old one and swapped in, so a crash leaves one
+        or the other.
+        """
+
+        temporary_name = self.file_name + ".tmp"
+        with open(temporary_name, 'wb') as f:
+            f.write(JOURNAL_MAGIC)
+            data = json.dumps(
+                {"type": "snapshot", "state": snapshot.as_dict(self.template)},
+                separators=(",", ":"),
+            ).encode("utf-8")
+            f.write(JOURNAL_RECORD.pack(len(data)))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.f.close()
+        os.replace(temporary_name, self.file_name)
+        self.f = open(self.file_name, 'ab')
+        self.turn = snapshot.turns
+        self.since_compaction = 0
+
+    def close(self):
+        self.f.close()
+
+
+def read_journal(f):
+    """
+    Yield the records of a journal one at a time. A record cut short by a
+    crash ends the journal.
+    """
+
+    if f.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+        raise JournalError("Error: Not a journal")
+    while True:
+        header = f.read(JOURNAL_RECORD.size)
+        if len(header) < JOURNAL_RECORD.size:
+            return
+        (size,) = JOURNAL_RECORD.unpack(header)
+        data = f.read(size)
+        if len(data) < size:
+            return
+        try:
+            yield json.loads(data)
+        except ValueError:
+            raise JournalError("Error: Journal is corrupt")
+
+
+def _replay_move(engine, event):
+    engine.move_to(event["to"])
+
+
+def _replay_pick_up(engine, event):
+    location = engine.current_location
+    if "item" in event:
+        engine.player.pick_item(event["item"])
+        location.writable("items").remove(event["item"])
+    else:
+        engine.player.pick_complex_item(event["thing"])
+        location.writable("complex_items").remove(event["thing"])
+
+
+def _replay_drop(engine, event):
+    location = engine.current_location
+    if "item" in event:
+        engine.player.remove_item(event["item"])
+        location.writable("items").append(event["item"])
+    else:
+        engine.player.remove_complex_item(event["thing"])
+        location.writable("complex_items").append(event["thing"])
+
+
+def _replay_craft(engine, event):
+    recipe = engine.player.get_recipe(event["recipe"])
+    engine.player.use_ingredients(recipe["ingredients"])
+    engine.current_location.writable("complex_items").append(recipe["result"])
+
+
+def _replay_unlock(engine, event):
+    engine.location_map.unlock(event["location"])
+
+
+def _replay_open_chest(engine, event):
+    chest = engine.current_location.writable("chest")
+    chest["locked"] = False
+    chest["items"] = []
+    engine.current_location.writable("complex_items").extend(event["items"])
+
+
+def _replay_damage(engine, event):
+    enemies = engine.current_location.writable("enemies")
+    if isinstance(enemies, EnemyRoster):
+        enemies.set_hp(event["enemy"], event["hp"])
+    else:
+        enemies[event["enemy"]]["hp"] = event["hp"]
+    if event["hp"] <= 0:
+        enemy = enemies[event["enemy"]]
+        # Drops from a loot table follow in a loot event of their own
+        if enemy.get("drop") and not is_loot_table(enemy["drop"]):
+            engine.current_location.writable("complex_items").append(enemy["drop"])
+        del enemies[event["enemy"]]
+
+
+def _replay_area_damage(engine, event):
+    # Whatever the dead dropped follows in a loot event
+    engine.enemy_roster(writable=True).area_damage(event["damage"])
+
+
+def _replay_loot(engine, event):
+    engine.current_location.writable("complex_items").extend(event["things"])
 
-    def delete_spell(self, spell_name):
-        for spell in self.spells:
-            if spell['name'] == spell_name:
-                self.spells.remove(spell)
-                return spell
-        return None
 
-    def remove_item(self, item):
-        self.items.remove(item)
+def _replay_hurt(engine, event):
+    engine.player.take_hit(event["hp_lost"])
 
-    def remove_recipe(self, recipe):
-        self.recipies.remove(recipe)
 
-    def remove_spell(self, spell):
-        self.spells.remove(spell)
+def _replay_heal(engine, event):
+    engine.player.heal(event["amount"])
 
-    def remove_weapon(self, weapon):
-        self.weapons.remove(weapon)
 
-    def remove_key(self, key):
-        self.keys.remove(key)
+def _replay_use(engine, event):
+    engine.player.delete_spell(event["spell"])
 
 
-class GameEngineError(Exception):
-    pass
+def _replay_decline(engine, event):
+    engine.player.pick_spell(event["spell"])
 
 
-class LocationMapError(GameEngineError):
-    pass
+def _replay_effect(engine, event):
+    engine.effects.add(thaw(event["effect"]), event["clock"])
 
 
-class InvalidCommand(GameEngineError):
-    pass
+def _replay_effect_tick(engine, event):
+    engine.effects.set_turns(event["name"], event["turns"])
 
 
-class CommandArgumentError(GameEngineError):
-    pass
+def _replay_effect_end(engine, event):
+    engine.effects.remove(event["name"])
 
 
-class MaxCapacityError(GameEngineError):
-    pass
+def _replay_outcome(engine, event):
+    engine.outcome = event["outcome"]
 
 
-class StopGameEngine(GameEngineError):
+def _replay_turn(engine, event):
+    # replay_journal() has already set the turn
     pass
 
 
+def _replay_snapshot(engine, event):
+    GameSnapshot.from_dict(event["state"], engine.template).restore(engine)
+
+
+journal_handlers = {
+    "move": _replay_move,
+    "pick_up": _replay_pick_up,
+    "drop": _replay_drop,
+    "loot": _replay_loot,
+    "craft": _replay_craft,
+    "unlock": _replay_unlock,
+    "open_chest": _replay_open_chest,
+    "damage": _replay_damage,
+    "area_damage": _replay_area_damage,
+    "hurt": _replay_hurt,
+    "heal": _replay_heal,
+    "use": _replay_use,
+    "decline": _replay_decline,
+    "effect": _replay_effect,
+    "effect_tick": _replay_effect_tick,
+    "effect_end": _replay_effect_end,
+    "outcome": _replay_outcome,
+    "turn": _replay_turn,
+    "snapshot": _replay_snapshot,
+}
+
+
+def replay_journal(engine, records):
+    """
+    Rebuild a session by applying journal records to a started engine.
+    Works through the records as they come, so a journal never has to be
+    in memory all at once. Returns the number of records applied.
+    """
+
+    applied = 0
+    for record in records:
+        handler = journal_handlers.get(record.get("type"))
+        if handler is None:
+            raise JournalError(f"Error: Unknown journal event {record.get('type')}")
+        if record["type"] != "snapshot":
+            record = freeze(record)
+            engine.turns = record["turn"]
+        try:
+            handler(engine, record)
+        except (KeyError, ValueError, TypeError):
+            raise JournalError(
+                f"Error: Journal event {record['type']} doesn't fit the session"
+            )
+        applied += 1
+    return applied
+
+
 class GameEngine(object):
-    def __init__(self, location_map):
-        self.location_map = location_map
+    def __init__(self, location_map, sink=None, rng=None, seed=None,
+                 instrumentation=None, commands=None, undo_limit=0,
+                 journal=None, world=None, realtime=False, save_dir="."):
+        if not isinstance(location_map, MapTemplate):
+            location_map = MapTemplate(location_map)
+        self.template = location_map
+        # A SharedWorld has to be on the same template
+        self.location_map = world if world is not None else World(self.template)
         self.current_location = None
-        self.player = Player(
-            any(
-                [
-                    len(location.get('enemies', {})) != 0
-                    for location in location_map
-                ]
-            )
+        self.player = Player(self.template.has_enemies)
+        self.effects = EffectScheduler()
+        self.current_index = None
+        self.visited = {}
+        self.turns = 0
+        self.outcome = None
+        self.pending_confirmation = None
+        self.sink = sink if sink is not None else TextSink(sys.stdout)
+        # Every session rolls its own dice, so sessions in one process
+        # don't affect each other and a seed replays a game exactly
+        self.rng = rng if rng is not None else random.Random(seed)
+        self.instrumentation = instrumentation
+        self.commands = commands if commands is not None else COMMANDS
+        # Snapshots from before the latest turns, for `undo`
+        self.history = (
+            deque(maxlen=undo_limit)
+            if undo_limit and not self.location_map.shared else None
         )
-        self.current_spell = None
+        self.journal = journal
+        # In real time, start_turn() runs on every tick() instead of
+        # before every command
+        self.realtime = realtime
+        # `save` and `load` only use files in here
+        self.save_dir = save_dir
+
+    def say(self, text="", kind="layout", **fields):
+        self.sink.message(kind, text, fields)
+
+    def start(self):
+        """
+        Put the player in the first location
+        """
+
+        self.move_to(0)
+        self.look()
+        if self.journal is not None and self.journal.empty:
+            self.journal.write_snapshot(self.snapshot())
+
+    def move_to(self, index):
+        self.current_index = index
+        self.current_location = self.location_map[index]
+        self.visited[index] = True
+
+    def prompt(self):
+        if self.pending_confirmation:
+            return self.pending_confirmation[0]
+        return "What would you like to do? "
 
     def play(self):
         """
@@ -217,45 +3244,180 @@ class GameEngine(object):
         """
 
         self.validate_map()
-        self.current_location = self.location_map[0]
-        self.look()
+        if self.current_location is None:
+            self.start()
+        else:
+            self.look()
         while True:
+            self.sink.flush()
             try:
-                command = input("What would you like to do? ")
-                if command != "quit":
-                    self.enemy_attack_at_start_of_turn()
-                func_name, args = self.parse_command(command)
-                getattr(self, func_name)(*args)
+                command = input(self.prompt())
             except EOFError:
-                print("Use 'quit' to exit.")
-            except StopGameEngine as e:
-                print(e)
+                self.say("Use 'quit' to exit.", "error")
+                continue
+            if not self.execute(command):
+                break
+        self.sink.flush()
+
+    def run(self, commands):
+        """
+        Play the game without a terminal, feeding it the given commands.
+        Answers to confirmation prompts are taken from the same iterable,
+        just like they would be read from stdin. Returns a SessionResult.
+        """
+
+        self.check_map()
+        self.start()
+        self.sink.flush()
+        for command in commands:
+            running = self.execute(command)
+            self.sink.flush()
+            if not running:
                 break
-            except InvalidCommand as e:
-                print(e)
-                print("Please check readme.txt for a list of valid commands.")
-            except (CommandArgumentError, MaxCapacityError) as e:
-                print(e)
+        return self.result()
+
+    def execute(self, command):
+        """
+        Run a single line of input. Returns False once the game is over.
+        Output stays in the sink until the caller flushes it.
+        """
+
+        try:
+            if self.pending_confirmation:
+                _, on_answer = self.pending_confirmation
+                self.pending_confirmation = None
+                self.timed("confirm", on_answer, command)
+                return True
+            found = self.commands.find(command)
+            if found is None or found[0].takes_turn:
+                if self.history is not None:
+                    self.history.append(self.snapshot())
+                # Answers to a question, lines that aren't commands and
+                # commands like save and undo don't count as turns
+                if found is not None:
+                    self.turns += 1
+                if not self.realtime:
+                    self.timed(None, self.start_turn)
+            if found is None:
+                raise self.commands.unknown(command)
+            command, args = found
+            self.timed(command.verb, command.handler, self, *args)
+        except StopGameEngine as e:
+            self.say(str(e), "game_over", outcome=self.outcome)
+            return False
+        except InvalidCommand as e:
+            self.say(str(e), "error")
+            self.say(
+                "Please check readme.txt for a list of valid commands.", "error"
+            )
+        except (CommandArgumentError, MaxCapacityError) as e:
+            self.say(str(e), "error")
+        finally:
+            if self.journal is not None:
+                self.journal.end_turn(self)
+        return True
+
+    def tick(self):
+        """
+        Let a tick of the clock pass in real time: enemies attack and
+        spells wear on, as they do before every command otherwise.
+        Returns False once the game is over.
+        """
+
+        try:
+            self.timed(None, self.start_turn)
+        except StopGameEngine as e:
+            self.say(str(e), "game_over", outcome=self.outcome)
+            return False
+        finally:
+            if self.journal is not None:
+                self.journal.end_turn(self)
+        return True
+
+    def recover(self, records):
+        """
+        Rebuild the session from journal records without saying anything.
+        Returns the number of records applied.
+        """
+
+        sink, self.sink = self.sink, NullSink()
+        try:
+            self.start()
+            return replay_journal(self, records)
+        finally:
+            self.sink = sink
+
+    def snapshot(self):
+        """
+        Take a GameSnapshot of the session
+        """
+
+        return GameSnapshot(self)
+
+    def restore(self, snapshot):
+        """
+        Put the session back the way it was when the snapshot was taken
+        """
+
+        snapshot.restore(self)
+
+    def record(self, kind, **fields):
+        """
+        Write a change to the session's state to the journal, if it has one
+        """
+
+        if self.journal is not None:
+            self.journal.append(kind, self.turns, fields)
+
+    def timed(self, verb, function, *args):
+        """
+        Run part of a turn, through the instrumentation if there is any
+        """
+
+        if self.instrumentation is None:
+            return function(*args)
+        return self.instrumentation.timed(verb, function, args)
+
+    def result(self):
+        return SessionResult(
+            self.outcome or "unfinished",
+            self.player.hp,
+            {
+                "items": list(self.player.items),
+                "recipes": [i['name'] for i in self.player.recipies],
+                "weapons": [i['name'] for i in self.player.weapons],
+                "spells": [i['name'] for i in self.player.spells],
+                "keys": [i['name'] for i in self.player.keys],
+            },
+            list(self.visited),
+            self.turns,
+        )
 
     def parse_command(self, command):
         """
         Parse the command and return the function name and arguments
         """
 
-        unpacked_command = command.lower().split(" ", 1)
-        func_name = unpacked_command[0]
-        secondPart = None
+        found = self.commands.find(command)
+        if found is None:
+            raise self.commands.unknown(command)
+        return (found[0].verb, found[1])
 
-        if not any(func_name in commands for commands in commands_args_map.values()):
-            raise InvalidCommand("Unknown command: " + func_name)
-
-        if len(unpacked_command) > 1:
-            secondPart = unpacked_command[1].strip()
+    def check_map(self):
+        """
+        Raise LocationMapError if the map can't be played
+        """
 
-        if func_name in commands_args_map[1]:
-            return (func_name, [secondPart])
+        if len(self.template) == 0:
+            raise LocationMapError("Map is empty.")
+        if not self.template.is_lazy:
+            errors = self.analysis.errors()
+            if errors:
+                raise LocationMapError("\n".join(errors))
 
-        return (func_name, [])
+    @property
+    def analysis(self):
+        return self.template.analysis
 
     def validate_map(self):
         """
@@ -263,14 +3425,21 @@ class GameEngine(object):
         """
 
         try:
-            if not isinstance(self.location_map, list):
-                raise LocationMapError("Map is not a list.")
-            if len(self.location_map) == 0:
-                raise LocationMapError("Map is empty.")
+            self.check_map()
         except LocationMapError as e:
-            print(e)
+            self.say(str(e), "error")
+            self.sink.flush()
             sys.exit(1)
 
+    def say_all(self, messages):
+        """
+        Send (kind, text, fields) messages rendered before
+        """
+
+        message = self.sink.message
+        for kind, text, fields in messages:
+            message(kind, text, fields)
+
     def look(self):
         """
         Describe the current location
@@ -279,55 +3448,176 @@ class GameEngine(object):
         if not self.current_location:
             return
 
-        print(
-            "> " +
-            self.current_location["name"] +
+        self.say_all(self.current_location.rendered("look", self.render_look))
+        if self.current_location.get("enemies"):
+            self.say(ENEMY_BANNER)
+            self.say()
+            self.say("Current HP: " + str(self.player.hp), "hp", hp=self.player.hp)
+            self.say_all(self.current_location.rendered("enemies", self.render_enemies))
+
+    def render_look(self, location):
+        """
+        The messages describing a location, up to its enemies
+        """
+
+        messages = [
             (
-                ("(ID: " + str(self.current_location["id"]) + ")")
-                if self.current_location.get("id")
-                else ""
+                "location",
+                "> " + location["name"] + (
+                    ("(ID: " + str(location["id"]) + ")")
+                    if location.get("id")
+                    else ""
+                ),
+                {"name": location["name"]},
+            ),
+            LAYOUT,
+            ("description", location["desc"], {}),
+            LAYOUT,
+        ]
+        if location.get("items", []) or location.get("complex_items", []):
+            messages.extend(location.rendered("items", self.render_items))
+            messages.append(LAYOUT)
+        messages.append((
+            "exits",
+            "Exits: " + " ".join(location["exits"].keys()),
+            {"exits": list(location["exits"].keys())},
+        ))
+        messages.append(LAYOUT)
+        if location.get('chest'):
+            messages.extend([
+                CHEST_BANNER_MESSAGE,
+                LAYOUT,
+                (
+                    "chest",
+                    f"There is a {location.get('chest')['name']} in this room.",
+                    {"name": location.get('chest')['name']},
+                ),
+                LAYOUT,
+                CHEST_BANNER_MESSAGE,
+                LAYOUT,
+            ])
+        return messages
+
+    def render_enemies(self, location):
+        """
+        The messages about a location's enemies, after the player's hp
+        """
+
+        messages = [LAYOUT]
+        if location.get("enemy_attack_desc"):
+            messages.append(("description", location["enemy_attack_desc"], {}))
+            messages.append(LAYOUT)
+        enemies = location["enemies"]
+        if isinstance(enemies, EnemyRoster) or len(enemies) >= HORDE_SIZE:
+            kinds = enemies.kinds if isinstance(enemies, EnemyRoster) else Counter(
+                enemy_kind(name, enemy) for name, enemy in enemies.items()
             )
-        )
-        print()
-        print(self.current_location["desc"])
-        print()
-        if self.current_location.get("items", []) or self.current_location.get("complex_items", []):
-            self.items()
-            print()
-        print("Exits: " + " ".join(self.current_location["exits"].keys()))
-        print()
-        if self.current_location.get('chest'):
-            print("$" * 50)
-            print()
-            print(
-                f"There is a {self.current_location.get('chest')['name']} in this room."
-            )
-            print()
-            print("$" * 50)
-            print()
-        if self.current_location.get("enemies"):
-            print("*" * 50)
-            print()
-            print("Current HP: " + str(self.player.hp))
-            print()
-            if self.current_location.get("enemy_attack_desc"):
-                print(self.current_location["enemy_attack_desc"])
-                print()
-            print(
+            messages.append((
+                "enemies",
+                f"There {'is' if len(enemies) == 1 else 'are'} "
+                f"{enemies_count(len(enemies))} trying to attack you: " +
+                ", ".join(f"{count} {kind}" for kind, count in kinds.items()),
+                {"horde": dict(kinds)},
+            ))
+        else:
+            enemy_names = list(enemies.keys())
+            messages.append((
+                "enemies",
                 "There are the following enemies trying to attack you: " +
-                ", ".join(self.current_location_enemy_names())
-            )
-            print()
-            print("*" * 50)
-            print()
+                ", ".join(enemy_names),
+                {"enemies": enemy_names},
+            ))
+        messages.extend([
+            LAYOUT,
+            ENEMY_BANNER_MESSAGE,
+            LAYOUT,
+        ])
+        return messages
 
     def quit(self):
         """
         Quit the game
         """
 
+        self.outcome = "quit"
         raise StopGameEngine("Goodbye!")
 
+    def undo(self):
+        """
+        Take back the last turn
+        """
+
+        if self.location_map.shared:
+            self.say("Other players share this world, so turns can't be taken back.", "error")
+            return
+        if not self.history:
+            self.say("There's nothing to undo.", "error")
+            return
+        self.restore(self.history.pop())
+        if self.journal is not None:
+            self.journal.write_snapshot(self.snapshot())
+        self.say("You take back your last move.", "undo")
+        self.look()
+
+    def save_path(self, file_name):
+        """
+        The file a save name stands for. Names are just file names, kept
+        in the save directory, so a command can't write or read anywhere
+        else.
+        """
+
+        file_name = file_name or DEFAULT_SAVE_FILE
+        if (
+            ".." in file_name
+            or "/" in file_name
+            or "\\" in file_name
+            or os.path.basename(file_name) != file_name
+        ):
+            raise CommandArgumentError(
+                "Save names are just names, like my_game.sav, not paths."
+            )
+        return os.path.join(self.save_dir, file_name)
+
+    def save(self, file_name):
+        """
+        Save the game to a file
+        """
+
+        if self.location_map.shared:
+            self.say("Games in a shared world can't be saved.", "error")
+            return
+        path = self.save_path(file_name)
+        file_name = file_name or DEFAULT_SAVE_FILE
+        try:
+            self.snapshot().write(path, self.template)
+        except OSError as e:
+            self.say(f"Could not save the game: {e.strerror}", "error")
+            return
+        self.say(f"Game saved to {file_name}.", "save", file=file_name)
+
+    def load(self, file_name):
+        """
+        Load a game saved with `save`
+        """
+
+        if self.location_map.shared:
+            self.say("Games in a shared world can't be loaded.", "error")
+            return
+        path = self.save_path(file_name)
+        file_name = file_name or DEFAULT_SAVE_FILE
+        try:
+            snapshot = GameSnapshot.read(path, self.template)
+        except SaveGameError as e:
+            self.say(str(e), "error")
+            return
+        self.restore(snapshot)
+        if self.history is not None:
+            self.history.clear()
+        if self.journal is not None:
+            self.journal.write_snapshot(self.snapshot())
+        self.say(f"Game loaded from {file_name}.", "load", file=file_name)
+        self.look()
+
     def go(self, direction):
         """
         Go in a particular direction.
@@ -339,16 +3629,60 @@ class GameEngine(object):
         direction = direction.lower()
 
         if direction in self.current_location["exits"]:
-            next_location = self.location_map[self.current_location["exits"][direction]]
-            if next_location.get("locked"):
-                print("The door is locked.")
+            next_index = self.current_location["exits"][direction]
+            if self.location_map[next_index].get("locked"):
+                self.say("The door is locked.", "locked", direction=direction)
                 return
-            self.current_location = next_location
-            print(f"You go {direction}.")
-            print()
+            self.move_to(next_index)
+            self.record("move", to=next_index)
+            self.say(f"You go {direction}.", "move", direction=direction)
+            self.say()
             self.look()
         else:
-            print(f"There's no way to go {direction}.")
+            self.say(f"There's no way to go {direction}.", "no_exit", direction=direction)
+
+    def travel(self, destination):
+        """
+        Take the shortest way to a location, by name or id, stopping early
+        in any location with enemies
+        """
+
+        if not destination:
+            raise CommandArgumentError("Sorry, you need to 'travel' somewhere.")
+
+        analysis = self.template.analysis
+        if destination.isdigit():
+            target = analysis.id_index.get(int(destination))
+        else:
+            target = analysis.name_index.get(destination.lower())
+        if target is None:
+            self.say(f"There's no place called {destination}.", "not_found", place=destination)
+            return
+        if target == self.current_index:
+            self.say("You're already there.", "travel")
+            return
+
+        route = self.location_map.route(self.current_index, target)
+        if route is None:
+            self.say(
+                f"You don't know a way to {destination} without going through a locked door.",
+                "no_route",
+                place=destination,
+            )
+            return
+
+        directions = []
+        for direction, index in route:
+            self.move_to(index)
+            self.record("move", to=index)
+            directions.append(direction)
+            if self.current_location.get("enemies"):
+                break
+        self.say(f"You travel {', '.join(directions)}.", "travel", directions=directions)
+        if self.current_index != target:
+            self.say("Enemies block your way, so you stop here.", "travel_stopped")
+        self.say()
+        self.look()
 
     def get(self, item_name):
         """
@@ -364,8 +3698,9 @@ class GameEngine(object):
             if not self.player.can_pick_item():
                 raise MaxCapacityError("You can't carry any more items.")
             self.player.pick_item(item_name)
-            self.current_location["items"].remove(item_name)
-            print(f"You pick up the {item_name}.")
+            self.current_location.writable("items").remove(item_name)
+            self.record("pick_up", item=item_name)
+            self.say(f"You pick up the {item_name}.", "pick_up", item=item_name)
             return
 
         complex_item = next(
@@ -374,17 +3709,18 @@ class GameEngine(object):
             None
         )
         if not complex_item:
-            print(f"There's no {item_name} anywhere.")
+            self.say(f"There's no {item_name} anywhere.", "not_found", item=item_name)
             return
 
         if not self.player.can_pick_complex_item(complex_item):
             raise MaxCapacityError("You can't carry any more items.")
 
         if self.player.pick_complex_item(complex_item):
-            self.current_location["complex_items"].remove(complex_item)
-            print(f"You pick up the {item_name}.")
+            self.current_location.writable("complex_items").remove(complex_item)
+            self.record("pick_up", thing=complex_item)
+            self.say(f"You pick up the {item_name}.", "pick_up", item=item_name)
         else:
-            print(f"There's no {item_name} anywhere.")
+            self.say(f"There's no {item_name} anywhere.", "not_found", item=item_name)
             return
 
     def get_all(self):
@@ -402,22 +3738,32 @@ class GameEngine(object):
                 break
             self.player.pick_item(item_name)
             picked_items.append(item_name)
-            print(f"You pick up the {item_name}.")
+            self.record("pick_up", item=item_name)
+            self.say(f"You pick up the {item_name}.", "pick_up", item=item_name)
 
         if len(picked_items) > 0:
+            location_items = self.current_location.writable("items")
             for item_name in picked_items:
-                self.current_location["items"].remove(item_name)
+                location_items.remove(item_name)
 
         for complex_item in self.current_location.get('complex_items', []):
             if not self.player.can_pick_complex_item(complex_item):
                 exceeded_max_capacity = True
             elif self.player.pick_complex_item(complex_item):
                 picked_complex_items.append(complex_item)
-                print(f"You pick up the {complex_item['name']}.")
+                self.record("pick_up", thing=complex_item)
+                self.say(
+                    f"You pick up the {complex_item['name']}.",
+                    "pick_up",
+                    item=complex_item['name'],
+                )
 
         if len(picked_complex_items) > 0:
+            location_complex_items = self.current_location.writable(
+                "complex_items"
+            )
             for complex_item in picked_complex_items:
-                self.current_location["complex_items"].remove(complex_item)
+                location_complex_items.remove(complex_item)
 
         if exceeded_max_capacity:
             raise MaxCapacityError("You can't carry any more items.")
@@ -430,29 +3776,25 @@ class GameEngine(object):
         if not item_name:
             raise CommandArgumentError("Sorry, you need to 'drop' something.")
 
-        if item_name in self.player.items:
+        if self.player.has_item(item_name):
             self.player.remove_item(item_name)
-            self.current_location["items"].append(item_name)
-            print(f"You drop the {item_name}.")
+            self.current_location.writable("items").append(item_name)
+            self.record("drop", item=item_name)
+            self.say(f"You drop the {item_name}.", "drop", item=item_name)
             return
 
-        complex_item = next(
-            (i for i in self.player.my_complex_items()
-             if i['name'] == item_name), None
-        )
+        complex_item = self.player.find_complex_item(item_name)
 
         if not complex_item:
-            print(f"You don't have {item_name}.")
+            self.say(f"You don't have {item_name}.", "not_found", item=item_name)
             return
 
         if self.player.remove_complex_item(complex_item):
-            self.current_location['complex_items'] = self.current_location.get(
-                'complex_items', []
-            )
-            self.current_location["complex_items"].append(complex_item)
-            print(f"You drop the {item_name}.")
+            self.current_location.writable("complex_items").append(complex_item)
+            self.record("drop", thing=complex_item)
+            self.say(f"You drop the {item_name}.", "drop", item=item_name)
         else:
-            print("Weird item. Can't drop it.")
+            self.say("Weird item. Can't drop it.", "error")
             return
 
     def inventory(self):
@@ -460,56 +3802,71 @@ class GameEngine(object):
         Show the player's inventory
         """
 
-        if len(self.player.items) + len(self.player.recipies) + len(self.player.weapons) + len(self.player.spells) == 0:
-            print("You're not carrying anything.")
-            return
-
-        print("Inventory:")
-        print(
-            ("  " + "\n  ".join(self.player.items))
-            if self.player.items
-            else "NA"
+        player = self.player
+        versions = (
+            player.items.version, player.recipies.version,
+            player.weapons.version, player.spells.version,
         )
-        if len(self.player.recipies) > 0:
-            print("Recipes:")
-            print("  " + "\n  ".join((i['name']
-                  for i in self.player.recipies)))
+        if player.inventory_render is None or player.inventory_render[0] != versions:
+            player.inventory_render = (versions, self.render_inventory(player))
+        self.say_all(player.inventory_render[1])
 
-        if len(self.player.weapons) > 0:
-            print("Weapons:")
-            print("  " + "\n  ".join((i['name']
-                  for i in self.player.weapons)))
+    def render_inventory(self, player):
+        if len(player.items) + len(player.recipies) + len(player.weapons) + len(player.spells) == 0:
+            return [("inventory", "You're not carrying anything.", {"items": []})]
 
-        if len(self.player.spells) > 0:
-            print("Spells:")
-            print("  " + "\n  ".join((i['name']
-                  for i in self.player.spells)))
+        messages = [
+            ("inventory", "Inventory:", {}),
+            (
+                "inventory",
+                ("  " + "\n  ".join(player.items)) if player.items else "NA",
+                {"items": list(player.items)},
+            ),
+        ]
+        for title, field, bag in (
+            ("Recipes:", "recipes", player.recipies),
+            ("Weapons:", "weapons", player.weapons),
+            ("Spells:", "spells", player.spells),
+        ):
+            if len(bag) > 0:
+                names = [i['name'] for i in bag]
+                messages.append(("inventory", title, {}))
+                messages.append(("inventory", "  " + "\n  ".join(names), {field: names}))
+        return messages
 
     def hp(self):
-        print(f"Current HP: {self.player.hp}")
+        self.say(f"Current HP: {self.player.hp}", "hp", hp=self.player.hp)
 
     def items(self):
         """
         Show the current location items
         """
 
-        print(
+        self.say_all(self.current_location.rendered("items", self.render_items))
+
+    def render_items(self, location):
+        messages = [(
+            "items",
             "Items: " + (
-                ", ".join(self.current_location.get("items"))
-                if len(self.current_location.get("items", [])) > 0
+                ", ".join(location.get("items"))
+                if len(location.get("items", [])) > 0
                 else "NA"
-            )
-        )
-        if len(self.current_location.get('complex_items', [])) > 0:
-            print("Complex Items:")
-            print(
+            ),
+            {"items": list(location.get("items", []))},
+        )]
+        if len(location.get('complex_items', [])) > 0:
+            messages.append(("items", "Complex Items:", {}))
+            messages.append((
+                "items",
                 ", ".join(
                     (
                         i['name'] + " (" + i['type'] + ")"
-                        for i in self.current_location.get('complex_items', [])
+                        for i in location.get('complex_items', [])
                     )
-                )
-            )
+                ),
+                {"complex_items": [i['name'] for i in location.get('complex_items', [])]},
+            ))
+        return messages
 
     def ingredients(self, recipe_name):
         """
@@ -525,10 +3882,15 @@ class GameEngine(object):
             recipe = self.player.get_recipe(f"{recipe_name}_recipe")
 
         if recipe:
-            print("Ingredients:")
-            print(", ".join(recipe['ingredients']))
+            self.say("Ingredients:", "ingredients")
+            self.say(
+                ", ".join(recipe['ingredients']),
+                "ingredients",
+                recipe=recipe['name'],
+                ingredients=list(recipe['ingredients']),
+            )
         else:
-            print("You don't have that recipe.")
+            self.say("You don't have that recipe.", "error")
 
     def craft(self, recipe_name):
         """
@@ -536,7 +3898,7 @@ class GameEngine(object):
         """
 
         if not self.current_location.get('craftable', False):
-            print("You can't craft here.")
+            self.say("You can't craft here.", "error")
             return
 
         if not recipe_name:
@@ -548,21 +3910,26 @@ class GameEngine(object):
             recipe = self.player.get_recipe(f"{recipe_name}_recipe")
 
         if recipe:
-            if all(item_name in self.player.items for item_name in recipe['ingredients']):
-                for item_name in recipe['ingredients']:
-                    self.player.items.remove(item_name)
-                print("You craft the " + recipe['result']['name'])
-                self.current_location["complex_items"] = self.current_location.get(
-                    "complex_items", []
+            if self.player.has_ingredients(recipe['ingredients']):
+                self.player.use_ingredients(recipe['ingredients'])
+                self.say(
+                    "You craft the " + recipe['result']['name'],
+                    "craft",
+                    item=recipe['result']['name'],
                 )
-                self.current_location["complex_items"].append(recipe['result'])
-                print("You can pick up the " +
-                      recipe['result']['name'] + " now.")
+                self.current_location.writable("complex_items").append(
+                    recipe['result']
+                )
+                self.record("craft", recipe=recipe['name'])
+                self.say("You can pick up the " +
+                         recipe['result']['name'] + " now.", "craft")
             else:
-                print("You don't have the ingredients to craft that.")
+                self.say("You don't have the ingredients to craft that.", "error")
             return
         else:
-            print("Recipe unavailble or you don't know how to craft that yet.")
+            self.say(
+                "Recipe unavailble or you don't know how to craft that yet.", "error"
+            )
             return
 
     def unlock(self, exit):
@@ -576,11 +3943,11 @@ class GameEngine(object):
             )
 
         if exit not in self.current_location.get("exits", []):
-            print("Exit does not exist")
+            self.say("Exit does not exist", "error")
             return
 
         if exit not in self.current_location.get("locked_exits", []):
-            print("Exit is not locked")
+            self.say("Exit is not locked", "error")
             return
 
         exit_location = self.location_map[self.current_location["exits"][exit]]
@@ -588,13 +3955,18 @@ class GameEngine(object):
         if exit_location.get("locked"):
             required_key = self.player.get_key(exit_location["required_key"])
             if required_key is not None and required_key.get('from') == self.current_location.get("id") and required_key.get("to") == exit_location.get("id"):
-                print("You unlock the " + exit,
-                      "with the key: " + required_key["name"])
-                exit_location["locked"] = False
+                self.say(
+                    "You unlock the " + exit + " with the key: " + required_key["name"],
+                    "unlock",
+                    direction=exit,
+                    key=required_key["name"],
+                )
+                self.location_map.unlock(self.current_location["exits"][exit])
+                self.record("unlock", location=self.current_location["exits"][exit])
             else:
-                print("You don't have the key to unlock the " + exit)
+                self.say("You don't have the key to unlock the " + exit, "error")
         else:
-            print("The " + exit + " is already unlocked")
+            self.say("The " + exit + " is already unlocked", "error")
 
     def open_chest(self):
         """
@@ -602,25 +3974,34 @@ class GameEngine(object):
         """
 
         if not self.current_location.get("chest"):
-            print("There's no chest here.")
+            self.say("There's no chest here.", "error")
             return
 
         if not self.current_location["chest"]["items"]:
-            print("Wa Wa. The chest is empty.")
+            self.say("Wa Wa. The chest is empty.", "chest")
             return
 
-        print(
-            f"You open the {self.current_location['chest']['name']}. All the items fall out.")
-        self.current_location["chest"]["locked"] = False
-        self.current_location['complex_items'] = self.current_location.get(
-            'complex_items', []
+        self.say(
+            f"You open the {self.current_location['chest']['name']}. All the items fall out.",
+            "chest",
+            name=self.current_location['chest']['name'],
         )
-        unlocked_items = list(unlock_chest(self.current_location["chest"]))
-        print(f"you unlock the chest and find {unlocked_items[0]['name']}")
-        self.current_location["complex_items"].extend(
+        chest = self.current_location.writable("chest")
+        chest["locked"] = False
+        unlocked_items = self.template.loot.chest(self.current_index).draw(self.rng)
+        if unlocked_items:
+            self.say(
+                f"you unlock the chest and find {unlocked_items[0]['name']}",
+                "loot",
+                items=[i['name'] for i in unlocked_items],
+            )
+        else:
+            self.say("you unlock the chest and find nothing", "loot", items=[])
+        self.current_location.writable("complex_items").extend(
             unlocked_items
         )
-        self.current_location["chest"]["items"] = []
+        chest["items"] = []
+        self.record("open_chest", items=unlocked_items)
 
     def punch(self, enemy):
         """
@@ -659,41 +4040,48 @@ class GameEngine(object):
         weapon = self.player.get_weapon(weapon_name)
 
         if not weapon:
-            print("You don't have that weapon.")
+            self.say("You don't have that weapon.", "error")
             return
 
         if not self.current_location.get("enemies"):
-            print("There's nothing to attack here.")
+            self.say("There's nothing to attack here.", "error")
             return
 
         if enemy in self.current_location["enemies"]:
-            print("You attack the " + enemy + " with the " + weapon_name)
-            if will_action_happen(self.current_location["enemies"][enemy].get("evasion_chance", 0)):
-                print(f"The {enemy} evaded your attack!")
+            self.say(
+                "You attack the " + enemy + " with the " + weapon_name,
+                "attack",
+                enemy=enemy,
+                weapon=weapon_name,
+            )
+            if will_action_happen(self.current_location["enemies"][enemy].get("evasion_chance", 0), self.rng):
+                self.say(f"The {enemy} evaded your attack!", "evade", enemy=enemy)
                 return
 
-            if not will_action_happen(weapon['chance']):
-                print(f"You missed hitting the {enemy}!")
+            if not will_action_happen(weapon['chance'], self.rng):
+                self.say(f"You missed hitting the {enemy}!", "miss", enemy=enemy)
                 return
 
             multiplier = 1
-            if self.current_spell and self.current_spell.get("name") == "rage":
-                print("Rage mode ongoing!")
-                if self.current_spell["turns"] > 0:
-                    self.current_spell["turns"] -= 1
-                    multiplier = 1 + \
-                        (self.current_spell["damage_multiplier"] / 100)
-                if self.current_spell["turns"] == 0:
-                    print("Your rage mode will be deactivated after this attack")
-                    self.current_spell = None
+            rage = self.effects.get("rage")
+            if rage is not None:
+                multiplier += self.rage(rage)
+            for effect in self.effects.advance("hit"):
+                self.say(
+                    "Your rage mode will be deactivated after this attack",
+                    "spell",
+                    spell=effect["name"],
+                    effect="ongoing",
+                )
+                self.end_effect(effect)
 
             killed_enemy = self.damage_enemy(
                 enemy, weapon['damage'] * multiplier
             )
             if killed_enemy:
-                del self.current_location["enemies"][enemy]
+                del self.current_location.writable("enemies")[enemy]
         else:
-            print(f"There is no {enemy} to attack here.")
+            self.say(f"There is no {enemy} to attack here.", "error")
 
     def use(self, spell_name):
         if not spell_name:
@@ -702,65 +4090,189 @@ class GameEngine(object):
         spell = self.player.delete_spell(spell_name)
 
         if not spell:
-            print("You don't have that spell on you. Craft it or dont 'use' it.")
+            self.say(
+                "You don't have that spell on you. Craft it or dont 'use' it.",
+                "error",
+            )
             return
+        self.record("use", spell=spell['name'])
 
         enemies_available = len(self.current_location.get('enemies', [])) > 0
 
         if spell['name'] == 'peace':
-            print(
-                f"You cast a {spell_name} spell! A wave of white foam starts to consume the entire world"
+            self.say(
+                f"You cast a {spell_name} spell! A wave of white foam starts to consume the entire world",
+                "spell",
+                spell=spell['name'],
             )
+            self.outcome = "won"
+            self.record("outcome", outcome=self.outcome)
             raise StopGameEngine(
                 "Thud! You get up with a loud noise of your phone hitting the floor. You check that your bed is wet with sweat. You had a nightmare. You have a sip of water, say your prayers and go back to sleep. You sleep now with peace knowing that you are safe and conquered everything."
             )
 
+        if 'heal' in spell_name and spell.get('turns'):
+            self.say(
+                f"You cast a {spell_name} spell! You heal {spell['heal_amount']} hp per turn for the next {spell['turns']} turns.",
+                "spell",
+                spell=spell['name'],
+            )
+            self.put_in_effect(dict(spell), "turn")
+            return
+
         if 'heal' in spell_name:
-            print(
-                f"You cast a {spell_name} spell! You heal {spell['heal_amount']} hp."
+            self.say(
+                f"You cast a {spell_name} spell! You heal {spell['heal_amount']} hp.",
+                "spell",
+                spell=spell['name'],
             )
             self.player.heal(spell['heal_amount'])
-            print(f"You now have {self.player.hp} hp.")
+            self.record("heal", amount=spell['heal_amount'])
+            self.say(f"You now have {self.player.hp} hp.", "hp", hp=self.player.hp)
             return
 
-        shouldCast = True
-
         if not enemies_available:
-            print("You are casting a spell for no reason. There are no enemies here.")
-
-            shouldCastResponse = input(
-                "Do you want to cast it anyway? (y/n): ")
+            self.say(
+                "You are casting a spell for no reason. There are no enemies here.",
+                "confirm",
+            )
 
-            if not shouldCastResponse or shouldCastResponse.lower() in ['n', 'no', 'false', 'f', '0', 'nope']:
-                shouldCast = False
+            def on_answer(shouldCastResponse):
+                if not shouldCastResponse or shouldCastResponse.lower() in ['n', 'no', 'false', 'f', '0', 'nope']:
+                    self.say("You decided not to cast the spell.", "spell")
+                    self.player.pick_spell(spell)
+                    self.record("decline", spell=spell)
+                    return
+                self.cast(spell)
 
-        if not shouldCast:
-            print("You decided not to cast the spell.")
-            self.player.pick_spell(spell)
+            self.pending_confirmation = (
+                "Do you want to cast it anyway? (y/n): ", on_answer
+            )
             return
 
+        self.cast(spell)
+
+    def cast(self, spell):
+        """
+        Apply the effect of an attack spell
+        """
+
         if spell['name'] == 'rage':
-            print(
-                f"Rage mode activated. Your damage is increased by {spell['damage_multiplier']} percentage for the next {spell['turns']} turns!"
+            self.say(
+                f"Rage mode activated. Your damage is increased by {spell['damage_multiplier']} percentage for the next {spell['turns']} turns!",
+                "spell",
+                spell=spell['name'],
             )
-            self.current_spell = dict(spell)
+            self.put_in_effect(dict(spell), "hit")
 
         if spell['name'] == 'fireball':
-            print("You cast a fireball!")
+            self.say("You cast a fireball!", "spell", spell=spell['name'])
             self.attack_enemies_with_spell_damage(
                 spell['damage']
             )
 
         if spell['name'] == 'poison':
-            print(
-                f"You cast a poison cloud! Enemies take {spell['damage']} damage per turn for the next {spell['turns']} turns including current turn."
+            self.say(
+                f"You cast a poison cloud! Enemies take {spell['damage']} damage per turn for the next {spell['turns']} turns including current turn.",
+                "spell",
+                spell=spell['name'],
             )
-            self.current_spell = dict(spell)
+            effect = dict(spell)
             if len(self.current_location.get('enemies', [])) > 0:
                 self.attack_enemies_with_spell_damage(
                     spell['damage']
                 )
-                self.current_spell['turns'] = spell['turns'] - 1
+                effect['turns'] = spell['turns'] - 1
+            self.put_in_effect(effect, "round")
+
+    def put_in_effect(self, effect, clock):
+        """
+        Start a timed spell, counting down on the given clock (see
+        EffectScheduler)
+        """
+
+        self.effects.add(effect, clock)
+        self.record("effect", clock=clock, effect=effect)
+
+    def count_down(self, effect):
+        """
+        Take a turn off an effect that has just done its thing
+        """
+
+        effect["turns"] -= 1
+        self.record("effect_tick", name=effect["name"], turns=effect["turns"])
+
+    def end_effect(self, effect):
+        self.effects.remove(effect["name"])
+        self.record("effect_end", name=effect["name"])
+
+    def rage(self, effect):
+        """
+        Use up a turn of rage on an attack that landed. Returns how much
+        the attack's damage goes up by, as a share of the damage.
+        """
+
+        self.say("Rage mode ongoing!", "spell", spell=effect["name"], effect="ongoing")
+        if effect["turns"] <= 0:
+            return 0
+        self.count_down(effect)
+        return effect["damage_multiplier"] / 100
+
+    def poison(self, effect):
+        """
+        A turn of poison for the enemies around
+        """
+
+        if effect["turns"] > 0:
+            self.say(
+                "Enemies are affected by posion damage!",
+                "spell",
+                spell=effect["name"],
+                effect="ongoing",
+            )
+            self.attack_enemies_with_spell_damage(effect['damage'])
+            self.count_down(effect)
+        if effect["turns"] == 0:
+            self.say(
+                f"Your {effect['name']} spell wore out!",
+                "spell",
+                spell=effect["name"],
+                effect="worn_out",
+            )
+            self.end_effect(effect)
+
+    def heal_over_time(self, effect):
+        """
+        A turn of healing from a spell that heals over time
+        """
+
+        self.player.heal(effect['heal_amount'])
+        self.record("heal", amount=effect['heal_amount'])
+        self.count_down(effect)
+        self.say(
+            f"Your {effect['name']} spell heals you {effect['heal_amount']} hp. You now have {self.player.hp} hp.",
+            "spell",
+            spell=effect["name"],
+            effect="ongoing",
+        )
+        if effect["turns"] <= 0:
+            self.say(
+                f"Your {effect['name']} spell wore out!",
+                "spell",
+                spell=effect["name"],
+                effect="worn_out",
+            )
+            self.end_effect(effect)
+
+    def start_turn(self):
+        """
+        Everything that happens before the player's command: healing over
+        time first, then the enemies' turn
+        """
+
+        for effect in self.effects.advance("turn"):
+            self.heal_over_time(effect)
+        self.enemy_attack_at_start_of_turn()
 
     def enemy_attack_at_start_of_turn(self):
         """
@@ -773,81 +4285,267 @@ class GameEngine(object):
         if len(self.current_location.get('enemies', {})) == 0:
             return
 
-        print()
-        print("*" * 50)
-        print()
+        self.say()
+        self.say(ENEMY_BANNER)
+        self.say()
 
-        if self.current_spell is not None and self.current_spell.get('name') == "poison":
-            if self.current_spell["turns"] > 0:
-                print("Enemies are affected by posion damage!")
-                self.attack_enemies_with_spell_damage(
-                    self.current_spell['damage']
-                )
-                self.current_spell["turns"] -= 1
-            if self.current_spell["turns"] == 0:
-                print("Your poison spell wore out!")
-                self.current_spell = None
+        poisons = self.effects.advance("round")
+        if poisons:
+            for effect in poisons:
+                self.poison(effect)
 
             if len(self.current_location.get('enemies', [])) == 0:
-                print("You snake-d your way to victory in this room!")
+                self.say(
+                    "You snake-d your way to victory in this room!",
+                    "spell",
+                    spell="poison",
+                    effect="cleared",
+                )
 
-        hp_lost = 0
-        for (name, i) in self.current_location['enemies'].items():
-            if will_action_happen(i.get('chance', 1)):
-                hp_lost += i['attack']
-                print(f"{name} attacked you!")
+        roster = self.enemy_roster()
+        if roster is not None:
+            hits, hp_lost = roster.attacks(self.rng)
+            if hits:
+                self.say(
+                    f"{hits} of {enemies_count(len(roster))} attacked you!",
+                    "enemy_attack",
+                    hits=hits,
+                    enemies=len(roster),
+                )
             else:
-                print(f"{name} missed!")
+                self.say(
+                    f"{enemies_count(len(roster))} missed!" if len(roster) == 1
+                    else f"All {len(roster)} enemies missed!",
+                    "enemy_miss",
+                    enemies=len(roster),
+                )
+        else:
+            hp_lost = 0
+            for (name, i) in self.current_location['enemies'].items():
+                if will_action_happen(i.get('chance', 1), self.rng):
+                    hp_lost += i['attack']
+                    self.say(f"{name} attacked you!", "enemy_attack", enemy=name)
+                else:
+                    self.say(f"{name} missed!", "enemy_miss", enemy=name)
         self.player.take_hit(hp_lost)
+        if hp_lost:
+            self.record("hurt", hp_lost=hp_lost)
         if hp_lost > 0:
-            print(f"You lost {hp_lost} hp.")
+            self.say(f"You lost {hp_lost} hp.", "hp_lost", hp_lost=hp_lost)
         else:
-            print("Lucky you! You didn't lose any hp.")
+            self.say("Lucky you! You didn't lose any hp.", "hp_lost", hp_lost=0)
         if self.player.hp <= 0:
+            self.outcome = "died"
+            self.record("outcome", outcome=self.outcome)
             raise StopGameEngine("You died!")
-        print("Your current hp is:", self.player.hp)
-        print()
-        print("*" * 50)
-        print()
+        self.say(f"Your current hp is: {self.player.hp}", "hp", hp=self.player.hp)
+        self.say()
+        self.say(ENEMY_BANNER)
+        self.say()
+
+    def enemy_roster(self, writable=False):
+        """
+        The EnemyRoster of the current location, if it started out with a
+        horde of enemies. Only a writable one is copied into the session;
+        until then the map's own roster is read.
+        """
+
+        location = self.current_location
+        if not is_horde(location.base):
+            return None
+        if writable:
+            return location.writable("enemies")
+        enemies = location.get("enemies")
+        if isinstance(enemies, EnemyRoster):
+            return enemies
+        return self.template.roster(self.current_index)
 
     def attack_enemies_with_spell_damage(self, damage):
+        roster = self.enemy_roster(writable=True)
+        if roster is not None:
+            self.damage_horde(roster, damage)
+            return
         killed_enemies = [
             self.damage_enemy(enemy, damage)
-            for enemy in self.current_location['enemies']
+            for enemy in self.current_location.get('enemies', {})
         ]
         for enemy in killed_enemies:
             if enemy:
-                del self.current_location['enemies'][enemy]
+                del self.current_location.writable('enemies')[enemy]
 
-    def damage_enemy(self, enemy, damage):
-        self.current_location['enemies'][enemy]['hp'] -= damage
-        if self.current_location['enemies'][enemy]['hp'] <= 0:
-            print(f"You killed the {enemy}!")
-            drop = self.current_location['enemies'][enemy].get('drop')
-            if drop:
-                print(f"You found one {drop['type']}: `{drop['name']}`!")
-                print("You can pickup the item with the 'get' command.")
-                self.current_location['complex_items'] = self.current_location.get(
-                    'complex_items', []
+    def damage_horde(self, roster, damage):
+        """
+        Damage every enemy of a horde at once, telling the player about
+        them as a crowd
+        """
+
+        killed = roster.area_damage(damage)
+        self.record("area_damage", damage=damage)
+        if killed:
+            self.say(f"You killed {enemies_count(len(killed))}!", "kill", enemies=len(killed))
+        if roster:
+            self.say(
+                f"{enemies_count(len(roster))} still standing.",
+                "damage",
+                enemies=len(roster),
+            )
+
+        drops = []
+        for enemy in killed:
+            drop = roster.spec(enemy).get('drop')
+            if drop and is_loot_table(drop):
+                drops.extend(
+                    self.template.loot.drop(self.current_index, enemy).draw(self.rng)
+                )
+            elif drop:
+                drops.append(drop)
+        if drops:
+            self.record("loot", things=drops)
+            found = Counter((drop['type'], drop['name']) for drop in drops)
+            for (kind, name), count in found.items():
+                self.say(
+                    f"You found one {kind}: `{name}`!" if count == 1
+                    else f"You found {count} {kind}s: `{name}`!",
+                    "loot",
+                    items=[name] * count,
                 )
+            self.say("You can pickup the item with the 'get' command.", "loot")
+            self.current_location.writable('complex_items').extend(drops)
 
-                self.current_location['complex_items'].append(drop)
+    def damage_enemy(self, enemy, damage):
+        enemies = self.current_location.writable('enemies')
+        if isinstance(enemies, EnemyRoster):
+            enemies.damage(enemy, damage)
+        else:
+            enemies[enemy]['hp'] -= damage
+        self.record("damage", enemy=enemy, hp=enemies[enemy]['hp'])
+        if enemies[enemy]['hp'] <= 0:
+            self.say(f"You killed the {enemy}!", "kill", enemy=enemy)
+            drops = enemies[enemy].get('drop')
+            if drops and is_loot_table(drops):
+                drops = self.template.loot.drop(self.current_index, enemy).draw(self.rng)
+                self.record("loot", things=drops)
+            elif drops:
+                drops = [drops]
+            for drop in drops or ():
+                self.say(
+                    f"You found one {drop['type']}: `{drop['name']}`!",
+                    "loot",
+                    items=[drop['name']],
+                )
+            if drops:
+                self.say("You can pickup the item with the 'get' command.", "loot")
+                self.current_location.writable('complex_items').extend(drops)
 
             return enemy
         else:
-            print(
-                f"The {enemy} has {self.current_location['enemies'][enemy]['hp']} hp left."
+            self.say(
+                f"The {enemy} has {enemies[enemy]['hp']} hp left.",
+                "damage",
+                enemy=enemy,
+                hp=enemies[enemy]['hp'],
             )
             return
 
 
+def default_commands(without=()):
+    """
+    A CommandRegistry of every built-in verb and alias, but the verbs in
+    `without`
+    """
+
+    registry = CommandRegistry(pair_verb="attack")
+    for arity, verbs in commands_args_map.items():
+        for verb in verbs:
+            if verb in without:
+                continue
+            registry.register(
+                verb, getattr(GameEngine, verb), arity,
+                takes_turn=verb not in commands_without_turn,
+                keep_case=verb in commands_keep_case,
+            )
+    for alias, command in command_aliases.items():
+        registry.alias(alias, command)
+    return registry
+
+
+# The commands every GameEngine understands unless it's given its own.
+# Plugins can register more verbs here.
+COMMANDS = default_commands()
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Please provide a map file.")
         sys.exit(1)
-    map_parsor = MapParsor(sys.argv[1])
-    map_parsor.parse()
-
-    if map_parsor.is_valid():
-        location_map = map_parsor.map
-        GameEngine(location_map).play()
+    parser = argparse.ArgumentParser(description="Play a text adventure map.")
+    parser.add_argument("map")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed the dice, so the same commands play the same game")
+    parser.add_argument("--record",
+                        help="write every random draw to this file")
+    parser.add_argument("--replay",
+                        help="take the random draws from a file written by --record")
+    parser.add_argument("--undo", type=int, default=20, metavar="TURNS",
+                        help="how many turns `undo` can take back")
+    parser.add_argument("--save-dir", default=".",
+                        help="where `save` and `load` keep saved games")
+    parser.add_argument("--journal",
+                        help="log every change to this file, picking the game "
+                             "up from it if it's already there")
+    parser.add_argument("--compact-every", type=int, default=1000, metavar="EVENTS",
+                        help="fold the journal into a snapshot this often")
+    parser.add_argument("--stats",
+                        help="write how long every command took to this JSON file")
+    parser.add_argument("--profile-slow", type=float, metavar="SECONDS",
+                        help="profile commands slower than this, see --profile-dir")
+    parser.add_argument("--profile-dir", default="profiles",
+                        help="where profiles of slow commands are saved")
+    args = parser.parse_args()
+
+    instrumentation = None
+    if args.stats or args.profile_slow is not None:
+        instrumentation = Instrumentation(args.profile_slow, args.profile_dir)
+
+    with contextlib.ExitStack() as files:
+        rng = None
+        try:
+            if args.replay:
+                rng = ReplayRandom(files.enter_context(open(args.replay, 'rb')))
+            elif args.record:
+                rng = RecordingRandom(
+                    args.seed, files.enter_context(open(args.record, 'wb'))
+                )
+        except (OSError, RandomStreamError) as e:
+            print(e)
+            sys.exit(1)
+        try:
+            template = load_map(args.map)
+            journal = None
+            if args.journal:
+                try:
+                    journal = files.enter_context(contextlib.closing(
+                        Journal(args.journal, template, args.compact_every)
+                    ))
+                except OSError as e:
+                    print(f"Error: Could not open the journal: {e.strerror}")
+                    sys.exit(1)
+            engine = GameEngine(
+                template, rng=rng, seed=args.seed,
+                instrumentation=instrumentation, undo_limit=args.undo,
+                journal=journal, save_dir=args.save_dir,
+            )
+            if journal is not None and not journal.empty:
+                with open(args.journal, 'rb') as f:
+                    engine.recover(read_journal(f))
+                if engine.outcome is not None:
+                    print(f"The game in {args.journal} is already over.")
+                    sys.exit(1)
+            engine.play()
+        except (RandomStreamError, JournalError) as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            if args.stats:
+                with open(args.stats, 'w') as f:
+                    json.dump(instrumentation.as_dict(), f, indent=2)
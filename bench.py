@@ -0,0 +1,410 @@
+"""
+Benchmark the engine's hot paths and compare them with a baseline.
+
+Every benchmark reports operations per second (commands, or locations for
+map loading), so higher is always better. Results are written as JSON.
+When a baseline file exists the results are compared against it, and any
+benchmark that got slower than the tolerance allows is reported as a
+regression (with a non-zero exit status). Baselines depend on the machine
+they were measured on, so save one per machine with --save-baseline.
+
+Usage:
+    python3 bench.py --save-baseline
+    python3 bench.py
+    python3 bench.py --quick --only look --only attack
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+
+from adventure import (
+    GameEngine, MapParsor, MapTemplate, NullSink, TextSink, compile_map,
+)
+
+
+BASELINE = "bench_baseline.json"
+RESULTS = "bench_results.json"
+
+
+def arena(**location):
+    """
+    A one location map for benchmarks that only need a single room
+    """
+
+    location.setdefault("exits", {})
+    return [dict(id=0, name="Arena", desc="A room for benchmarks.", **location)]
+
+
+def scaled_map(copies):
+    """
+    square.map repeated the given number of times, every copy's first
+    location linked to the next copy's
+    """
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "square.map")) as f:
+        square = json.load(f)
+    size = len(square)
+    locations = []
+    for copy in range(copies):
+        offset = copy * size
+        for location in square:
+            location = json.loads(json.dumps(location))
+            location["id"] += offset
+            location["exits"] = {
+                direction: target + offset
+                for direction, target in location.get("exits", {}).items()
+            }
+            for key in _keys(location):
+                key["from"] += offset
+                key["to"] += offset
+            locations.append(location)
+        if copy + 1 < copies:
+            locations[offset]["exits"]["down"] = offset + size
+    return locations
+
+
+def _keys(location):
+    for enemy in location.get("enemies", {}).values():
+        drop = enemy.get("drop")
+        if drop and drop.get("type") == "key":
+            yield drop
+    for thing in location.get("complex_items", []):
+        if thing.get("type") == "key":
+            yield thing
+
+
+class Benchmark(object):
+    """
+    One measurement. setup() builds whatever the benchmark needs and
+    returns a callable doing `operations` operations per call.
+    """
+
+    unit = "commands"
+
+    def __init__(self, name, setup, operations, unit=None):
+        self.name = name
+        self.setup = setup
+        self.operations = operations
+        if unit:
+            self.unit = unit
+
+    def run(self, repeats, min_time):
+        """
+        Returns the rate of every repeat. A repeat calls the benchmark
+        once to warm up, then until at least min_time seconds have passed.
+        What the first call does only once (building a roster, filling a
+        cache) isn't timed.
+        """
+
+        rates = []
+        for _ in range(repeats):
+            step = self.setup()
+            step()
+            calls = 0
+            started = time.perf_counter()
+            elapsed = 0
+            while elapsed < min_time or not calls:
+                step()
+                calls += 1
+                elapsed = time.perf_counter() - started
+            rates.append(calls * self.operations / elapsed)
+        return rates
+
+
+def engine_in(location_map, sink=None, undo_limit=0):
+    engine = GameEngine(location_map, sink or NullSink(), seed=0, undo_limit=undo_limit)
+    engine.start()
+    engine.sink.flush()
+    return engine
+
+
+def bench_dispatch():
+    engine = engine_in(arena(items=["stone"]))
+    commands = ["hp", "inventory", "items", "go nowhere", "dance"] * 20
+
+    def step():
+        for command in commands:
+            engine.execute(command)
+    return step
+
+
+def bench_look():
+    engine = engine_in(
+        arena(
+            exits={"north": 0, "south": 0, "east": 0, "west": 0},
+            items=[f"item{i}" for i in range(50)],
+            complex_items=[
+                {"name": f"sword{i}", "type": "weapon", "damage": 5, "chance": 0.5}
+                for i in range(20)
+            ],
+        ),
+        TextSink(),
+    )
+
+    def step():
+        for _ in range(100):
+            engine.look()
+            engine.sink.flush()
+    return step
+
+
+def bench_get_all_drop():
+    items = [f"item{i}" for i in range(1000)]
+    engine = engine_in(arena(items=items))
+    drops = ["drop " + item for item in items]
+
+    def step():
+        engine.execute("get_all")
+        for command in drops:
+            engine.execute(command)
+    return step
+
+
+def bench_attack():
+    engine = engine_in(arena(enemies={
+        "dummy": {"hp": 10 ** 12, "attack": 0, "chance": 1},
+    }))
+
+    def step():
+        for _ in range(100):
+            engine.execute("attack dummy:punch")
+    return step
+
+
+def bench_enemy_turn():
+    engine = engine_in(arena(enemies={
+        f"rat{i}": {"hp": 10, "attack": 0, "chance": 0.5} for i in range(200)
+    }))
+
+    def step():
+        for _ in range(10):
+            engine.enemy_attack_at_start_of_turn()
+    return step
+
+
+def bench_horde_turn():
+    """
+    Enemy turns and fireballs in a room with ten thousand enemies
+    """
+
+    engine = engine_in(arena(enemies={
+        f"rat{i}": {"hp": 10 ** 12, "attack": 0, "chance": 0.5} for i in range(10000)
+    }))
+
+    def step():
+        for _ in range(10):
+            engine.enemy_attack_at_start_of_turn()
+            engine.attack_enemies_with_spell_damage(1)
+    return step
+
+
+def bench_horde_turn_undo():
+    """
+    Turns and fireballs in a room with ten thousand enemies, keeping an
+    undo history as the game does by default
+    """
+
+    engine = engine_in(arena(enemies={
+        f"rat{i}": {"hp": 10 ** 12, "attack": 0, "chance": 0.5} for i in range(10000)
+    }), undo_limit=20)
+
+    def step():
+        for _ in range(10):
+            engine.execute("hp")
+            engine.attack_enemies_with_spell_damage(1)
+        engine.sink.flush()
+    return step
+
+
+def bench_loot():
+    engine = engine_in(arena(chest={
+        "name": "hoard",
+        "type": "chest",
+        "locked": True,
+        "items": [{"name": f"coin{i}", "type": "item"} for i in range(50)],
+        "chances": list(range(1, 51)),
+        "number_of_items_unlocked": 3,
+    }))
+    chest = engine.template.loot.chest(0)
+
+    def step():
+        for _ in range(100):
+            chest.draw(engine.rng)
+    return step
+
+
+class MapFiles(object):
+    """
+    Scaled maps written to a temporary directory once, shared by all the
+    map loading benchmarks
+    """
+
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = {}
+
+    def path(self, copies, compiled=False):
+        key = (copies, compiled)
+        if key not in self.paths:
+            name = os.path.join(self.directory.name, f"scaled_{copies}.map")
+            if not os.path.exists(name):
+                with open(name, 'w') as f:
+                    json.dump(scaled_map(copies), f)
+            if compiled:
+                compile_map(_parse(name), name + "c")
+                name += "c"
+            self.paths[key] = name
+        return self.paths[key]
+
+    def close(self):
+        self.directory.cleanup()
+
+
+def _parse(path):
+    parsor = MapParsor(path)
+    parsor.parse()
+    return parsor.map
+
+
+def bench_parse(files, copies, compiled=False):
+    def setup():
+        path = files.path(copies, compiled)
+        return lambda: _parse(path)
+    return setup
+
+
+def bench_load(files, copies, compiled=False):
+    """
+    Loading a map and reading every location of it once, so maps that
+    load their locations lazily pay for them too
+    """
+
+    def setup():
+        path = files.path(copies, compiled)
+
+        def step():
+            template = MapTemplate(_parse(path))
+            for index in range(len(template)):
+                template[index]
+        return step
+    return setup
+
+
+def benchmarks(files, quick=False):
+    sizes = (100, 1000) if quick else (100, 1000, 10000)
+    square_size = 10
+    found = [
+        Benchmark("dispatch", bench_dispatch, 100),
+        Benchmark("look", bench_look, 100),
+        Benchmark("get_all_drop", bench_get_all_drop, 1001),
+        Benchmark("attack", bench_attack, 100),
+        Benchmark("enemy_turn", bench_enemy_turn, 10, "turns"),
+        Benchmark("horde_turn", bench_horde_turn, 10, "turns"),
+        Benchmark("horde_turn_undo", bench_horde_turn_undo, 10, "turns"),
+        Benchmark("loot", bench_loot, 100, "chests"),
+    ]
+    for copies in sizes:
+        rooms = copies * square_size
+        found.append(Benchmark(
+            f"parse_json_{rooms}", bench_parse(files, copies), rooms, "locations"
+        ))
+        found.append(Benchmark(
+            f"load_json_{rooms}", bench_load(files, copies), rooms, "locations"
+        ))
+        found.append(Benchmark(
+            f"load_compiled_{rooms}", bench_load(files, copies, True), rooms,
+            "locations",
+        ))
+    return found
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print every result next to its baseline. Returns the names of the
+    benchmarks that regressed.
+    """
+
+    regressions = []
+    print(f"{'benchmark':<28}{'ops/s':>14}{'baseline':>14}{'change':>10}")
+    for name, result in results.items():
+        rate = result["ops_per_sec"]
+        before = baseline.get(name, {}).get("ops_per_sec")
+        if before is None:
+            print(f"{name:<28}{rate:>14,.0f}{'-':>14}{'':>10}")
+            continue
+        change = rate / before - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<28}{rate:>14,.0f}{before:>14,.0f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default=RESULTS,
+                        help="where to write the results")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="the results to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="how much slower than the baseline is still fine")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds every repeat runs for at least")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip the biggest maps")
+    parser.add_argument("--only", action="append", default=[],
+                        help="run benchmarks whose name starts with this")
+    args = parser.parse_args(argv)
+
+    files = MapFiles()
+    try:
+        results = {}
+        for benchmark in benchmarks(files, args.quick):
+            if args.only and not any(benchmark.name.startswith(p) for p in args.only):
+                continue
+            rates = benchmark.run(args.repeats, args.min_time)
+            results[benchmark.name] = {
+                "ops_per_sec": max(rates),
+                "median": statistics.median(rates),
+                "unit": benchmark.unit,
+                "runs": rates,
+            }
+    finally:
+        files.close()
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("results", {})
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
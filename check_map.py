@@ -0,0 +1,40 @@
+"""
+Check a map for problems before anyone plays it: exits that lead nowhere,
+rooms that can't be reached, locks that can't be opened and recipes whose
+ingredients don't exist.
+
+Usage:
+    python3 check_map.py square.map
+"""
+
+import sys
+import argparse
+
+from adventure import load_map
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("map")
+    args = parser.parse_args(argv)
+
+    analysis = load_map(args.map).analysis
+    errors = analysis.errors()
+    warnings = analysis.warnings()
+
+    for error in errors:
+        print("Error: " + error)
+    for warning in warnings:
+        print("Warning: " + warning)
+    print(
+        f"{analysis.count} locations, "
+        f"{analysis.count - len(analysis.unreachable)} reachable, "
+        f"{len(analysis.opened_locks)} of {len(analysis.locks)} locks solvable, "
+        f"{len(analysis.recipes)} recipes."
+    )
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
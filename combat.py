@@ -0,0 +1,476 @@
+"""
+Estimate how an encounter goes by fighting it over and over.
+
+A room's enemies are fought by a player with a given weapon, who casts
+the given spells first and then attacks until everyone is dead. Millions
+of fights run side by side as NumPy arrays, one turn at a time for all of
+them, following the same rules as the game: healing over time, poison
+ticks and enemy attacks at the start of every turn, evasion and hit rolls
+on every attack and rage used up by hits only. Spells stay in effect side
+by side, as they do in the game.
+
+Usage:
+    python3 combat.py square.map --room 9 --weapon sledgehammer --cast fireball
+    python3 combat.py square.map --room 7 --weapon magic_wand --cast rage --check 10000
+"""
+
+import sys
+import json
+import random
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from adventure import (
+    GameEngine, NullSink, StopGameEngine, hit_chance, is_loot_table, load_map,
+)
+
+
+# Kinds of timed spell. Every one in effect has its turns left in an
+# array, with NOT_IN_EFFECT for fights where it isn't.
+RAGE = 1
+POISON = 2
+HEAL = 3
+NOT_IN_EFFECT = -1
+
+# Turn results
+FIGHTING = 0
+WON = 1
+DIED = 2
+
+PUNCH = {
+    "name": "punch",
+    "type": "weapon",
+    "desc": "Deals 1 damage",
+    "damage": 1,
+    "chance": 0.9,
+}
+
+
+def roll_table(chance):
+    """
+    Which of the ten rolls of will_action_happen(chance) succeed. Those
+    are always the lowest ones, as many as hit_chance() counts.
+    """
+
+    table = np.zeros(11, dtype=bool)
+    table[1:round(hit_chance(chance) * 10) + 1] = True
+    return table
+
+
+def timed_kind(spell):
+    """
+    What kind of timed spell a spell is, or None if it acts at once. Goes
+    by the same names GameEngine.use() and cast() do.
+    """
+
+    name = spell["name"]
+    if "heal" in name:
+        return HEAL if spell.get("turns") else None
+    return {"rage": RAGE, "poison": POISON}.get(name)
+
+
+def find_things(template):
+    """
+    Every weapon and spell mentioned anywhere in a map, by name
+    """
+
+    things = {"punch": PUNCH}
+
+    def visit(thing):
+        if not isinstance(thing, dict):
+            return
+        if is_loot_table(thing):
+            for entry in thing.get("items", ()):
+                visit(entry)
+        if thing.get("type") in ("weapon", "spell"):
+            things.setdefault(thing["name"], thing)
+        if thing.get("type") == "recipe":
+            visit(thing.get("result"))
+
+    for location in template.locations:
+        for thing in location.get("complex_items", ()):
+            visit(thing)
+        for enemy in location.get("enemies", {}).values():
+            visit(enemy.get("drop"))
+        for thing in (location.get("chest") or {}).get("items", ()):
+            visit(thing)
+        for table in location.get("loot_tables", {}).values():
+            visit(table)
+    return things
+
+
+class FightResults(object):
+    """
+    How every fight ended: whether the player won, how many turns it
+    took and how much hp the player had left
+    """
+
+    def __init__(self, won, died, turns, hp):
+        self.won = won
+        self.died = died
+        self.turns = turns
+        self.hp = hp
+
+    def __len__(self):
+        return len(self.won)
+
+    def summary(self, start_hp=100):
+        fights = len(self)
+        won_turns = self.turns[self.won]
+        won_hp = self.hp[self.won]
+
+        def spread(values):
+            if not len(values):
+                return None
+            return {
+                "mean": float(np.mean(values)),
+                "p10": float(np.percentile(values, 10)),
+                "p50": float(np.percentile(values, 50)),
+                "p90": float(np.percentile(values, 90)),
+                "p99": float(np.percentile(values, 99)),
+            }
+
+        counts = np.bincount(won_turns) if len(won_turns) else np.zeros(0)
+        return {
+            "fights": fights,
+            "win_rate": float(self.won.mean()) if fights else 0,
+            "death_rate": float(self.died.mean()) if fights else 0,
+            "unfinished_rate": (
+                float((~self.won & ~self.died).mean()) if fights else 0
+            ),
+            "turns_to_kill": spread(won_turns),
+            "turns_to_kill_histogram": {
+                int(turns): int(count) for turns, count in enumerate(counts) if count
+            },
+            "hp_remaining": spread(won_hp),
+            "hp_lost": spread(start_hp - np.maximum(self.hp, 0)),
+        }
+
+
+class CombatSimulator(object):
+    """
+    Fights one set of enemies with one loadout, many times at once
+    """
+
+    def __init__(self, enemies, weapon, spells=(), hp=100, targets=None,
+                 max_turns=1000):
+        names = list(enemies)
+        if targets:
+            names = [name for name in targets if name in enemies] + [
+                name for name in names if name not in targets
+            ]
+        # Enemies attack in map order, but are attacked in target order
+        self.names = list(enemies)
+        self.order = np.array([self.names.index(name) for name in names])
+        self.enemy_hp = np.array(
+            [float(enemies[name]["hp"]) for name in self.names]
+        )
+        self.attack = np.array(
+            [float(enemies[name]["attack"]) for name in self.names]
+        )
+        self.hit_tables = np.array(
+            [roll_table(enemies[name].get("chance", 1)) for name in self.names]
+        )
+        self.evade_tables = np.array(
+            [roll_table(enemies[name].get("evasion_chance", 0)) for name in self.names]
+        )
+        self.weapon = weapon
+        self.weapon_table = roll_table(weapon["chance"])
+        self.spells = list(spells)
+        # The timed spells cast, by name
+        self.timed = {}
+        for spell in self.spells:
+            kind = timed_kind(spell)
+            if kind:
+                self.timed[spell["name"]] = kind
+        self.hp = hp
+        self.max_turns = max_turns
+
+    def run(self, fights, seed=None, batch=1000000):
+        """
+        Fight the given number of fights, batch by batch to bound memory
+        """
+
+        rng = np.random.default_rng(seed)
+        parts = []
+        while fights > 0:
+            size = min(batch, fights)
+            parts.append(self.run_batch(size, rng))
+            fights -= size
+        return FightResults(*(
+            np.concatenate([part[i] for part in parts]) for i in range(4)
+        ))
+
+    def run_batch(self, n, rng):
+        """
+        Fight n fights. Finished fights are dropped from the working arrays
+        every turn, so the long ones don't make every fight pay for them.
+        """
+
+        count = len(self.names)
+        won = np.zeros(n, dtype=bool)
+        died = np.zeros(n, dtype=bool)
+        turns = np.zeros(n, dtype=np.int64)
+        hp_left = np.zeros(n)
+
+        fights = np.arange(n)
+        enemy_hp = np.tile(self.enemy_hp, (n, 1))
+        hp = np.full(n, float(self.hp))
+        # name -> (kind, turns left, strength) of every timed spell
+        effects = {
+            name: (kind, np.full(n, NOT_IN_EFFECT, dtype=np.int64), np.zeros(n))
+            for name, kind in self.timed.items()
+        }
+
+        for turn in range(self.max_turns):
+            live = len(fights)
+            if not live:
+                break
+            turns[fights] += 1
+
+            # Start of the turn: healing, poison, then every enemy still
+            # alive attacks
+            for kind, spell_turns, value in effects.values():
+                if kind != HEAL:
+                    continue
+                ticking = spell_turns > 0
+                hp[ticking] = np.minimum(100, hp[ticking] + value[ticking])
+                spell_turns[ticking] -= 1
+                spell_turns[ticking & (spell_turns == 0)] = NOT_IN_EFFECT
+            for kind, spell_turns, value in effects.values():
+                if kind != POISON:
+                    continue
+                alive = enemy_hp > 0
+                poisoned = spell_turns != NOT_IN_EFFECT
+                ticking = spell_turns > 0
+                enemy_hp -= np.where(ticking[:, None] & alive, value[:, None], 0)
+                spell_turns[ticking] -= 1
+                spell_turns[poisoned & (spell_turns == 0)] = NOT_IN_EFFECT
+
+            alive = enemy_hp > 0
+            rolls = rng.integers(1, 11, size=(live, count), dtype=np.int8)
+            hits = self.hit_tables[np.arange(count), rolls] & alive
+            hp -= (hits * self.attack).sum(axis=1)
+            dead = hp <= 0
+
+            acting = ~dead & alive.any(axis=1)
+            if turn < len(self.spells):
+                self.cast(self.spells[turn], acting, enemy_hp, hp, effects)
+            else:
+                self.strike(acting, enemy_hp, effects, rng)
+
+            cleared = ~dead & ~(enemy_hp > 0).any(axis=1)
+            done = dead | cleared
+            if done.any():
+                finished = fights[done]
+                won[finished] = cleared[done]
+                died[finished] = dead[done]
+                hp_left[finished] = hp[done]
+                keep = ~done
+                fights = fights[keep]
+                enemy_hp = enemy_hp[keep]
+                hp = hp[keep]
+                effects = {
+                    name: (kind, spell_turns[keep], value[keep])
+                    for name, (kind, spell_turns, value) in effects.items()
+                }
+
+        # Fights still going after max_turns count as neither won nor lost
+        hp_left[fights] = hp
+        return won, died, turns, hp_left
+
+    def cast(self, spell, acting, enemy_hp, hp, effects):
+        name = spell["name"]
+        alive = enemy_hp > 0
+        if name in effects:
+            _, turns, value = effects[name]
+        if self.timed.get(name) == HEAL:
+            turns[acting] = spell["turns"]
+            value[acting] = spell["heal_amount"]
+        elif "heal" in name:
+            hp[acting] = np.minimum(100, hp[acting] + spell["heal_amount"])
+        elif name == "fireball":
+            enemy_hp -= np.where(acting[:, None] & alive, spell["damage"], 0)
+        elif name == "rage":
+            turns[acting] = spell["turns"]
+            value[acting] = spell["damage_multiplier"]
+        elif name == "poison":
+            value[acting] = spell["damage"]
+            enemy_hp -= np.where(acting[:, None] & alive, spell["damage"], 0)
+            turns[acting] = spell["turns"] - 1
+
+    def strike(self, acting, enemy_hp, effects, rng):
+        """
+        Attack the first enemy still alive, in target order
+        """
+
+        rows = np.arange(len(acting))
+        alive = (enemy_hp > 0)[:, self.order]
+        target = self.order[np.argmax(alive, axis=1)]
+        evade_rolls = rng.integers(1, 11, size=len(rows), dtype=np.int8)
+        hit_rolls = rng.integers(1, 11, size=len(rows), dtype=np.int8)
+        landed = (
+            acting
+            & ~self.evade_tables[target, evade_rolls]
+            & self.weapon_table[hit_rolls]
+        )
+
+        multiplier = np.ones(len(rows))
+        for kind, turns, value in effects.values():
+            if kind != RAGE:
+                continue
+            raging = landed & (turns != NOT_IN_EFFECT)
+            boosted = raging & (turns > 0)
+            turns[boosted] -= 1
+            multiplier[boosted] += value[boosted] / 100
+            turns[raging & (turns == 0)] = NOT_IN_EFFECT
+
+        enemy_hp[rows[landed], target[landed]] -= (
+            self.weapon["damage"] * multiplier[landed]
+        )
+
+
+def engine_fights(enemies, weapon, spells=(), hp=100, targets=None,
+                  fights=1000, max_turns=1000, seed=None):
+    """
+    Fight the same fights through GameEngine itself, one command at a
+    time, to check the simulator against the real rules
+    """
+
+    rng = random.Random(seed)
+    order = [name for name in (targets or []) if name in enemies] + [
+        name for name in enemies if name not in (targets or [])
+    ]
+    arena = [{
+        "id": 0,
+        "name": "Arena",
+        "desc": "A room to fight in.",
+        "exits": {},
+        "enemies": enemies,
+    }]
+    engine = GameEngine(arena, NullSink())
+    template = engine.template
+
+    won = np.zeros(fights, dtype=bool)
+    died = np.zeros(fights, dtype=bool)
+    turn_counts = np.zeros(fights, dtype=np.int64)
+    hp_left = np.zeros(fights)
+    for fight in range(fights):
+        engine = GameEngine(template, NullSink(), rng=rng)
+        engine.start()
+        engine.player.hp = hp
+        if weapon["name"] != "punch":
+            engine.player.pick_weapon(weapon)
+        for spell in spells:
+            engine.player.pick_spell(spell)
+        plan = ["use " + spell["name"] for spell in spells]
+
+        turns = 0
+        try:
+            while engine.current_location.get("enemies") and turns < max_turns:
+                if turns < len(plan):
+                    command = plan[turns]
+                else:
+                    alive = engine.current_location["enemies"]
+                    target = next(name for name in order if name in alive)
+                    command = f"attack {target}:{weapon['name']}"
+                turns += 1
+                engine.execute(command)
+        except StopGameEngine:
+            pass
+        won[fight] = not engine.current_location.get("enemies")
+        died[fight] = engine.outcome == "died"
+        turn_counts[fight] = turns
+        hp_left[fight] = engine.player.hp
+    return FightResults(won & ~died, died, turn_counts, hp_left)
+
+
+def print_summary(title, summary):
+    print(title)
+    print(f"  fights:        {summary['fights']}")
+    print(f"  won:           {summary['win_rate']:.2%}")
+    print(f"  died:          {summary['death_rate']:.2%}")
+    if summary["unfinished_rate"]:
+        print(f"  unfinished:    {summary['unfinished_rate']:.2%}")
+    for label, key in (
+        ("turns to kill", "turns_to_kill"),
+        ("hp remaining", "hp_remaining"),
+        ("hp lost", "hp_lost"),
+    ):
+        spread = summary[key]
+        if spread:
+            print(
+                f"  {label + ':':<15}mean {spread['mean']:.2f}, "
+                f"p10 {spread['p10']:g}, p50 {spread['p50']:g}, "
+                f"p90 {spread['p90']:g}, p99 {spread['p99']:g}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("map")
+    parser.add_argument("--room", type=int, required=True,
+                        help="id of the location whose enemies to fight")
+    parser.add_argument("--weapon", default="punch")
+    parser.add_argument("--cast", action="append", default=[],
+                        help="a spell to cast before attacking, can be repeated")
+    parser.add_argument("--target", action="append", default=[],
+                        help="an enemy to attack first, can be repeated")
+    parser.add_argument("--hp", type=float, default=100)
+    parser.add_argument("--fights", type=int, default=1000000)
+    parser.add_argument("--max-turns", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--check", type=int, default=0, metavar="FIGHTS",
+                        help="also fight this many fights through the game itself")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    if np is None:
+        print("Error: combat.py needs numpy (pip install numpy)")
+        sys.exit(1)
+
+    template = load_map(args.map)
+    location = next(
+        (location for location in template.locations if location.get("id") == args.room),
+        None,
+    )
+    if location is None or not location.get("enemies"):
+        print(f"Error: Location {args.room} has no enemies")
+        sys.exit(1)
+    enemies = {
+        name: dict(enemy) for name, enemy in location["enemies"].items()
+    }
+
+    things = find_things(template)
+    try:
+        weapon = things[args.weapon]
+        spells = [things[name] for name in args.cast]
+    except KeyError as e:
+        print(f"Error: There is no weapon or spell called {e.args[0]} on this map")
+        sys.exit(1)
+
+    simulator = CombatSimulator(
+        enemies, weapon, spells, args.hp, args.target, args.max_turns
+    )
+    results = {"simulated": simulator.run(args.fights, args.seed).summary(args.hp)}
+    if args.check:
+        results["engine"] = engine_fights(
+            enemies, weapon, spells, args.hp, args.target, args.check,
+            args.max_turns, args.seed,
+        ).summary(args.hp)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print_summary("Simulated", results["simulated"])
+    if args.check:
+        print_summary("Played through the game", results["engine"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,40 @@
+"""
+Compile a .map JSON file into the binary form adventure.py loads directly.
+
+Usage:
+    python3 compile_map.py square.map square.mapc
+    python3 adventure.py square.mapc
+"""
+
+import sys
+import time
+import argparse
+
+from adventure import MapParsor, LocationMapError, compile_map
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("map")
+    parser.add_argument("output")
+    args = parser.parse_args(argv)
+
+    map_parsor = MapParsor(args.map)
+    map_parsor.parse()
+    if not map_parsor.is_valid():
+        sys.exit(1)
+
+    try:
+        start = time.perf_counter()
+        count = compile_map(map_parsor.map, args.output)
+    except LocationMapError as e:
+        print(e)
+        sys.exit(1)
+    print(
+        f"Compiled {count} locations into {args.output} "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,484 @@
+"""
+Generate big random maps for testing how the game and the tools scale.
+
+Locations are laid out as a tree: location i leads on to locations
+b*i+1 to b*i+b (b being the branching factor) and back to its parent.
+Everything in a location is worked out from the seed and its own index
+alone, so the same seed always gives the same map and locations are
+written one at a time, whatever the size of the map. The map has
+everything the game knows about: enemies and their drops, recipes and
+their ingredients, crafting tables, chests, and locked locations whose
+key is always found on the way to them. The last location holds the
+boss that drops `peace`.
+
+Usage:
+    python3 generate_map.py big.map --rooms 100000 --seed 1
+    python3 generate_map.py huge.map --rooms 5000000 --branching 4 --index
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import functools
+from array import array
+
+from adventure import MAP_INDEX_HEADER, MAP_INDEX_MAGIC
+
+
+DIRECTIONS = [
+    "north", "east", "south", "west",
+    "northeast", "southeast", "southwest", "northwest",
+    "up", "down",
+]
+OPPOSITE = {
+    "north": "south", "south": "north", "east": "west", "west": "east",
+    "northeast": "southwest", "southwest": "northeast",
+    "southeast": "northwest", "northwest": "southeast",
+    "up": "down", "down": "up",
+}
+
+ADJECTIVES = [
+    "Dusty", "Damp", "Silent", "Crooked", "Mossy", "Burnt", "Frozen",
+    "Narrow", "Echoing", "Forgotten", "Gloomy", "Sunken",
+]
+PLACES = [
+    "Cellar", "Hall", "Corridor", "Cave", "Library", "Kitchen", "Garden",
+    "Chapel", "Armory", "Vault", "Well", "Attic",
+]
+INGREDIENTS = [
+    "stick", "stone", "berry", "spinach", "wood", "iron", "oil", "cloth",
+    "gun_powder", "coffee_beans", "sugar", "rat_poison", "feather", "bone",
+    "moss", "salt", "wax", "string",
+]
+ENEMIES = ["goblin", "zombie", "piranha", "rat", "skeleton", "bat", "slime"]
+WEAPONS = ["dagger", "spear", "sword", "axe", "mace", "halberd"]
+HEALS = ["heal", "big_heal", "ultra_heal"]
+
+# Salts that keep the random numbers of different decisions about the same
+# location apart
+CONTENT, LOCK, KEY_HOLDER, HORDE = range(4)
+
+MASK = (1 << 64) - 1
+
+# How many index offsets are buffered before they're written out
+INDEX_BUFFER = 1 << 16
+
+
+def mix(*values):
+    """
+    Hash integers into 64 bits (splitmix64), quick enough to call several
+    times per location
+    """
+
+    h = 0x9E3779B97F4A7C15
+    for value in values:
+        h = (h ^ (value & MASK)) * 0xBF58476D1CE4E5B9 & MASK
+        h = (h ^ (h >> 27)) * 0x94D049BB133111EB & MASK
+        h ^= h >> 31
+    return h
+
+
+class MapGenerator(object):
+    """
+    A random map of `rooms` locations. Iterating over it builds the
+    locations in order.
+    """
+
+    def __init__(self, rooms, seed=0, branching=3, enemy_density=0.5,
+                 items=4, lock_density=0.1, chest_density=0.05,
+                 craft_density=0.1, horde_density=0, horde_size=1000):
+        if rooms < 1:
+            raise ValueError("A map needs at least one location.")
+        if not 1 <= branching <= len(DIRECTIONS) - 1:
+            raise ValueError(
+                f"Branching has to be between 1 and {len(DIRECTIONS) - 1}."
+            )
+        self.rooms = rooms
+        self.seed = seed
+        self.branching = branching
+        self.enemy_density = enemy_density
+        self.items = items
+        self.lock_density = lock_density
+        self.chest_density = chest_density
+        self.craft_density = craft_density
+        self.horde_density = horde_density
+        self.horde_size = horde_size
+        # Locations are built in order, so the parents asked about are
+        # always recent ones
+        self.incoming = functools.lru_cache(maxsize=4096)(self.incoming)
+
+    def __len__(self):
+        return self.rooms
+
+    def __iter__(self):
+        for index in range(self.rooms):
+            yield self.location(index)
+
+    def chance(self, index, salt):
+        return mix(self.seed, index, salt) / (MASK + 1)
+
+    def parent(self, index):
+        return None if index == 0 else (index - 1) // self.branching
+
+    def children(self, index):
+        first = self.branching * index + 1
+        return range(first, min(first + self.branching, self.rooms))
+
+    def depth(self, index):
+        depth = 0
+        while index:
+            index = self.parent(index)
+            depth += 1
+        return depth
+
+    def directions(self, index):
+        """
+        The directions leading to the children of a location, leaving out
+        the one leading back to its parent
+        """
+
+        if index == 0:
+            return DIRECTIONS
+        back = OPPOSITE[self.incoming(index)]
+        return [direction for direction in DIRECTIONS if direction != back]
+
+    def incoming(self, index):
+        """
+        The direction leading from the parent of a location to it
+        """
+
+        parent = self.parent(index)
+        return self.directions(parent)[index - self.branching * parent - 1]
+
+    def is_locked(self, index):
+        return index != 0 and self.chance(index, LOCK) < self.lock_density
+
+    def key_holder(self, index):
+        """
+        Where the key of a locked location is found: its parent or its
+        grandparent, either way somewhere on the way to it
+        """
+
+        parent = self.parent(index)
+        if parent == 0 or self.chance(index, KEY_HOLDER) < 0.5:
+            return parent
+        return self.parent(parent)
+
+    def keys_held(self, index):
+        held = []
+        for child in self.children(index):
+            candidates = [child]
+            candidates.extend(self.children(child))
+            for locked in candidates:
+                if self.is_locked(locked) and self.key_holder(locked) == index:
+                    held.append(locked)
+        return held
+
+    def key(self, locked):
+        parent = self.parent(locked)
+        return {
+            "name": f"key-{parent}-{locked}",
+            "type": "key",
+            "desc": f"This key opens the door from room {parent} to room {locked}",
+            "from": parent,
+            "to": locked,
+        }
+
+    def location(self, index):
+        rng = random.Random(mix(self.seed, index, CONTENT))
+        depth = self.depth(index)
+        location = {
+            "id": index,
+            "name": f"{rng.choice(ADJECTIVES)} {rng.choice(PLACES)}",
+            "desc": f"Room {index} of the maze, {depth} rooms away from the entrance.",
+            "exits": {},
+            "items": rng.choices(INGREDIENTS, k=rng.randint(0, 2 * self.items)),
+        }
+
+        directions = self.directions(index)
+        locked_exits = []
+        for position, child in enumerate(self.children(index)):
+            location["exits"][directions[position]] = child
+            if self.is_locked(child):
+                locked_exits.append(directions[position])
+        if index:
+            location["exits"][OPPOSITE[self.incoming(index)]] = self.parent(index)
+        if locked_exits:
+            location["locked_exits"] = locked_exits
+        if self.is_locked(index):
+            location["locked"] = True
+            location["required_key"] = self.key(index)["name"]
+
+        if index == 0 or rng.random() < self.craft_density:
+            location["craftable"] = True
+
+        enemies = {}
+        if index != 0 and rng.random() < self.enemy_density:
+            for number in range(rng.randint(1, 3)):
+                kind = rng.choice(ENEMIES)
+                enemies[f"{kind}{number + 1}"] = self.enemy(rng, kind, depth, location)
+        if self.has_horde(index):
+            self.horde(index, depth, enemies)
+        if index == self.rooms - 1:
+            enemies["boss"] = {
+                "hp": 100 + 10 * depth,
+                "attack": 10 + depth,
+                "chance": 0.6,
+                "evasion_chance": 0.3,
+                "type": "boss",
+                "drop": {"name": "peace", "type": "spell"},
+            }
+
+        complex_items = []
+        droppers = [
+            name for name in enemies if name != "boss"
+        ]
+        for locked in self.keys_held(index):
+            if droppers and rng.random() < 0.5:
+                enemies[droppers.pop()]["drop"] = self.key(locked)
+            else:
+                complex_items.append(self.key(locked))
+        if rng.random() < self.chest_density:
+            location["chest"] = self.chest(rng, depth)
+        if enemies:
+            location["enemy_attack_desc"] = (
+                f"{len(enemies)} enemies jump out of the shadows!"
+            )
+            location["enemies"] = enemies
+        if complex_items:
+            location["complex_items"] = complex_items
+        return location
+
+    def has_horde(self, index):
+        return 0 < index < self.rooms - 1 and self.chance(index, HORDE) < self.horde_density
+
+    def horde(self, index, depth, enemies):
+        """
+        Fill a location with a horde of weak enemies. They have their own
+        random numbers, so maps without hordes stay as they were.
+        """
+
+        rng = random.Random(mix(self.seed, index, HORDE))
+        for number in range(len(enemies), len(enemies) + self.horde_size):
+            kind = rng.choice(ENEMIES)
+            enemy = {
+                "hp": rng.randint(1, 10) + depth,
+                "attack": 1,
+                "chance": rng.randint(1, 3) / 10,
+                "type": kind,
+            }
+            if rng.random() < 0.05:
+                enemy["drop"] = {"name": rng.choice(INGREDIENTS), "type": "item"}
+            enemies[f"{kind}{number + 1}"] = enemy
+
+    def enemy(self, rng, kind, depth, location):
+        enemy = {
+            "hp": rng.randint(5, 20) + 5 * depth,
+            "attack": rng.randint(1, 3) + depth // 2,
+            "chance": rng.randint(5, 10) / 10,
+            "type": kind,
+        }
+        if rng.random() < 0.3:
+            enemy["evasion_chance"] = rng.randint(1, 4) / 10
+        roll = rng.random()
+        if roll < 0.3:
+            enemy["drop"] = self.recipe(rng, depth, location)
+        elif roll < 0.5:
+            enemy["drop"] = self.weapon(rng, depth)
+        elif roll < 0.7:
+            enemy["drop"] = self.spell(rng, depth)
+        elif roll < 0.9:
+            enemy["drop"] = {"name": rng.choice(INGREDIENTS), "type": "item"}
+        return enemy
+
+    def weapon(self, rng, depth):
+        damage = rng.randint(5, 20) + 5 * depth
+        return {
+            "name": rng.choice(WEAPONS),
+            "type": "weapon",
+            "desc": f"Deals {damage} damage",
+            "damage": damage,
+            "chance": rng.randint(6, 10) / 10,
+        }
+
+    def spell(self, rng, depth):
+        kind = rng.choice(["heal", "fireball", "poison", "rage"])
+        if kind == "heal":
+            amount = rng.choice([10, 20, 40])
+            return {
+                "name": HEALS[[10, 20, 40].index(amount)],
+                "type": "spell",
+                "desc": f"Heals {amount} hp",
+                "heal_amount": amount,
+            }
+        if kind == "fireball":
+            damage = 10 + 2 * depth
+            return {
+                "name": "fireball",
+                "type": "spell",
+                "desc": f"Deals {damage} damage to all enemies",
+                "damage": damage,
+            }
+        if kind == "poison":
+            return {
+                "name": "poison",
+                "type": "spell",
+                "desc": "Deals 5 hp per turn for 3 turns",
+                "turns": 3,
+                "damage": 5,
+            }
+        return {
+            "name": "rage",
+            "type": "spell",
+            "desc": "Increases damage by 50% for 3 turns",
+            "turns": 3,
+            "damage_multiplier": 50,
+        }
+
+    def recipe(self, rng, depth, location):
+        """
+        A recipe whose ingredients are all lying in the location it's
+        found in
+        """
+
+        result = self.weapon(rng, depth) if rng.random() < 0.5 else self.spell(rng, depth)
+        ingredients = rng.sample(INGREDIENTS, rng.randint(2, 3))
+        location["items"].extend(ingredients)
+        return {
+            "name": f"{result['name']}_recipe",
+            "type": "recipe",
+            "result": result,
+            "ingredients": ingredients,
+        }
+
+    def chest(self, rng, depth):
+        items = [
+            self.weapon(rng, depth) if rng.random() < 0.5 else self.spell(rng, depth)
+            for _ in range(rng.randint(2, 4))
+        ]
+        weights = [rng.randint(1, 10) for _ in items]
+        return {
+            "name": "Chest",
+            "type": "chest",
+            "locked": True,
+            "items": items,
+            "chances": [round(weight / sum(weights), 2) for weight in weights],
+            "number_of_items_unlocked": 1,
+        }
+
+    def write(self, f, index=None):
+        """
+        Write the map as JSON to a binary file. With an index file the
+        byte range of every location is saved there too, in the format
+        adventure.py keeps next to lazily loaded maps, so it never has to
+        scan the map. Returns whether the map has enemies.
+        """
+
+        has_enemies = False
+        starts = array("Q")
+        ends = tempfile.TemporaryFile() if index else None
+        ends_buffer = array("Q")
+        if index:
+            index.write(MAP_INDEX_MAGIC)
+            index.write(bytes(MAP_INDEX_HEADER.size))
+
+        f.write(b"[\n")
+        position = 2
+        for number, location in enumerate(self):
+            if number:
+                f.write(b",\n")
+                position += 2
+            data = json.dumps(location).encode("utf-8")
+            f.write(data)
+            has_enemies = has_enemies or "enemies" in location
+            if index:
+                starts.append(position)
+                ends_buffer.append(position + len(data))
+                if len(starts) >= INDEX_BUFFER:
+                    starts.tofile(index)
+                    ends_buffer.tofile(ends)
+                    starts = array("Q")
+                    ends_buffer = array("Q")
+            position += len(data)
+        f.write(b"\n]\n")
+
+        if index:
+            starts.tofile(index)
+            ends_buffer.tofile(ends)
+            ends.seek(0)
+            while True:
+                chunk = ends.read(1 << 20)
+                if not chunk:
+                    break
+                index.write(chunk)
+            ends.close()
+        return has_enemies
+
+
+def write_index_header(index, map_name, rooms, has_enemies):
+    """
+    Fill in the header of an index once the map it belongs to is closed,
+    since the header records the map's size and modification time
+    """
+
+    stat = os.stat(map_name)
+    index.seek(len(MAP_INDEX_MAGIC))
+    index.write(MAP_INDEX_HEADER.pack(
+        stat.st_size, stat.st_mtime_ns, rooms, has_enemies
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output", help="the map file to write")
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--branching", type=int, default=3,
+                        help="how many locations every location leads on to")
+    parser.add_argument("--enemies", type=float, default=0.5,
+                        help="the share of locations with enemies")
+    parser.add_argument("--items", type=int, default=4,
+                        help="how many items a location has on average")
+    parser.add_argument("--locks", type=float, default=0.1,
+                        help="the share of locations that are locked")
+    parser.add_argument("--chests", type=float, default=0.05,
+                        help="the share of locations with a chest")
+    parser.add_argument("--craft", type=float, default=0.1,
+                        help="the share of locations with a crafting table")
+    parser.add_argument("--hordes", type=float, default=0,
+                        help="the share of locations overrun by a horde of enemies")
+    parser.add_argument("--horde-size", type=int, default=1000,
+                        help="how many enemies a horde has")
+    parser.add_argument("--index", action="store_true",
+                        help="also write <output>.idx so the map loads lazily")
+    args = parser.parse_args(argv)
+
+    try:
+        generator = MapGenerator(
+            args.rooms, args.seed, args.branching, args.enemies, args.items,
+            args.locks, args.chests, args.craft, args.hordes, args.horde_size,
+        )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    index_name = args.output + ".idx"
+    if not args.index and os.path.exists(index_name):
+        os.remove(index_name)
+    index = open(index_name, 'w+b') if args.index else None
+    try:
+        with open(args.output, 'wb') as f:
+            has_enemies = generator.write(f, index)
+        if index:
+            write_index_header(index, args.output, args.rooms, has_enemies)
+    finally:
+        if index:
+            index.close()
+    print(f"Wrote {args.rooms} locations to {args.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,851 @@
+"""
+Host the game for many players from one process.
+
+Every TCP connection plays its own session on top of one shared map
+template. Commands are read one line at a time and the response, followed
+by the next prompt, is written back.
+
+With --metrics-port the time every command takes is measured and served
+over HTTP, at /metrics for Prometheus and at /metrics.json as JSON. With
+--journal-dir every session logs its changes to its own journal there.
+Players can only `save` and `load` with --save-dir, and then only files
+right in that directory.
+
+With --shared every player plays in one SharedWorld instead. The server
+is one process with one event loop, and a command runs to the end
+without waiting on anything, so commands never interleave and the world
+needs no locks. That also means commands don't run in parallel, in
+different rooms or not: the server plays on one core. With --world the
+shared world is kept in a file between runs.
+
+With --tick the game runs in real time: enemies attack and spells wear on
+once every --tick seconds, for every room with a player in it, instead of
+before every command. The metrics then say how long ticks take and how
+many rooms they go through, and how often they ran late.
+
+In a shared world, what happens in a room (attacks, kills, loot, players
+coming and going) is published to whoever is subscribed to it. Players
+hear what the others in their room do, and with --spectate-port anyone
+can connect, send the id or name of a location and watch it as JSON lines.
+A client that can't keep up has what it missed summed up in one line, or
+with --slow-clients drop is disconnected.
+
+Usage:
+    python3 server.py square.map --port 8515
+    nc localhost 8515
+    python3 server.py square.map --metrics-port 9515
+    curl localhost:9515/metrics
+    python3 server.py square.map --shared --world square.world
+    python3 server.py square.map --shared --tick 2 --metrics-port 9515
+    python3 server.py square.map --shared --spectate-port 8516
+    echo 3 | nc localhost 8516
+"""
+
+import os
+import sys
+import json
+import time
+import itertools
+import asyncio
+import argparse
+import contextlib
+
+from adventure import (
+    COMMANDS, GameEngine, Instrumentation, Journal, SaveGameError, SharedWorld,
+    TextSink, default_commands, enemies_count, load_map,
+)
+
+
+# The kinds of messages that others in the room would notice
+ROOM_KINDS = frozenset([
+    "move", "travel", "pick_up", "drop", "craft", "unlock", "chest", "loot",
+    "attack", "evade", "miss", "kill", "damage", "spell", "enemy_attack",
+    "enemy_miss", "hp_lost", "game_over",
+])
+
+# The kinds of messages said once the player has left the room they're about
+MOVE_KINDS = frozenset(["move", "travel"])
+
+
+def room_text(player, kind, fields):
+    """
+    What the others in a room hear of a message to a player: the same
+    thing told about the player, from the message's fields. None for what
+    they wouldn't notice.
+    """
+
+    if kind == "arrive":
+        return f"{player} arrives."
+    if kind == "move":
+        return f"{player} goes {fields['direction']}."
+    if kind == "travel":
+        if not fields.get("directions"):
+            return None
+        return f"{player} leaves, heading {fields['directions'][0]}."
+    if kind in ("pick_up", "drop", "craft"):
+        verb = {"pick_up": "picks up", "drop": "drops", "craft": "crafts"}[kind]
+        return f"{player} {verb} the {fields['item']}."
+    if kind == "unlock":
+        return f"{player} unlocks the {fields['direction']} with the key: {fields['key']}"
+    if kind == "chest":
+        if "name" not in fields:
+            return f"{player} finds the chest empty."
+        return f"{player} opens the {fields['name']}."
+    if kind == "loot":
+        if "items" not in fields:
+            return None
+        if not fields["items"]:
+            return f"{player} finds nothing."
+        return f"{player} finds {', '.join(fields['items'])}."
+    if kind == "attack":
+        return f"{player} attacks the {fields['enemy']} with the {fields['weapon']}."
+    if kind == "evade":
+        return f"The {fields['enemy']} evaded {player}'s attack!"
+    if kind == "miss":
+        return f"{player} missed hitting the {fields['enemy']}!"
+    if kind == "kill":
+        if "enemy" in fields:
+            return f"{player} killed the {fields['enemy']}!"
+        return f"{player} killed {enemies_count(fields['enemies'])}!"
+    if kind == "damage":
+        if "enemy" in fields:
+            return f"The {fields['enemy']} has {fields['hp']} hp left."
+        return f"{enemies_count(fields['enemies'])} still standing."
+    if kind == "spell":
+        spell = fields.get("spell")
+        effect = fields.get("effect")
+        if spell is None:
+            return None
+        if effect is None:
+            return f"{player} casts a {spell} spell!"
+        if effect == "worn_out":
+            return f"{player}'s {spell} spell wore out."
+        if effect == "cleared":
+            return f"{player}'s {spell} cleared the room!"
+        if spell == "poison":
+            return f"Enemies are affected by {player}'s poison!"
+        return None
+    if kind == "enemy_attack":
+        if "enemy" in fields:
+            return f"{fields['enemy']} attacked {player}!"
+        return f"{fields['hits']} of {enemies_count(fields['enemies'])} attacked {player}!"
+    if kind == "enemy_miss":
+        if "enemy" in fields:
+            return f"{fields['enemy']} missed {player}!"
+        if fields["enemies"] == 1:
+            return f"{enemies_count(1)} missed {player}!"
+        return f"All {fields['enemies']} enemies missed {player}!"
+    if kind == "hp_lost":
+        if not fields["hp_lost"]:
+            return None
+        return f"{player} lost {fields['hp_lost']} hp."
+    if kind == "game_over":
+        if fields.get("outcome") == "won":
+            return f"{player} won the game!"
+        if fields.get("outcome") == "died":
+            return f"{player} died!"
+        return f"{player} left the game."
+    return None
+
+
+class RoomSink(TextSink):
+    """
+    A TextSink that also hands the messages others in the room would
+    notice to `publish`
+    """
+
+    def __init__(self, publish=None):
+        super().__init__()
+        self.publish = publish
+
+    def message(self, kind, text, fields):
+        self.lines.append(text)
+        if self.publish is not None and kind in ROOM_KINDS:
+            self.publish(kind, text, fields)
+
+
+class GameSession(object):
+    """
+    Command/response wrapper around one GameEngine
+    """
+
+    def __init__(self, template, instrumentation=None, journal=None, world=None,
+                 realtime=False, hub=None, name="player", commands=None,
+                 save_dir="."):
+        self.engine = GameEngine(
+            template, RoomSink(), instrumentation=instrumentation,
+            journal=journal, world=world, realtime=realtime, commands=commands,
+            save_dir=save_dir,
+        )
+        self.running = True
+        # In real time, where what happens between commands is written
+        self.writer = None
+        self.name = name
+        # Where the others in the player's room hear about it, in a shared
+        # world
+        self.hub = hub
+        # Hears what the others in the player's room do, in a shared world
+        self.subscriber = None
+        # The room the command being run started in
+        self.origin = None
+        if hub is not None:
+            self.engine.sink.publish = self.publish
+
+    def publish(self, kind, text, fields):
+        """
+        Tell the others in the room about a message to the player. Moves
+        are told to the room the player left.
+        """
+
+        text = room_text(self.name, kind, fields)
+        if text is None:
+            return
+        engine = self.engine
+        index = engine.current_index
+        if kind in MOVE_KINDS and self.origin is not None:
+            index = self.origin
+        self.hub.publish(
+            index, engine.template[index].get("id"), self.name, kind, text,
+            fields, self,
+        )
+
+    def start(self):
+        """
+        Start the session, returning the opening text and first prompt
+        """
+
+        self.engine.start()
+        if self.hub is not None and self.engine.current_index is not None:
+            self.publish("arrive", None, {})
+        return self.engine.sink.flush() + self.engine.prompt()
+
+    def send(self, command):
+        """
+        Run a command, returning its output followed by the next prompt
+        """
+
+        if not self.running:
+            return ""
+        self.origin = self.engine.current_index
+        self.running = self.engine.execute(command)
+        if self.hub is not None and self.engine.current_index not in (
+            self.origin, None
+        ):
+            self.publish("arrive", None, {})
+        self.origin = None
+        text = self.engine.sink.flush()
+        if self.running:
+            text += self.engine.prompt()
+        return text
+
+    def busy(self):
+        """
+        Whether a tick has anything to do for the session: enemies to
+        attack it or spells to wear on
+        """
+
+        engine = self.engine
+        return self.running and bool(
+            engine.effects or engine.current_location.get("enemies")
+        )
+
+    def tick(self):
+        """
+        Let a tick pass in real time, writing what happened to the player
+        """
+
+        self.running = self.engine.tick()
+        text = self.engine.sink.flush()
+        if not text or self.writer is None:
+            return
+        if self.running:
+            self.writer.write(("\n" + text + self.engine.prompt()).encode())
+        else:
+            self.writer.write(("\n" + text).encode())
+            # The connection's reader sees the end of it and cleans up
+            self.writer.close()
+
+
+class TickScheduler(object):
+    """
+    Real-time mode: a clock ticking every `interval` seconds. On every
+    tick the sessions are grouped by the room they're in, and each room
+    with enemies or spells in effect gets one batch of work. A tick runs
+    to the end between two commands, like a command does. A tick that
+    ends after the next was due is an overrun, and the ticks it ran into
+    are skipped rather than piled up.
+    """
+
+    def __init__(self, server, interval):
+        self.server = server
+        self.interval = interval
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        # Rooms worked through, over every tick and on the last one
+        self.rooms = 0
+        self.last_rooms = 0
+        self.busy_seconds = 0.0
+        self.last_seconds = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        due = loop.time() + self.interval
+        while True:
+            await asyncio.sleep(max(0, due - loop.time()))
+            started = time.perf_counter()
+            self.tick()
+            self.last_seconds = time.perf_counter() - started
+            self.busy_seconds += self.last_seconds
+            self.ticks += 1
+            due += self.interval
+            late = loop.time() - due
+            if late > 0:
+                self.overruns += 1
+                missed = int(late // self.interval) + 1
+                self.skipped += missed
+                due += missed * self.interval
+
+    def tick(self):
+        rooms = {}
+        for session in self.server.sessions:
+            if session.busy():
+                engine = session.engine
+                rooms.setdefault(
+                    (engine.location_map, engine.current_index), []
+                ).append(session)
+        self.last_rooms = len(rooms)
+        self.rooms += len(rooms)
+        for sessions in rooms.values():
+            tick_room(sessions)
+
+    def metrics(self):
+        return {
+            "ticks": self.ticks,
+            "tick_overruns": self.overruns,
+            "ticks_skipped": self.skipped,
+            "tick_rooms": self.rooms,
+            "last_tick_rooms": self.last_rooms,
+            "tick_seconds": self.busy_seconds,
+            "last_tick_seconds": self.last_seconds,
+        }
+
+    def prometheus(self):
+        return (
+            "# HELP adventure_ticks_total Real-time ticks run.\n"
+            "# TYPE adventure_ticks_total counter\n"
+            f"adventure_ticks_total {self.ticks}\n"
+            "# HELP adventure_tick_overruns_total Ticks that ended after the next one was due.\n"
+            "# TYPE adventure_tick_overruns_total counter\n"
+            f"adventure_tick_overruns_total {self.overruns}\n"
+            "# HELP adventure_ticks_skipped_total Ticks skipped because one ran late.\n"
+            "# TYPE adventure_ticks_skipped_total counter\n"
+            f"adventure_ticks_skipped_total {self.skipped}\n"
+            "# HELP adventure_tick_rooms_total Rooms worked through, over every tick.\n"
+            "# TYPE adventure_tick_rooms_total counter\n"
+            f"adventure_tick_rooms_total {self.rooms}\n"
+            "# HELP adventure_tick_rooms Rooms worked through on the last tick.\n"
+            "# TYPE adventure_tick_rooms gauge\n"
+            f"adventure_tick_rooms {self.last_rooms}\n"
+            "# HELP adventure_tick_seconds_total Time spent in ticks.\n"
+            "# TYPE adventure_tick_seconds_total counter\n"
+            f"adventure_tick_seconds_total {self.busy_seconds}\n"
+            "# HELP adventure_tick_seconds How long the last tick took.\n"
+            "# TYPE adventure_tick_seconds gauge\n"
+            f"adventure_tick_seconds {self.last_seconds}\n"
+        )
+
+
+def tick_room(sessions):
+    for session in sessions:
+        if session.running:
+            session.tick()
+
+
+class RoomEvent(object):
+    """
+    Something that happened in a room, with its text told about the
+    player. It's encoded at most once per format, however many subscribers
+    it goes to: "text" for players and "json" for spectators.
+    """
+
+    __slots__ = ("location", "player", "kind", "text", "fields", "encoded")
+
+    def __init__(self, location, player, kind, text, fields):
+        self.location = location
+        self.player = player
+        self.kind = kind
+        self.text = text
+        self.fields = fields
+        self.encoded = {}
+
+    def encode(self, format):
+        data = self.encoded.get(format)
+        if data is None:
+            if format == "json":
+                line = json.dumps(dict(
+                    location=self.location, player=self.player, kind=self.kind,
+                    text=self.text, fields=self.fields,
+                ), default=str)
+            else:
+                line = self.text
+            data = self.encoded[format] = (line + "\n").encode()
+        return data
+
+
+def skipped_notice(format, skipped):
+    if format == "json":
+        return (json.dumps({"skipped": skipped}) + "\n").encode()
+    return f"[{skipped} things happened here while you weren't keeping up]\n".encode()
+
+
+class Subscriber(object):
+    """
+    A client of a RoomHub, subscribed to one room at a time. Events are
+    queued and written to its connection in one go once the event loop
+    gets round to it. What's queued plus what the connection hasn't sent
+    yet is bounded by `limit` bytes. A client over that is too slow: with
+    `coalesce` its events are counted instead and the count is sent once
+    it catches up, otherwise it's disconnected.
+    """
+
+    def __init__(self, writer, format="text", limit=65536, coalesce=True,
+                 session=None):
+        self.transport = writer.transport
+        self.format = format
+        self.limit = limit
+        self.coalesce = coalesce
+        # Whose own events aren't sent back to it
+        self.session = session
+        self.room = None
+        self.skipped = 0
+        self.queue = []
+        self.queued = 0
+
+    def deliver(self, event):
+        """
+        Queue an event, returning "sent", "skipped" or "dropped"
+        """
+
+        transport = self.transport
+        if transport.is_closing():
+            return "dropped"
+        if self.queued + transport.get_write_buffer_size() > self.limit:
+            if not self.coalesce:
+                transport.abort()
+                return "dropped"
+            self.skipped += 1
+            return "skipped"
+        if not self.queue:
+            asyncio.get_running_loop().call_soon(self.flush)
+        if self.skipped:
+            self.queue.append(skipped_notice(self.format, self.skipped))
+            self.skipped = 0
+        data = event.encode(self.format)
+        self.queue.append(data)
+        self.queued += len(data)
+        return "sent"
+
+    def flush(self):
+        if not self.transport.is_closing():
+            self.transport.write(b"".join(self.queue))
+        self.queue.clear()
+        self.queued = 0
+
+
+class RoomHub(object):
+    """
+    Publish/subscribe by location index. Publishing to a room nobody
+    watches is a dictionary lookup; otherwise the event is encoded once
+    and written to every subscriber of the room but the one it came from.
+    """
+
+    def __init__(self, limit=65536, coalesce=True):
+        self.limit = limit
+        self.coalesce = coalesce
+        # location index -> set of Subscribers
+        self.rooms = {}
+        self.subscribers = 0
+        self.published = 0
+        self.delivered = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def subscriber(self, writer, format="text", session=None):
+        return Subscriber(writer, format, self.limit, self.coalesce, session)
+
+    def subscribe(self, subscriber, index):
+        """
+        Move a subscriber to the room at a location index
+        """
+
+        if subscriber.room == index:
+            return
+        self.unsubscribe(subscriber)
+        self.rooms.setdefault(index, set()).add(subscriber)
+        subscriber.room = index
+        self.subscribers += 1
+
+    def unsubscribe(self, subscriber):
+        room = self.rooms.get(subscriber.room)
+        if room is None or subscriber not in room:
+            return
+        room.discard(subscriber)
+        if not room:
+            del self.rooms[subscriber.room]
+        subscriber.room = None
+        self.subscribers -= 1
+
+    def publish(self, index, location, player, kind, text, fields, session=None):
+        subscribers = self.rooms.get(index)
+        if not subscribers:
+            return
+        self.published += 1
+        event = RoomEvent(location, player, kind, text, fields)
+        dropped = None
+        for subscriber in subscribers:
+            if subscriber.session is session and session is not None:
+                continue
+            result = subscriber.deliver(event)
+            if result == "sent":
+                self.delivered += 1
+            elif result == "skipped":
+                self.skipped += 1
+            else:
+                dropped = dropped or []
+                dropped.append(subscriber)
+        if dropped:
+            self.dropped += len(dropped)
+            for subscriber in dropped:
+                self.unsubscribe(subscriber)
+
+    def metrics(self):
+        return {
+            "room_subscribers": self.subscribers,
+            "room_events": self.published,
+            "room_events_delivered": self.delivered,
+            "room_events_skipped": self.skipped,
+            "room_subscribers_dropped": self.dropped,
+        }
+
+    def prometheus(self):
+        return (
+            "# HELP adventure_room_subscribers Clients subscribed to a room.\n"
+            "# TYPE adventure_room_subscribers gauge\n"
+            f"adventure_room_subscribers {self.subscribers}\n"
+            "# HELP adventure_room_events_total Events published to rooms with subscribers.\n"
+            "# TYPE adventure_room_events_total counter\n"
+            f"adventure_room_events_total {self.published}\n"
+            "# HELP adventure_room_events_delivered_total Events written to subscribers.\n"
+            "# TYPE adventure_room_events_delivered_total counter\n"
+            f"adventure_room_events_delivered_total {self.delivered}\n"
+            "# HELP adventure_room_events_skipped_total Events slow subscribers missed.\n"
+            "# TYPE adventure_room_events_skipped_total counter\n"
+            f"adventure_room_events_skipped_total {self.skipped}\n"
+            "# HELP adventure_room_subscribers_dropped_total Subscribers dropped as they were gone or too slow.\n"
+            "# TYPE adventure_room_subscribers_dropped_total counter\n"
+            f"adventure_room_subscribers_dropped_total {self.dropped}\n"
+        )
+
+
+class GameServer(object):
+    def __init__(self, template, instrumentation=None, journal_dir=None,
+                 compact_every=1000, world=None, world_file=None,
+                 save_every=60, tick=None, hub=None, save_dir=None):
+        self.template = template
+        self.instrumentation = instrumentation
+        self.journal_dir = journal_dir
+        self.compact_every = compact_every
+        self.session_numbers = itertools.count(1)
+        self.sessions = set()
+        self.world = world
+        self.world_file = world_file
+        self.save_every = save_every
+        self.ticker = TickScheduler(self, tick) if tick else None
+        # Only players of the shared world hear about each other's rooms
+        self.hub = hub or RoomHub()
+        self.player_numbers = itertools.count(1)
+        # Players only get `save` and `load` with a directory for them
+        self.save_dir = save_dir
+        self.commands = (
+            COMMANDS if save_dir is not None
+            else default_commands(without=("save", "load"))
+        )
+
+    def new_journal(self):
+        if self.journal_dir is None:
+            return None
+        return Journal(
+            os.path.join(self.journal_dir, f"session-{next(self.session_numbers)}.log"),
+            self.template,
+            self.compact_every,
+        )
+
+    async def handle(self, reader, writer):
+        journal = self.new_journal()
+        session = GameSession(
+            self.template, self.instrumentation, journal, self.world,
+            self.ticker is not None, self.hub if self.world is not None else None,
+            f"player {next(self.player_numbers)}", self.commands, self.save_dir,
+        )
+        session.writer = writer
+        if self.world is not None:
+            session.subscriber = self.hub.subscriber(writer, session=session)
+        self.sessions.add(session)
+        try:
+            writer.write(session.start().encode())
+            self.follow(session)
+            while session.running:
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors="replace").rstrip("\r\n")
+                writer.write(session.send(command).encode())
+                self.follow(session)
+            await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            session.running = False
+            session.writer = None
+            if session.subscriber is not None:
+                self.hub.unsubscribe(session.subscriber)
+            if journal is not None:
+                journal.close()
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    def follow(self, session):
+        """
+        Subscribe a player to the room they're in, once they've left the
+        one they were subscribed to
+        """
+
+        if session.subscriber is not None and session.running:
+            self.hub.subscribe(session.subscriber, session.engine.current_index)
+
+    def find_location(self, place):
+        """
+        The index of a location by id or name, like travel finds them
+        """
+
+        analysis = self.template.analysis
+        if place.isdigit():
+            return analysis.id_index.get(int(place))
+        return analysis.name_index.get(place.lower())
+
+    async def handle_spectator(self, reader, writer):
+        """
+        Let a spectator watch rooms. Every line names the room to watch
+        from then on, and is answered with a JSON line before the room's
+        events follow.
+        """
+
+        subscriber = self.hub.subscriber(writer, "json")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                place = line.decode(errors="replace").strip()
+                if not place:
+                    continue
+                index = self.find_location(place)
+                if index is None:
+                    reply = {"error": f"There's no place called {place}."}
+                else:
+                    self.hub.subscribe(subscriber, index)
+                    location = self.template[index]
+                    reply = {"watching": location.get("id"), "name": location.get("name")}
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.hub.unsubscribe(subscriber)
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    def save_world(self):
+        if self.world_file is None:
+            return
+        try:
+            self.world.write(self.world_file)
+        except OSError as e:
+            print(f"Could not save the world: {e.strerror}")
+
+    async def keep_saving_world(self):
+        while True:
+            await asyncio.sleep(self.save_every)
+            self.save_world()
+
+    def metrics(self):
+        """
+        The command latencies, the number of connected players, how room
+        events are delivered and in real time how the ticks are keeping
+        up, in the Prometheus text format
+        """
+
+        text = self.instrumentation.prometheus() + (
+            "# HELP adventure_sessions Players connected right now.\n"
+            "# TYPE adventure_sessions gauge\n"
+            f"adventure_sessions {len(self.sessions)}\n"
+        ) + self.hub.prometheus()
+        if self.ticker is not None:
+            text += self.ticker.prometheus()
+        return text
+
+    async def handle_metrics(self, reader, writer):
+        """
+        Answer one HTTP request for the metrics
+        """
+
+        try:
+            request = (await reader.readline()).decode(errors="replace").split()
+            while (await reader.readline()).strip():
+                pass
+            path = request[1] if len(request) > 1 else ""
+            if path == "/metrics":
+                status = "200 OK"
+                content_type = "text/plain; version=0.0.4"
+                body = self.metrics()
+            elif path == "/metrics.json":
+                status = "200 OK"
+                content_type = "application/json"
+                data = dict(
+                    self.instrumentation.as_dict(), sessions=len(self.sessions)
+                )
+                data.update(self.hub.metrics())
+                if self.ticker is not None:
+                    data.update(self.ticker.metrics())
+                body = json.dumps(data)
+            else:
+                status = "404 Not Found"
+                content_type = "text/plain"
+                body = "Not found\n"
+            body = body.encode()
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def serve(self, host, port, metrics_port=None, spectate_port=None):
+        server = await asyncio.start_server(
+            self.handle, host, port, backlog=1024
+        )
+        for sock in server.sockets:
+            print("Serving on %s:%s" % sock.getsockname()[:2])
+        async with contextlib.AsyncExitStack() as servers:
+            await servers.enter_async_context(server)
+            if metrics_port is not None:
+                metrics = await asyncio.start_server(
+                    self.handle_metrics, host, metrics_port
+                )
+                for sock in metrics.sockets:
+                    print("Serving metrics on %s:%s" % sock.getsockname()[:2])
+                await servers.enter_async_context(metrics)
+            if spectate_port is not None:
+                spectate = await asyncio.start_server(
+                    self.handle_spectator, host, spectate_port, backlog=1024
+                )
+                for sock in spectate.sockets:
+                    print("Serving spectators on %s:%s" % sock.getsockname()[:2])
+                await servers.enter_async_context(spectate)
+            if self.world_file is not None:
+                saver = asyncio.get_running_loop().create_task(self.keep_saving_world())
+                servers.callback(saver.cancel)
+                servers.callback(self.save_world)
+            if self.ticker is not None:
+                ticker = asyncio.get_running_loop().create_task(self.ticker.run())
+                servers.callback(ticker.cancel)
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("map")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8515)
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="measure every command and serve the numbers here")
+    parser.add_argument("--profile-slow", type=float, metavar="SECONDS",
+                        help="profile commands slower than this, see --profile-dir")
+    parser.add_argument("--profile-dir", default="profiles",
+                        help="where profiles of slow commands are saved")
+    parser.add_argument("--journal-dir",
+                        help="log every session's changes to a journal in here")
+    parser.add_argument("--compact-every", type=int, default=1000, metavar="EVENTS",
+                        help="fold journals into a snapshot this often")
+    parser.add_argument("--save-dir",
+                        help="let players save and load games, kept in here")
+    parser.add_argument("--shared", action="store_true",
+                        help="put every player in one world")
+    parser.add_argument("--world",
+                        help="keep the shared world in this file between runs")
+    parser.add_argument("--save-every", type=float, default=60, metavar="SECONDS",
+                        help="how often the shared world is saved to --world")
+    parser.add_argument("--tick", type=float, metavar="SECONDS",
+                        help="play in real time, enemies attacking this often")
+    parser.add_argument("--spectate-port", type=int, default=None,
+                        help="let spectators watch rooms from here")
+    parser.add_argument("--client-buffer", type=int, default=65536, metavar="BYTES",
+                        help="how much unread room events a client may fall behind")
+    parser.add_argument("--slow-clients", choices=["coalesce", "drop"],
+                        default="coalesce",
+                        help="sum up what slow clients miss, or disconnect them")
+    args = parser.parse_args(argv)
+    if args.tick is not None and args.tick <= 0:
+        parser.error("--tick has to be more than 0 seconds")
+    if args.world and not args.shared:
+        parser.error("--world needs --shared")
+    if args.journal_dir and args.shared:
+        parser.error("--journal-dir can't be used with --shared")
+    if args.spectate_port is not None and not args.shared:
+        parser.error("--spectate-port needs --shared")
+
+    instrumentation = None
+    if args.metrics_port is not None or args.profile_slow is not None:
+        instrumentation = Instrumentation(args.profile_slow, args.profile_dir)
+    if args.journal_dir:
+        os.makedirs(args.journal_dir, exist_ok=True)
+    if args.save_dir:
+        os.makedirs(args.save_dir, exist_ok=True)
+    template = load_map(args.map)
+    world = None
+    if args.shared:
+        world = SharedWorld(template)
+        if args.world and os.path.exists(args.world):
+            try:
+                world.read(args.world)
+            except SaveGameError as e:
+                print(e)
+                sys.exit(1)
+    server = GameServer(
+        template, instrumentation, args.journal_dir, args.compact_every,
+        world, args.world, args.save_every, args.tick,
+        RoomHub(args.client_buffer, args.slow_clients == "coalesce"),
+        args.save_dir,
+    )
+    try:
+        asyncio.run(server.serve(
+            args.host, args.port, args.metrics_port, args.spectate_port
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,167 @@
+"""
+Replay scripted sessions against a map without a terminal.
+
+Each script is a text file with one command per line, the same thing you
+would pipe into adventure.py. Shell scripts with a heredoc (like
+ideal_run.sh) work too, only the heredoc body is used.
+
+Every session gets its own seed (--seed plus the session's number), so
+a batch plays out the same way every time, however the sessions are
+spread over the worker processes. With --record every session's random
+draws are also saved, to replay one with `adventure.py --replay`.
+
+Usage:
+    python3 simulate.py square.map ideal_run.sh --repeat 1000
+    python3 simulate.py square.map ideal_run.sh --seed 7 --record runs/
+"""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from collections import Counter
+
+from adventure import (
+    GameEngine, GameEngineError, NullSink, RecordingRandom, load_map,
+)
+
+
+_worker_map = None
+
+
+def read_script(path):
+    """
+    Read the commands of a script file
+    """
+
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+
+    heredoc = next((i for i, line in enumerate(lines) if "<<" in line), None)
+    if heredoc is None:
+        return lines
+
+    marker = lines[heredoc].split("<<", 1)[1].strip().strip("'\"")
+    body = []
+    for line in lines[heredoc + 1:]:
+        if line.strip() == marker:
+            break
+        body.append(line)
+    return body
+
+
+def run_script(template, commands, seed=None, record=None):
+    """
+    Play one session on top of a shared map template. With a record path
+    every random draw is written there.
+    """
+
+    if record is None:
+        return GameEngine(template, NullSink(), seed=seed).run(commands)
+    with open(record, 'wb') as f:
+        rng = RecordingRandom(seed, f)
+        return GameEngine(template, NullSink(), rng=rng).run(commands)
+
+
+def _init_worker(map_name):
+    global _worker_map
+    _worker_map = load_map(map_name)
+
+
+def _run_job(job):
+    index, commands, seed, record = job
+    # A map the game refuses is one failed session, not a failed batch
+    try:
+        result = run_script(_worker_map, commands, seed, record).as_dict()
+    except GameEngineError as e:
+        result = {"outcome": "error", "error": str(e)}
+    result["seed"] = seed
+    return index, result
+
+
+def run_batch(map_name, scripts, processes=None, chunksize=16, seed=None,
+              record_dir=None):
+    """
+    Replay the scripts across a pool of worker processes. Every worker
+    parses the map once and shares it between all the sessions it plays.
+    Session i is seeded with seed + i when a seed is given, and records
+    its draws to record_dir/i.rng when a directory is given. Yields
+    (script index, result dict) pairs as they complete. A session the
+    game refused to play has outcome "error" and the reason in "error".
+    """
+
+    jobs = (
+        (
+            index,
+            commands,
+            None if seed is None else seed + index,
+            None if record_dir is None else os.path.join(record_dir, f"{index}.rng"),
+        )
+        for index, commands in enumerate(scripts)
+    )
+    with multiprocessing.Pool(
+        processes, initializer=_init_worker, initargs=(map_name,)
+    ) as pool:
+        for index, result in pool.imap_unordered(_run_job, jobs, chunksize):
+            yield index, result
+
+
+def summarize(results):
+    outcomes = Counter(result["outcome"] for result in results)
+    total = sum(outcomes.values())
+    played = [result for result in results if result["outcome"] != "error"]
+    summary = {
+        "sessions": total,
+        "outcomes": dict(outcomes),
+        "win_rate": outcomes["won"] / total if total else 0,
+        "average_hp": (
+            sum(result["hp"] for result in played) / len(played)
+            if played else 0
+        ),
+    }
+    errors = Counter(result["error"] for result in results if "error" in result)
+    if errors:
+        summary["errors"] = dict(errors)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("map")
+    parser.add_argument("scripts", nargs="+")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="play every script this many times")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (defaults to the cpu count)")
+    parser.add_argument("--output",
+                        help="write one JSON result per line to this file")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the first session, the rest count up from it")
+    parser.add_argument("--record", metavar="DIR",
+                        help="save every session's random draws in this directory")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+
+    scripts = [read_script(path) for path in args.scripts]
+    jobs = [commands for commands in scripts for _ in range(args.repeat)]
+
+    results = [None] * len(jobs)
+    for index, result in run_batch(
+        args.map, jobs, args.processes, seed=args.seed, record_dir=args.record
+    ):
+        results[index] = result
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            for index, result in enumerate(results):
+                result = dict(result, script=args.scripts[index // args.repeat])
+                f.write(json.dumps(result) + "\n")
+
+    print(json.dumps(summarize(results), indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
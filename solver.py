@@ -0,0 +1,1952 @@
+"""
+Find a short script that wins a map.
+
+The solver searches the game's state space (where the player is, what
+they carry, what's left in every room, enemy hp, opened locks and chests,
+the spells in effect and hp). States are hashed canonically into a
+transposition table, and a state is dropped when the same position has
+already been reached in no more commands, with no fewer spells, nearly as
+much hp, not much more risk taken and nearly as good a chance of winning.
+In worst mode, where only surviving matters, the number of commands
+isn't compared.
+
+Moves are whole steps of a plan rather than single commands: walk to the
+next interesting room (healing up or casting poison and rage on the
+doorstep first), clear a room with a given set of spells, pick up
+everything worth carrying, craft, fetch the ingredients a recipe held is
+missing, unlock a door or open a chest. Each one expands to the commands
+it takes. A room is only walked to if no other room worth visiting is on
+the way, of the weapons only the ones no other weapon beats on both
+damage and accuracy count, and keys are only fetched for the doors on
+every way to the goal.
+
+A script can't react to the dice, so a fight is planned the way the
+script will play it: every enemy in turn gets as many attacks as it takes
+to kill it KILL_CHANCE of the time, or LAST_KILL_CHANCE for the last one
+in a room, since attacks left over then cost nothing. How long that
+takes is worked out exactly from the chances to hit, evasion, rage and
+poison; damage taken is followed as a mean and a variance. Every step
+keeps an estimate of the chance to win: every fight going to plan times
+the chance of hp staying above 0. Steps that bring it under --win-chance
+are never taken.
+
+--mode picks what chance is left in:
+  expected  enemies hit as often as they do in the game. Chests are only
+            relied on when they always give the same thing, and drops
+            from loot tables never are.
+  worst     enemies always hit and chests can't be relied on. Your own
+            attacks still land by chance, otherwise nothing could ever be
+            won.
+
+The search is a focal search. The heuristic is admissible: walking to
+the goal (fetching the key to every locked door on the way), the fewest
+attacks that could kill whatever holds it, picking it up and casting it.
+Of the states that could still lead to a script at most --weight times
+as long as the shortest, the one readiest for the fights between it and
+the goal goes first: the one that would have the most hp to spare, in
+standard deviations, counting the heals it carries. With --weight 1 the
+script found is the shortest.
+
+The script found is a plan, not a promise: with --check N it's also
+played through the game N times, to see how often it really wins.
+
+Usage:
+    python3 solver.py square.map
+    python3 solver.py square.map --mode worst --output run.txt
+    python3 solver.py square.map --check 300
+"""
+
+import sys
+import json
+import math
+import time
+import heapq
+import argparse
+from bisect import bisect_left
+from itertools import combinations
+from collections import Counter, deque
+
+from adventure import GameEngine, NullSink, hit_chance, is_loot_table, load_map
+
+
+ATTACK_SPELLS = ("fireball", "poison", "rage")
+
+MAX_HP = 100
+
+# How often the attacks scripted on an enemy have to be enough to kill it
+KILL_CHANCE = 0.95
+# The same for the last enemy in a location: attacks left over once it's
+# dead don't give anyone a turn, so more of them cost nothing but typing
+LAST_KILL_CHANCE = 0.999
+
+# The most attacks scripted on one enemy
+MAX_ATTACKS = 100
+
+# How much a heal in the middle of a fight has to raise the chance of
+# getting through the next enemy to be worth a turn
+HEAL_GAIN = 0.02
+
+HP_SLACK = 10
+ODDS_SLACK = 0.05
+
+READY_STEP = 0.1
+
+# Marks a State.replace() argument that wasn't given, for fields that can
+# be None
+_KEEP = object()
+
+
+def _lookup(pairs, key, default):
+    """
+    Find a value in a sorted tuple of (key, value) pairs
+    """
+
+    i = bisect_left(pairs, (key,))
+    if i < len(pairs) and pairs[i][0] == key:
+        return pairs[i][1]
+    return default
+
+
+def _replace(pairs, key, value):
+    i = bisect_left(pairs, (key,))
+    if i < len(pairs) and pairs[i][0] == key:
+        return pairs[:i] + ((key, value),) + pairs[i + 1:]
+    return pairs[:i] + ((key, value),) + pairs[i:]
+
+
+def _add(things, thing_id):
+    return tuple(sorted(things + (thing_id,)))
+
+
+def _remove(things, thing_id):
+    i = things.index(thing_id)
+    return things[:i] + things[i + 1:]
+
+
+def _contains(things, other):
+    """
+    Whether a sorted tuple of ids holds everything another one does
+    """
+
+    i = 0
+    for thing_id in other:
+        while i < len(things) and things[i] < thing_id:
+            i += 1
+        if i == len(things) or things[i] != thing_id:
+            return False
+        i += 1
+    return True
+
+
+def normal_cdf(x):
+    return 0.5 * math.erfc(-x / math.sqrt(2))
+
+
+def survival(hp, risk):
+    """
+    The chance of hp being above 0, for hp with this mean and variance
+    """
+
+    if risk <= 0:
+        return 1.0 if hp > 0 else 0.0
+    return normal_cdf(hp / math.sqrt(risk))
+
+
+def healed(hp, risk, amount):
+    """
+    Mean and variance of hp after a heal, which can't go past MAX_HP. The
+    more likely the heal is to fill hp up, the less risk is left.
+    """
+
+    if risk <= 0:
+        return min(MAX_HP, hp + amount), 0.0
+    mean = hp + amount
+    sd = math.sqrt(risk)
+    t = (MAX_HP - mean) / sd
+    below = normal_cdf(t)
+    density = math.exp(-t * t / 2) / math.sqrt(2 * math.pi)
+    first = mean * below - sd * density + MAX_HP * (1 - below)
+    second = (
+        (mean * mean + risk) * below - sd * density * (mean + MAX_HP)
+        + MAX_HP * MAX_HP * (1 - below)
+    )
+    return first, max(second - first * first, 0.0)
+
+
+class State(object):
+    """
+    One position in the search. Rooms and enemies only hold the locations
+    that differ from the map, as sorted (location, value) pairs. hp is the
+    mean hp and risk its variance; odds is the chance of every fight so
+    far going to plan and of surviving up to the last heal. poison is
+    (turns, damage) and rage (hits, multiplier) while they're in effect.
+    """
+
+    __slots__ = (
+        "location", "hp", "inventory", "rooms", "enemies", "opened", "chests",
+        "poison", "rage", "risk", "odds",
+    )
+
+    def __init__(self, location, hp, inventory, rooms, enemies, opened,
+                 chests, poison=None, rage=None, risk=0.0, odds=1.0):
+        self.location = location
+        self.hp = hp
+        self.inventory = inventory
+        self.rooms = rooms
+        self.enemies = enemies
+        self.opened = opened
+        self.chests = chests
+        self.poison = poison
+        self.rage = rage
+        self.risk = risk
+        self.odds = odds
+
+    def replace(self, location=None, hp=None, inventory=None, rooms=None,
+                enemies=None, opened=None, chests=None, poison=_KEEP,
+                rage=_KEEP, risk=None, odds=None):
+        return State(
+            self.location if location is None else location,
+            self.hp if hp is None else hp,
+            self.inventory if inventory is None else inventory,
+            self.rooms if rooms is None else rooms,
+            self.enemies if enemies is None else enemies,
+            self.opened if opened is None else opened,
+            self.chests if chests is None else chests,
+            self.poison if poison is _KEEP else poison,
+            self.rage if rage is _KEEP else rage,
+            self.risk if risk is None else risk,
+            self.odds if odds is None else odds,
+        )
+
+
+class Kill(object):
+    """
+    How the attacks scripted on one enemy play out: how many there are,
+    the chance they kill it, the mean and mean square of the turns it
+    gets to attack, and the most hits that have to land
+    """
+
+    __slots__ = ("attacks", "chance", "turns", "turns_square", "landed")
+
+    def __init__(self, attacks, chance, turns, turns_square, landed):
+        self.attacks = attacks
+        self.chance = chance
+        self.turns = turns
+        self.turns_square = turns_square
+        self.landed = landed
+
+
+class SolverModel(object):
+    """
+    The rules of the game, rewritten over compact ids instead of dicts.
+    Every distinct thing (item, weapon, spell, recipe or key) gets an id,
+    and inventories and room contents are sorted tuples of those ids.
+    """
+
+    def __init__(self, template, goal="peace", mode="expected", win_chance=0.4):
+        self.template = template
+        self.analysis = template.analysis
+        self.goal = goal
+        self.mode = mode
+        self.win_chance = win_chance
+        # Plans are given up on below this chance to win
+        self.floor = win_chance
+        self.count = len(template)
+
+        self.things = []
+        self.thing_ids = {}
+        # (type, name) -> the first thing id with them
+        self.named = {}
+        self.room_things = []
+        # location -> [(name, hp, attack, chance to hit the player,
+        #               chance to evade an attack, drop id)]
+        self.room_enemies = []
+        self.chests = {}
+
+        for index, location in enumerate(template.locations):
+            things = [self.thing_id(name) for name in location.get("items", ())]
+            things.extend(
+                self.thing_id(thing) for thing in location.get("complex_items", ())
+            )
+            self.room_things.append(tuple(sorted(things)))
+            enemies = []
+            for name, enemy in location.get("enemies", {}).items():
+                enemies.append((
+                    name,
+                    enemy["hp"],
+                    enemy["attack"],
+                    1 if mode == "worst" else hit_chance(enemy.get("chance", 1)),
+                    hit_chance(enemy.get("evasion_chance", 0)),
+                    self.thing_id(enemy["drop"])
+                    if enemy.get("drop") and not is_loot_table(enemy["drop"])
+                    else None,
+                ))
+            self.room_enemies.append(tuple(enemies))
+            chest = location.get("chest")
+            if chest and chest.get("items") and mode == "expected":
+                items = chest["items"]
+                chances = chest.get("chances") or [1] * len(items)
+                # Only a chest that can't give anything else is relied on
+                possible = [item for item, chance in zip(items, chances) if chance > 0]
+                if possible and all(
+                    item is not None and not is_loot_table(item) for item in possible
+                ):
+                    found = {self.thing_id(item) for item in possible}
+                    if len(found) == 1:
+                        self.chests[index] = (
+                            found.pop(),
+                        ) * chest.get("number_of_items_unlocked", 1)
+
+        self.capacity = 10 if template.has_enemies else math.inf
+        self.start_inventory = ()
+        if template.has_enemies:
+            self.start_inventory = (self.thing_id({
+                "name": "punch", "type": "weapon", "damage": 1, "chance": 0.9,
+            }),)
+
+        self.kinds = [thing["type"] for thing in self.things]
+        # thing id -> what the spell does in a fight, if anything
+        self.spells = [
+            self.spell_kind(thing) if thing["type"] == "spell" else None
+            for thing in self.things
+        ]
+        self.weapons = [
+            (thing.get("damage", 0), hit_chance(thing.get("chance", 0)))
+            if thing["type"] == "weapon" else None
+            for thing in self.things
+        ]
+        self.ingredients = {
+            name for thing in self.things if thing["type"] == "recipe"
+            for name in thing["ingredients"]
+        }
+        self.initial_hps = [
+            tuple(enemy[1] for enemy in enemies) for enemies in self.room_enemies
+        ]
+        # thing id -> locations it lies in, or is dropped by an enemy in
+        self.thing_rooms = [set() for _ in self.things]
+        for index, things in enumerate(self.room_things):
+            for thing_id in things:
+                self.thing_rooms[thing_id].add(index)
+            for enemy in self.room_enemies[index]:
+                if enemy[5] is not None:
+                    self.thing_rooms[enemy[5]].add(index)
+
+        for index, found in self.chests.items():
+            for thing_id in found:
+                self.thing_rooms[thing_id].add(index)
+        # location -> things that lie or are dropped there to begin with
+        self.room_offers = [set() for _ in self.room_things]
+        for thing_id, rooms in enumerate(self.thing_rooms):
+            for index in rooms:
+                self.room_offers[index].add(thing_id)
+
+        # Everything that can be had: what lies around or is dropped, and
+        # what that can craft
+        obtainable = set(self.start_inventory)
+        obtainable.update(i for i, rooms in enumerate(self.thing_rooms) if rooms)
+        obtainable.update(
+            self.result_id(i) for i in list(obtainable)
+            if self.kinds[i] == "recipe"
+        )
+        # The best any weapon to be had could do, the most damage a
+        # fireball or poison could deal one enemy for the command it takes,
+        # and the strongest rage
+        weapons = [self.weapons[i] for i in obtainable if self.weapons[i]]
+        self.best_damage = max((weapon[0] for weapon in weapons), default=0)
+        self.best_accuracy = max((weapon[1] for weapon in weapons), default=0)
+        self.spell_damage = max([0] + [
+            self.things[i]["damage"] * self.things[i].get("turns", 1)
+            for i in obtainable if self.spells[i] in ("fireball", "poison")
+        ])
+        self.best_rage = max((
+            (self.things[i]["turns"], self.things[i]["damage_multiplier"])
+            for i in obtainable if self.spells[i] == "rage"
+        ), default=None)
+
+        self.goal_id = self.named.get(("spell", goal))
+        self.goal_rooms = self.find_goal_rooms()
+        self.reverse_exits = [[] for _ in range(self.count)]
+        for index in range(self.count):
+            for _, target in self.analysis.exits(index):
+                self.reverse_exits[target].append(index)
+        self.needs_cache = {}
+        self.arsenal_cache = {}
+        self.wanted_cache = {}
+        self.route_cache = {}
+        self.floor_cache = {}
+        self.distance_cache = {}
+        self.kill_cache = {}
+        self.fewest_cache = {}
+        self.ready_cache = {}
+        self.sources_cache = {}
+        self.hops_cache = {}
+        self.behind_cache = {}
+        self.alive_cache = {}
+        self.incoming_cache = {}
+        # locked location -> ids of the keys that open it, or None if a key
+        # can be crafted
+        self.lock_keys = {}
+        # The locked locations that stand between the start and the goal.
+        # Keys to other doors aren't worth fetching.
+        self.cuts_cache = {}
+        self.guarding = self.cuts(0)
+        for lock, name in self.analysis.locks.items():
+            keys = [
+                thing_id for thing_id, thing in enumerate(self.things)
+                if thing["type"] == "key" and thing["name"] == name
+                and thing.get("to") == self.analysis.ids[lock]
+            ]
+            if any(
+                thing["type"] == "recipe" and self.result_id(thing_id) in keys
+                for thing_id, thing in enumerate(self.things)
+            ):
+                keys = None
+            self.lock_keys[lock] = keys
+
+    def thing_id(self, thing):
+        if isinstance(thing, str):
+            thing = {"name": thing, "type": "item"}
+        # Things with the same name can still differ, like weapons the
+        # map generator rolls damage for
+        key = json.dumps(thing, sort_keys=True)
+        thing_id = self.thing_ids.get(key)
+        if thing_id is None:
+            thing_id = self.thing_ids[key] = len(self.things)
+            self.named.setdefault((thing.get("type"), thing.get("name")), thing_id)
+            self.things.append(thing)
+            if thing.get("type") == "recipe" and thing.get("result"):
+                self.thing_id(thing["result"])
+        return thing_id
+
+    @staticmethod
+    def spell_kind(spell):
+        """
+        What using a spell does, the way GameEngine.use() tells
+        """
+
+        name = spell["name"]
+        if "heal" in name:
+            # Healing over time isn't planned for
+            return None if spell.get("turns") else "heal"
+        if name in ATTACK_SPELLS:
+            return name
+        return None
+
+    def result_id(self, recipe_id):
+        result = self.things[recipe_id]["result"]
+        return self.thing_id(result)
+
+    def find_goal_rooms(self):
+        rooms = set()
+        for index in range(self.count):
+            if self.goal_id in self.room_things[index]:
+                rooms.add(index)
+            if any(enemy[5] == self.goal_id for enemy in self.room_enemies[index]):
+                rooms.add(index)
+        for thing_id, thing in enumerate(self.things):
+            if thing["type"] == "recipe" and self.result_id(thing_id) == self.goal_id:
+                rooms.update(self.analysis.craftable)
+        return rooms
+
+    def goal_distances(self, opened):
+        """
+        Fewest commands from every location to reach one of the goal rooms:
+        a move per step, and an unlock for every locked door on the way
+        """
+
+        distance = self.distance_cache.get(opened)
+        if distance is not None:
+            return distance
+        locks = self.analysis.locks
+        distance = [math.inf] * self.count
+        heap = [(0, target) for target in self.goal_rooms]
+        for target in self.goal_rooms:
+            distance[target] = 0
+        while heap:
+            steps, index = heapq.heappop(heap)
+            if steps > distance[index]:
+                continue
+            # Going into a locked location takes unlocking it first
+            steps += 2 if index in locks and index not in opened else 1
+            for source in self.reverse_exits[index]:
+                if steps < distance[source]:
+                    distance[source] = steps
+                    heapq.heappush(heap, (steps, source))
+        if len(self.distance_cache) > 1000:
+            self.distance_cache.clear()
+        self.distance_cache[opened] = distance
+        return distance
+
+    def start(self):
+        return State(
+            0, float(MAX_HP), tuple(sorted(self.start_inventory)), (), (),
+            frozenset(), frozenset(),
+        )
+
+    # State accessors
+
+    def things_in(self, state, index):
+        return _lookup(state.rooms, index, self.room_things[index])
+
+    def enemy_hps(self, state, index):
+        return _lookup(state.enemies, index, self.initial_hps[index])
+
+    def alive(self, state, index):
+        if not self.initial_hps[index]:
+            return ()
+        hps = self.enemy_hps(state, index)
+        alive = self.alive_cache.get(hps)
+        if alive is None:
+            alive = self.alive_cache[hps] = tuple(
+                i for i, hp in enumerate(hps) if hp > 0
+            )
+        return alive
+
+    def chance(self, state):
+        """
+        The chance to win the state stands for, as far as it's played
+        """
+
+        return state.odds * survival(state.hp, state.risk)
+
+    def is_locked(self, state, index):
+        return index in self.analysis.locks and index not in state.opened
+
+    def slots_used(self, inventory):
+        kinds = self.kinds
+        return sum(
+            1 for i in inventory if kinds[i] in ("item", "spell", "weapon")
+        )
+
+    def beats(self, weapon_id, other_id):
+        """
+        Whether a weapon is at least as good as another on both damage and
+        accuracy
+        """
+
+        damage, accuracy = self.weapons[weapon_id]
+        other_damage, other_accuracy = self.weapons[other_id]
+        return damage >= other_damage and accuracy >= other_accuracy
+
+    def arsenal(self, inventory):
+        """
+        The weapons carried that no other weapon carried beats
+        """
+
+        kept = self.arsenal_cache.get(inventory)
+        if kept is None:
+            weapons = sorted(
+                set(i for i in inventory if self.kinds[i] == "weapon"),
+                key=lambda i: (self.weapons[i], -i), reverse=True,
+            )
+            kept = []
+            for weapon_id in weapons:
+                if not any(self.beats(other, weapon_id) for other in kept):
+                    kept.append(weapon_id)
+            kept = tuple(kept)
+            if len(self.arsenal_cache) > 100000:
+                self.arsenal_cache.clear()
+            self.arsenal_cache[inventory] = kept
+        return kept
+
+    def needs(self, inventory):
+        """
+        How many of each ingredient the recipes in an inventory call for,
+        counting only recipes whose result is still worth having
+        """
+
+        needed = self.needs_cache.get(inventory)
+        if needed is None:
+            needed = Counter()
+            for i in set(inventory):
+                if self.kinds[i] == "recipe" and self.wanted_result(inventory, i):
+                    needed.update(self.things[i]["ingredients"])
+            if len(self.needs_cache) > 100000:
+                self.needs_cache.clear()
+            self.needs_cache[inventory] = needed
+        return needed
+
+    def namesake(self, inventory, thing_id):
+        """
+        Whether something different with the same name is carried. The
+        game would use whichever it finds first, so the two are never
+        carried together.
+        """
+
+        thing = self.things[thing_id]
+        return thing["type"] in ("weapon", "spell") and any(
+            i != thing_id and self.kinds[i] == thing["type"]
+            and self.things[i]["name"] == thing["name"]
+            for i in inventory
+        )
+
+    def wanted_result(self, inventory, recipe_id):
+        result = self.result_id(recipe_id)
+        kind = self.kinds[result]
+        if self.namesake(inventory, result):
+            return False
+        if kind == "weapon":
+            return not any(
+                self.beats(other, result) for other in self.arsenal(inventory)
+            )
+        if kind == "spell":
+            return result == self.goal_id or (
+                self.spells[result] is not None and inventory.count(result) < 2
+            )
+        return kind == "key" and any(
+            self.analysis.ids[lock] == self.things[result].get("to")
+            for lock in self.guarding
+        )
+
+    def wanted(self, state, thing_id):
+        """
+        Whether picking this thing up can still help
+        """
+
+        thing = self.things[thing_id]
+        kind = self.kinds[thing_id]
+        inventory = state.inventory
+        if self.namesake(inventory, thing_id):
+            return False
+        if kind == "item":
+            # Ingredients are only worth carrying for a recipe already in hand
+            return inventory.count(thing_id) < self.needs(inventory)[thing["name"]]
+        if kind == "spell":
+            return thing_id == self.goal_id or (
+                self.spells[thing_id] is not None and inventory.count(thing_id) < 2
+            )
+        if kind == "key":
+            return thing_id not in inventory and any(
+                self.analysis.ids[lock] == thing.get("to")
+                for lock in self.guarding if lock not in state.opened
+            )
+        if kind == "recipe":
+            return thing_id not in inventory and self.wanted_result(inventory, thing_id)
+        if kind == "weapon":
+            return not any(
+                self.beats(other, thing_id) for other in self.arsenal(inventory)
+            )
+        return False
+
+    def wanted_things(self, state):
+        cache_key = (state.inventory, state.opened)
+        wanted = self.wanted_cache.get(cache_key)
+        if wanted is None:
+            wanted = frozenset(
+                i for i in range(len(self.things)) if self.wanted(state, i)
+            )
+            if len(self.wanted_cache) > 100000:
+                self.wanted_cache.clear()
+            self.wanted_cache[cache_key] = wanted
+        return wanted
+
+    def useful(self, state, thing_id):
+        """
+        Whether something lying around could ever be worth picking up.
+        Ingredients and spells always could, a weaker weapon, a key to an
+        opened door or a recipe already carried never again.
+        """
+
+        kind = self.kinds[thing_id]
+        if kind == "item":
+            return self.things[thing_id]["name"] in self.ingredients
+        if kind == "spell":
+            return True
+        return self.wanted(state, thing_id)
+
+    def key(self, state):
+        """
+        Everything about a state but hp, risk, odds and the spells carried,
+        which are compared instead of hashed. Weapons that another weapon
+        carried beats only count for the room they take up, and of what
+        lies in the rooms only what could still be useful counts, so
+        carrying different junk or leaving it in different places doesn't
+        make states different.
+        """
+
+        arsenal = self.arsenal(state.inventory)
+        inventory = tuple(
+            i for i in state.inventory
+            if self.spells[i] is None
+            and (i in arsenal or self.kinds[i] != "weapon")
+        )
+        weaker = sum(
+            1 for i in state.inventory
+            if self.kinds[i] == "weapon" and i not in arsenal
+        )
+        cache_key = (state.rooms, state.inventory, state.opened)
+        floor = self.floor_cache.get(cache_key)
+        if floor is None:
+            floor = []
+            for index, things in state.rooms:
+                kept = tuple(i for i in things if self.useful(state, i))
+                if kept != tuple(i for i in self.room_things[index] if self.useful(state, i)):
+                    floor.append((index, kept))
+            floor = tuple(floor)
+            if len(self.floor_cache) > 100000:
+                self.floor_cache.clear()
+            self.floor_cache[cache_key] = floor
+        return (
+            state.location, inventory, weaker,
+            floor, state.enemies, state.opened, state.chests, state.poison,
+            state.rage,
+        )
+
+    def spells_held(self, state):
+        """
+        The spells carried that can be cast in a fight or to heal. Having
+        more of them is never worse.
+        """
+
+        return tuple(i for i in state.inventory if self.spells[i] is not None)
+
+    def junk(self, state):
+        """
+        Something carried that can be dropped to make room
+        """
+
+        arsenal = self.arsenal(state.inventory)
+        needed = self.needs(state.inventory)
+        held = Counter()
+        for i in state.inventory:
+            thing = self.things[i]
+            if thing["type"] == "weapon" and i not in arsenal:
+                return i
+            if thing["type"] == "item":
+                held[thing["name"]] += 1
+                if held[thing["name"]] > needed[thing["name"]]:
+                    return i
+        return None
+
+    # Rules
+
+    def damage_enemies(self, state, index, damage_by_enemy):
+        """
+        Apply damage to enemies of a location, dropping loot of the dead
+        """
+
+        hps = list(self.enemy_hps(state, index))
+        things = self.things_in(state, index)
+        for i, damage in damage_by_enemy:
+            if hps[i] <= 0:
+                continue
+            hps[i] -= damage
+            if hps[i] <= 0:
+                # How far below 0 doesn't matter, and would only tell
+                # otherwise equal states apart
+                hps[i] = 0
+                if self.room_enemies[index][i][5] is not None:
+                    things = _add(things, self.room_enemies[index][i][5])
+        return state.replace(
+            enemies=_replace(state.enemies, index, tuple(hps)),
+            rooms=_replace(state.rooms, index, things),
+        )
+
+    def incoming(self, index, alive):
+        """
+        Mean and variance of the damage the given enemies deal in a turn
+        """
+
+        cache_key = (index, alive)
+        incoming = self.incoming_cache.get(cache_key)
+        if incoming is not None:
+            return incoming
+        mean = variance = 0.0
+        for i in alive:
+            _, _, attack, hit, _, _ = self.room_enemies[index][i]
+            mean += attack * hit
+            variance += attack * attack * hit * (1 - hit)
+        self.incoming_cache[cache_key] = mean, variance
+        return mean, variance
+
+    def hurt(self, state, mean, variance):
+        """
+        Take damage. Returns None once the chance to win is too low.
+        """
+
+        state = state.replace(hp=state.hp - mean, risk=state.risk + variance)
+        if self.chance(state) < self.floor:
+            return None
+        return state
+
+    def tick(self, state):
+        """
+        A turn of poison on the enemies around, if it's in effect
+        """
+
+        index = state.location
+        if not state.poison:
+            return state
+        turns, damage = state.poison
+        state = self.damage_enemies(
+            state, index, [(i, damage) for i in self.alive(state, index)]
+        )
+        return state.replace(poison=(turns - 1, damage) if turns > 1 else None)
+
+    def pre_turn(self, state):
+        """
+        Poison ticks and enemy attacks at the start of a command. Returns
+        None once the chance to win is too low.
+        """
+
+        index = state.location
+        if not self.initial_hps[index] or not self.alive(state, index):
+            return state
+        state = self.tick(state)
+        return self.hurt(state, *self.incoming(index, self.alive(state, index)))
+
+    def kill(self, hp, damage, chance, rage, poison, needed=KILL_CHANCE):
+        """
+        Plan attacks on one enemy with hp left, for a weapon dealing damage
+        when it lands, which it does with the given chance. The first
+        hits of a rage deal more, and the enemy takes poison at the start
+        of every turn while it lasts. Returns a Kill, or None if the enemy
+        can't be killed with the needed chance within MAX_ATTACKS.
+        """
+
+        cache_key = (hp, damage, chance, rage, poison, needed)
+        if cache_key in self.kill_cache:
+            return self.kill_cache[cache_key]
+        rage_hits, multiplier = rage or (0, 0)
+        poison_turns, poison_damage = poison or (0, 0)
+        boosted = damage * (1 + multiplier / 100)
+
+        def dealt(landed):
+            return (
+                boosted * min(landed, rage_hits)
+                + damage * max(landed - rage_hits, 0)
+            )
+
+        result = None
+        if damage > 0 and chance > 0:
+            landed = 0
+            while dealt(landed) < hp:
+                landed += 1
+        elif poison_damage * poison_turns >= hp:
+            landed = 0
+        else:
+            landed = None
+        if landed is not None:
+            # Landed hits -> the chance of the enemy standing at the start
+            # of the turn with that many hits taken
+            standing = {0: 1.0}
+            killed = turns = turns_square = 0.0
+            for attack in range(1, MAX_ATTACKS + 1):
+                poisoned = poison_damage * min(attack, poison_turns)
+                after = {}
+                for hits, p in standing.items():
+                    if hp - poisoned - dealt(hits) <= 0:
+                        # The poison killed it before it could attack
+                        killed += p
+                        turns += p * (attack - 1)
+                        turns_square += p * (attack - 1) ** 2
+                        continue
+                    if chance > 0 and hp - poisoned - dealt(hits + 1) <= 0:
+                        killed += p * chance
+                        turns += p * chance * attack
+                        turns_square += p * chance * attack * attack
+                    elif chance > 0:
+                        after[hits + 1] = after.get(hits + 1, 0.0) + p * chance
+                    if chance < 1:
+                        after[hits] = after.get(hits, 0.0) + p * (1 - chance)
+                standing = after
+                if killed >= needed:
+                    left = sum(standing.values())
+                    result = Kill(
+                        attack, killed,
+                        turns + left * attack,
+                        turns_square + left * attack * attack,
+                        landed,
+                    )
+                    break
+        if len(self.kill_cache) > 100000:
+            self.kill_cache.clear()
+        self.kill_cache[cache_key] = result
+        return result
+
+    def plan_kill(self, state, target):
+        """
+        The best weapon to script on an enemy and how that plays out, as
+        (weapon id, Kill), or None if nothing carried kills it reliably
+        """
+
+        index = state.location
+        enemy = self.room_enemies[index][target]
+        hp = self.enemy_hps(state, index)[target]
+        needed = KILL_CHANCE
+        if self.alive(state, index) == (target,):
+            needed = LAST_KILL_CHANCE
+        best = None
+        for weapon_id in self.arsenal(state.inventory):
+            damage, accuracy = self.weapons[weapon_id]
+            kill = self.kill(
+                hp, damage, accuracy * (1 - enemy[4]), state.rage, state.poison,
+                needed,
+            )
+            if kill is not None and (
+                best is None or (kill.turns, kill.attacks) < (best[1].turns, best[1].attacks)
+            ):
+                best = (weapon_id, kill)
+        return best
+
+    def attack(self, state, target, weapon_id, kill):
+        """
+        Play out the attacks planned on an enemy. The other enemies take
+        poison and hit back on every one of those turns, the target until
+        it dies. Returns None once the chance to win is too low.
+        """
+
+        index = state.location
+        enemies = self.room_enemies[index]
+        others = tuple(i for i in self.alive(state, index) if i != target)
+        _, _, attack, hit, _, drop = enemies[target]
+        turns_variance = kill.turns_square - kill.turns * kill.turns
+        mean = attack * hit * kill.turns
+        variance = (
+            attack * attack * hit * (1 - hit) * kill.turns
+            + attack * attack * hit * hit * max(turns_variance, 0)
+        )
+
+        # The others are followed turn by turn: poison only kills them
+        # at fixed times, so what they do is known
+        poison = state.poison
+        steady = True
+        for turn in range(1, kill.attacks + 1):
+            if poison and turn <= poison[0]:
+                if not others:
+                    steady = False
+                    break
+                state = self.damage_enemies(
+                    state, index, [(i, poison[1]) for i in others]
+                )
+                others = tuple(
+                    i for i in others if self.enemy_hps(state, index)[i] > 0
+                )
+            turn_mean, turn_variance = self.incoming(index, others)
+            mean += turn_mean
+            variance += turn_variance
+        if poison:
+            # With nobody else around, the poison wears off with the
+            # target, and when that happens isn't known
+            left = poison[0] - kill.attacks
+            poison = (left, poison[1]) if steady and left > 0 else None
+        rage = state.rage
+        if rage:
+            left = rage[0] - kill.landed
+            rage = (left, rage[1]) if left > 0 else None
+
+        hps = list(self.enemy_hps(state, index))
+        hps[target] = 0
+        things = self.things_in(state, index)
+        if drop is not None:
+            things = _add(things, drop)
+        state = state.replace(
+            enemies=_replace(state.enemies, index, tuple(hps)),
+            rooms=_replace(state.rooms, index, things),
+            poison=poison, rage=rage, odds=state.odds * kill.chance,
+        )
+        return self.hurt(state, mean, variance)
+
+    def cast(self, state, spell_id):
+        index = state.location
+        spell = self.things[spell_id]
+        kind = self.spells[spell_id]
+        state = state.replace(inventory=_remove(state.inventory, spell_id))
+        alive = self.alive(state, index)
+        if kind == "fireball":
+            return self.damage_enemies(
+                state, index, [(i, spell["damage"]) for i in alive]
+            )
+        if kind == "rage":
+            return state.replace(rage=(spell["turns"], spell["damage_multiplier"]))
+        turns = spell["turns"]
+        if alive:
+            state = self.damage_enemies(
+                state, index, [(i, spell["damage"]) for i in alive]
+            )
+            turns -= 1
+        return state.replace(poison=(turns, spell["damage"]) if turns > 0 else None)
+
+    def heal(self, state, spell_id):
+        """
+        Use a heal. Whether hp stayed above 0 until now is settled into
+        odds, and what's left of the risk is what the heal didn't cover.
+        """
+
+        hp, risk = healed(state.hp, state.risk, self.things[spell_id]["heal_amount"])
+        return state.replace(
+            inventory=_remove(state.inventory, spell_id),
+            hp=hp, risk=risk, odds=self.chance(state),
+        )
+
+    def heals(self, state):
+        """
+        The heal spells carried, one of each
+        """
+
+        return sorted(
+            (i for i in set(state.inventory) if self.spells[i] == "heal"),
+            key=lambda i: self.things[i]["heal_amount"],
+        )
+
+    # Moves
+
+    def fight(self, state, tactic):
+        """
+        Clear the current location: cast the spells in the tactic, then
+        take the enemies on one at a time, the ones that hurt the most for
+        the time they take to kill first, healing whenever that makes
+        getting through the next one much more likely
+        """
+
+        index = state.location
+        enemies = self.room_enemies[index]
+        commands = []
+        for spell_id in tactic:
+            if not self.alive(state, index):
+                break
+            state = self.pre_turn(state)
+            if state is None:
+                return None
+            if not self.alive(state, index):
+                # The poison finished them off, and a spell cast now
+                # would only ask whether to waste it
+                commands.append("look")
+                break
+            commands.append("use " + self.things[spell_id]["name"])
+            state = self.cast(state, spell_id)
+
+        while True:
+            alive = self.alive(state, index)
+            if not alive:
+                # Poison and rage left over aren't counted on later: what
+                # they'd do depends on dice the plan can't see
+                return commands, state.replace(poison=None, rage=None)
+            plans = {}
+            for i in alive:
+                plan = self.plan_kill(state, i)
+                if plan is None:
+                    return None
+                plans[i] = plan
+            target = max(alive, key=lambda i: (
+                self.incoming(index, (i,))[0] / max(plans[i][1].turns, 1), -i
+            ))
+            weapon_id, kill = plans[target]
+            after = self.attack(state, target, weapon_id, kill)
+
+            for spell_id in self.heals(state):
+                turn = self.pre_turn(state)
+                if turn is None or target not in self.alive(turn, index):
+                    break
+                turn = self.heal(turn, spell_id)
+                plan = self.plan_kill(turn, target)
+                if plan is None:
+                    continue
+                healed_after = self.attack(turn, target, *plan)
+                if healed_after is not None and (
+                    after is None
+                    or self.chance(healed_after) > self.chance(after) + HEAL_GAIN
+                ):
+                    commands.append("use " + self.things[spell_id]["name"])
+                    state = turn
+                    weapon_id, kill = plan
+                    after = healed_after
+                    break
+
+            if after is None:
+                return None
+            name = self.things[weapon_id]["name"]
+            commands.extend([f"attack {enemies[target][0]}:{name}"] * kill.attacks)
+            state = after
+
+    def attack_spells(self, state):
+        return tuple(sorted(
+            (i for i in state.inventory if self.spells[i] in ATTACK_SPELLS),
+            key=lambda i: (ATTACK_SPELLS.index(self.spells[i]), i),
+        ))
+
+    def tactics(self, state):
+        """
+        Every set of attack spells worth trying in a fight, cast in a
+        fixed order: fireballs first, then poison, then rage
+        """
+
+        spells = self.attack_spells(state)
+        seen = set()
+        for size in range(len(spells) + 1):
+            for tactic in combinations(spells, size):
+                if tactic not in seen:
+                    seen.add(tactic)
+                    yield tactic
+
+    def preparations(self, state):
+        """
+        What can be done on the doorstep of a fight, as (commands, state):
+        a heal that doesn't go to waste, and poison or rage cast early
+        (answering yes to casting with no enemies around), so the poison
+        is at them and the rage ready before they get to strike
+        """
+
+        heals = [(), ]
+        fitting = [
+            i for i in self.heals(state)
+            if state.hp + self.things[i]["heal_amount"] / 2 <= MAX_HP
+        ]
+        if fitting:
+            heals.append((fitting[-1],))
+        spells = []
+        for kind in ("poison", "rage"):
+            held = [i for i in state.inventory if self.spells[i] == kind]
+            if held:
+                spells.append(held[0])
+        for heal in heals:
+            for size in range(len(spells) + 1):
+                for casts in combinations(spells, size):
+                    if not heal and not casts:
+                        continue
+                    commands = []
+                    after = state
+                    for spell_id in heal:
+                        commands.append("use " + self.things[spell_id]["name"])
+                        after = self.heal(after, spell_id)
+                    for spell_id in casts:
+                        commands.extend(["use " + self.things[spell_id]["name"], "y"])
+                        after = self.cast(after, spell_id)
+                    yield commands, after
+
+    def collect(self, state):
+        """
+        Pick up everything in the current location that's worth having,
+        dropping junk when the bag is full
+        """
+
+        index = state.location
+        commands = []
+        while True:
+            things = self.things_in(state, index)
+            # Once the goal is here nothing else matters. Otherwise
+            # recipes, keys and weapons change what else is wanted, so
+            # they're picked up first.
+            if self.goal_id in things:
+                order = [self.goal_id]
+            else:
+                order = sorted(
+                    set(things), key=lambda i: (self.things[i]["type"] == "item", i)
+                )
+            for thing_id in order:
+                if not self.wanted(state, thing_id):
+                    continue
+                inventory = state.inventory
+                room = _remove(things, thing_id)
+                if (
+                    self.things[thing_id]["type"] in ("item", "spell", "weapon")
+                    and self.slots_used(inventory) >= self.capacity
+                ):
+                    junk = self.junk(state)
+                    if junk is None and thing_id == self.goal_id:
+                        # Anything can go to make room for the goal
+                        junk = next(
+                            i for i in inventory
+                            if self.kinds[i] in ("item", "spell", "weapon")
+                        )
+                    if junk is None:
+                        continue
+                    commands.append("drop " + self.things[junk]["name"])
+                    inventory = _remove(inventory, junk)
+                    room = _add(room, junk)
+                commands.append("get " + self.things[thing_id]["name"])
+                state = state.replace(
+                    inventory=_add(inventory, thing_id),
+                    rooms=_replace(state.rooms, index, room),
+                )
+                if thing_id == self.goal_id:
+                    return commands, state
+                break
+            else:
+                return commands, state
+
+    def craftable_recipes(self, state):
+        held = Counter(self.things[i]["name"] for i in state.inventory)
+        recipes = []
+        for i in sorted(set(state.inventory)):
+            recipe = self.things[i]
+            if recipe["type"] != "recipe":
+                continue
+            needed = Counter(recipe["ingredients"])
+            if (
+                all(held[name] >= n for name, n in needed.items())
+                and self.wanted(state, self.result_id(i))
+            ):
+                recipes.append(i)
+        return recipes
+
+    def craft(self, state, recipe_id):
+        index = state.location
+        inventory = state.inventory
+        for name in self.things[recipe_id]["ingredients"]:
+            inventory = _remove(inventory, self.named[("item", name)])
+        result = self.result_id(recipe_id)
+        return state.replace(
+            inventory=inventory,
+            rooms=_replace(
+                state.rooms, index, _add(self.things_in(state, index), result)
+            ),
+        )
+
+    def unlockable(self, state, index):
+        locked_exits = self.analysis.locked_exits.get(index, ())
+        for direction, target in self.analysis.exits(index):
+            if direction not in locked_exits or not self.is_locked(state, target):
+                continue
+            required_key = self.analysis.locks[target]
+            for i in state.inventory:
+                key = self.things[i]
+                if (
+                    key["type"] == "key" and key["name"] == required_key
+                    and key.get("from") == self.analysis.ids[index]
+                    and key.get("to") == self.analysis.ids[target]
+                ):
+                    yield direction, target
+                    break
+
+    def routes(self, state):
+        """
+        Shortest paths through unlocked doors from the current location,
+        as {target: [(direction, location), ...]}
+        """
+
+        cache_key = (state.location, state.opened)
+        routes = self.route_cache.get(cache_key)
+        if routes is not None:
+            return routes
+        routes = {state.location: []}
+        queue = deque([state.location])
+        while queue:
+            index = queue.popleft()
+            for direction, target in self.analysis.exits(index):
+                if target not in routes and not self.is_locked(state, target):
+                    routes[target] = routes[index] + [(direction, target)]
+                    queue.append(target)
+        if len(self.route_cache) > 100000:
+            self.route_cache.clear()
+        self.route_cache[cache_key] = routes
+        return routes
+
+    def sources(self, location, thing_id):
+        """
+        The other locations a thing lies in or is dropped in, as (moves
+        away if no door were locked, location), nearest first
+        """
+
+        cache_key = (location, thing_id)
+        sources = self.sources_cache.get(cache_key)
+        if sources is None:
+            hops = self.hops(location)
+            sources = sorted(
+                (hops[index], index) for index in self.thing_rooms[thing_id]
+                if index in hops and index != location
+            )
+            self.sources_cache[cache_key] = sources
+        return sources
+
+    def nearest(self, state, routes, thing_id):
+        """
+        The nearest other location a thing lies in with no enemies left,
+        or None
+        """
+
+        nearest = None
+        for hops, index in self.sources(state.location, thing_id):
+            if nearest is not None and hops >= len(routes[nearest]):
+                break
+            if (
+                index in routes
+                and (nearest is None or len(routes[index]) < len(routes[nearest]))
+                and thing_id in self.things_in(state, index)
+                and not self.alive(state, index)
+            ):
+                nearest = index
+        # Junk dropped along the way
+        for index, things in state.rooms:
+            if (
+                index in routes and index != state.location and thing_id in things
+                and (nearest is None or len(routes[index]) < len(routes[nearest]))
+                and not self.alive(state, index)
+            ):
+                nearest = index
+        return nearest
+
+    def gather(self, state, recipe_id):
+        """
+        Fetch the ingredients a recipe is missing, each time from the
+        nearest location with some lying around and no enemies, picking
+        up everything else worth having there too. Returns (commands,
+        state), or None if they can't all be had.
+        """
+
+        needed = Counter(self.things[recipe_id]["ingredients"])
+        commands = []
+        while True:
+            held = Counter(self.things[i]["name"] for i in state.inventory)
+            missing = [name for name, n in needed.items() if held[name] < n]
+            if not missing:
+                return commands, state
+            routes = self.routes(state)
+            nearest = None
+            for name in missing:
+                index = self.nearest(state, routes, self.named[("item", name)])
+                if index is not None and (
+                    nearest is None or len(routes[index]) < len(routes[nearest])
+                ):
+                    nearest = index
+            if nearest is None:
+                return None
+            route = routes[nearest]
+            state = self.walk(state, route)
+            if state is None:
+                return None
+            more, state = self.collect(state)
+            if not more:
+                return None
+            commands.extend(["go " + direction for direction, _ in route] + more)
+
+    def destinations(self, state, routes):
+        """
+        Locations worth walking to: the nearest place to find every wanted
+        thing (lying around or dropped by an enemy still alive), unopened
+        chests, the nearest crafting spot when something can be crafted
+        and doors that can be unlocked. A location is left out when the
+        way there goes through another one: stopping there on the way is
+        never longer.
+        """
+
+        # Ingredients are gathered for a recipe instead
+        wanted = {
+            thing_id for thing_id in self.wanted_things(state)
+            if self.kinds[thing_id] != "item"
+        }
+        moved = {index for index, _ in state.rooms}
+        found = set()
+        # Routes are found breadth first, so nearer locations come first
+        for index in routes:
+            if not wanted:
+                break
+            if index == state.location or (
+                index not in moved and wanted.isdisjoint(self.room_offers[index])
+            ):
+                continue
+            enemies = self.room_enemies[index]
+            here = wanted.intersection(self.things_in(state, index)).union(
+                enemies[i][5] for i in self.alive(state, index)
+                if enemies[i][5] in wanted
+            )
+            if here:
+                found.add(index)
+                wanted -= here
+
+        found.update(
+            index for index in self.chests
+            if index not in state.chests and index in routes
+        )
+        if self.craftable_recipes(state):
+            craftable = [index for index in self.analysis.craftable if index in routes]
+            if craftable:
+                found.add(min(craftable, key=lambda index: len(routes[index])))
+        found.update(
+            index for index in self.analysis.locked_exits
+            if index in routes and any(self.unlockable(state, index))
+        )
+        found.discard(state.location)
+        return sorted(
+            (
+                index for index in found
+                if not any(step in found for _, step in routes[index][:-1])
+            ),
+            key=lambda index: (len(routes[index]), index),
+        )
+
+    def walk(self, state, route):
+        """
+        Follow a route, taking a turn of poison and enemy attacks in every
+        room on the way that still has enemies. Returns None once the
+        chance to win is too low.
+        """
+
+        hostile = self.initial_hps
+        index = state.location
+        for _, step in route:
+            if hostile[index]:
+                if index != state.location:
+                    state = state.replace(location=index)
+                state = self.pre_turn(state)
+                if state is None:
+                    return None
+            index = step
+        if index != state.location:
+            state = state.replace(location=index)
+        return state
+
+    def successors(self, state):
+        """
+        Yield (commands, next state) pairs, with None as the next state
+        once the game is won
+        """
+
+        index = state.location
+        if self.goal_id in state.inventory:
+            if self.pre_turn(state) is not None:
+                yield ["use " + self.goal], None
+            return
+
+        alive = self.alive(state, index)
+        if alive:
+            for tactic in self.tactics(state):
+                move = self.fight(state, tactic)
+                if move is not None:
+                    yield move
+        else:
+            # Anything worth having is picked up, and anything worth
+            # crafting is crafted, before doing anything else here. Coming
+            # back for it later is rarely shorter, and not trying keeps
+            # the search small.
+            commands, after = self.collect(state)
+            if commands:
+                yield commands, after
+                return
+
+            if index in self.analysis.craftable:
+                commands = []
+                after = state
+                for recipe_id in self.craftable_recipes(state):
+                    if recipe_id not in self.craftable_recipes(after):
+                        continue
+                    commands.append("craft " + self.things[recipe_id]["name"])
+                    after = self.craft(after, recipe_id)
+                if commands:
+                    more, after = self.collect(after)
+                    yield commands + more, after
+                    return
+
+            for recipe_id in sorted(set(state.inventory)):
+                if (
+                    self.kinds[recipe_id] == "recipe"
+                    and self.wanted_result(state.inventory, recipe_id)
+                    and recipe_id not in self.craftable_recipes(state)
+                ):
+                    move = self.gather(state, recipe_id)
+                    if move is not None:
+                        yield move
+
+            for direction, target in self.unlockable(state, index):
+                yield ["unlock " + direction], state.replace(
+                    opened=state.opened | {target}
+                )
+
+            if index in self.chests and index not in state.chests:
+                room = self.things_in(state, index)
+                for thing_id in self.chests[index]:
+                    room = _add(room, thing_id)
+                yield ["open_chest"], state.replace(
+                    rooms=_replace(state.rooms, index, room),
+                    chests=state.chests | {index},
+                )
+
+        routes = self.routes(state)
+        preparations = None
+        # Getting ready on the doorstep pays off for the fights that can't
+        # be avoided, and is tried for the nearest other one
+        guarded = set(self.goal_rooms).union(self.guards(state))
+        nearest = True
+        for target in self.destinations(state, routes):
+            route = routes[target]
+            moves = ["go " + direction for direction, _ in route]
+            after = self.walk(state, route)
+            if after is not None:
+                # What's worth having is picked up on arrival, as it would
+                # be first thing anyway
+                more = []
+                if not self.alive(after, target):
+                    more, after = self.collect(after)
+                yield moves + more, after
+            if alive or not self.alive(state, target):
+                continue
+            if target not in guarded:
+                if not nearest:
+                    continue
+                nearest = False
+            if preparations is None:
+                preparations = list(self.preparations(state))
+            for commands, prepared in preparations:
+                after = self.walk(prepared, route)
+                if after is not None:
+                    yield commands + moves, after
+
+    def readiness(self, state):
+        """
+        How ready a state is for the goal fight, as how many standard
+        deviations of hp would be left after it if it started right now,
+        after the fights for the keys on the way, counting every heal
+        carried, with no spells cast in the goal fight or all of them.
+        Unlike the chance to win, this keeps growing with every step that
+        helps, however far from winning it still is.
+        """
+
+        if self.goal_id in state.inventory:
+            return math.inf
+        fights = tuple(
+            (room, self.enemy_hps(state, room)) for room in self.goal_rooms
+        )
+        guards = tuple(
+            (room, self.enemy_hps(state, room)) for room in self.guards(state)
+        )
+        inventory = tuple(
+            i for i in state.inventory if self.spells[i] != "heal"
+        )
+        cache_key = (
+            fights, guards, self.arsenal(inventory), self.attack_spells(state)
+        )
+        damage = self.ready_cache.get(cache_key)
+        if damage is None:
+            # Fights don't depend on the hp they start with, when they're
+            # played to the end and never heal
+            damage = []
+            self.floor = 0.0
+            try:
+                before = after = 0.0
+                for room, _ in guards:
+                    at = State(
+                        room, 0.0, inventory, state.rooms, state.enemies,
+                        frozenset(), frozenset(),
+                    )
+                    move = self.fight(at, ())
+                    if move is not None:
+                        before -= move[1].hp
+                        after += move[1].risk
+                for room, _ in fights:
+                    at = State(
+                        room, 0.0, inventory, state.rooms, state.enemies,
+                        frozenset(), frozenset(),
+                    )
+                    if not self.alive(at, room):
+                        damage.append((before, after))
+                        continue
+                    for tactic in set([(), self.attack_spells(at)]):
+                        move = self.fight(at, tactic)
+                        if move is not None:
+                            damage.append(
+                                (before - move[1].hp, after + move[1].risk)
+                            )
+            finally:
+                self.floor = self.win_chance
+            if len(self.ready_cache) > 100000:
+                self.ready_cache.clear()
+            self.ready_cache[cache_key] = damage
+        hp = state.hp + sum(
+            self.things[i]["heal_amount"] for i in state.inventory
+            if self.spells[i] == "heal"
+        )
+        return max(
+            ((hp - mean) / math.sqrt(state.risk + risk + 1) for mean, risk in damage),
+            default=-math.inf,
+        )
+
+    def guards(self, state):
+        """
+        The locations whose enemies have to be beaten for the goal: where
+        the only key to a locked door on every way there is dropped
+        """
+
+        guards = []
+        for lock in self.guarding:
+            keys = self.lock_keys[lock]
+            if lock in state.opened or any(k in state.inventory for k in keys):
+                continue
+            rooms = set().union(*(self.thing_rooms[k] for k in keys))
+            if len(rooms) == 1:
+                room = rooms.pop()
+                enemies = self.room_enemies[room]
+                if any(
+                    enemies[i][5] in keys for i in self.alive(state, room)
+                ):
+                    guards.append(room)
+        return guards
+
+    def priority(self, state):
+        """
+        How ready a state is for the goal fight, readiest first
+        """
+
+        ready = self.readiness(state)
+        if ready in (math.inf, -math.inf):
+            return -ready
+        return -round(ready / READY_STEP)
+
+    def hops(self, source):
+        """
+        Fewest moves from a location to every other, as if no door were
+        locked
+        """
+
+        distance = self.hops_cache.get(source)
+        if distance is None:
+            distance = {source: 0}
+            queue = deque([source])
+            while queue:
+                index = queue.popleft()
+                for _, target in self.analysis.exits(index):
+                    if target not in distance:
+                        distance[target] = distance[index] + 1
+                        queue.append(target)
+            self.hops_cache[source] = distance
+        return distance
+
+    def behind(self, lock, room):
+        """
+        The locations that can't get to a room without going through a
+        locked location
+        """
+
+        cache_key = (lock, room)
+        cut_off = self.behind_cache.get(cache_key)
+        if cut_off is None:
+            # Nothing gets into a locked location without going through it
+            reach = {room} if room != lock else set()
+            queue = deque([room] if room != lock else [])
+            while queue:
+                index = queue.popleft()
+                for source in self.reverse_exits[index]:
+                    if source not in reach and source != lock:
+                        reach.add(source)
+                        queue.append(source)
+            cut_off = frozenset(range(self.count)) - reach
+            self.behind_cache[cache_key] = cut_off
+        return cut_off
+
+    def cuts(self, location):
+        """
+        The locked locations that stand between a location and every
+        goal room
+        """
+
+        cuts = self.cuts_cache.get(location)
+        if cuts is None:
+            cuts = self.cuts_cache[location] = [
+                lock for lock in self.analysis.locks
+                if self.goal_rooms and all(
+                    location in self.behind(lock, room) for room in self.goal_rooms
+                )
+            ]
+        return cuts
+
+    def fewest_attacks(self, hp, evasion):
+        """
+        The fewest commands any fight could script on an enemy: spells
+        dealing the most they could, then attacks with a weapon as strong
+        as the strongest on the map and as accurate as the most accurate
+        """
+
+        cache_key = (hp, evasion)
+        fewest = self.fewest_cache.get(cache_key)
+        if fewest is not None:
+            return fewest
+        fewest = math.inf
+        chance = self.best_accuracy * (1 - evasion)
+        spells = 0
+        while spells < fewest:
+            left = hp - spells * self.spell_damage
+            if left <= 0:
+                fewest = spells
+                break
+            # Every rage cast boosts a few more hits
+            rages = 0
+            while spells + rages < fewest:
+                rage = None
+                if rages:
+                    turns, multiplier = self.best_rage
+                    rage = (turns * rages, multiplier)
+                kill = self.kill(left, self.best_damage, chance, rage, None)
+                if kill is not None:
+                    fewest = min(fewest, spells + rages + kill.attacks)
+                if not self.best_rage or (rage and kill and kill.landed <= rage[0]):
+                    break
+                rages += 1
+            if not self.spell_damage:
+                break
+            spells += 1
+        self.fewest_cache[cache_key] = fewest
+        return fewest
+
+    def taking(self, state, room, thing_id):
+        """
+        The fewest commands to take something from a room: a get, and
+        killing the enemy that drops it if that hasn't happened yet
+        """
+
+        if thing_id in self.things_in(state, room):
+            return 1
+        if room in self.chests and room not in state.chests and thing_id in self.chests[room]:
+            return 2
+        hps = self.enemy_hps(state, room)
+        return min(
+            (
+                1 + self.fewest_attacks(hp, enemy[4])
+                for hp, enemy in zip(hps, self.room_enemies[room])
+                if enemy[5] == thing_id and hp > 0
+            ),
+            default=math.inf,
+        )
+
+    def heuristic(self, state):
+        """
+        A lower bound on the commands still needed: reach a goal room,
+        unlocking the doors on the way and first fetching the key to any
+        door that can't be gone around, kill whatever holds the goal spell
+        in as few attacks as the best weapon on the map could, pick it up
+        and cast it
+        """
+
+        if self.goal_id in state.inventory:
+            return 1
+        location = state.location
+        distance = self.goal_distances(state.opened)[location]
+        if distance == math.inf:
+            return math.inf
+
+        hops = self.hops(location)
+        for lock in self.cuts(location):
+            keys = self.lock_keys[lock]
+            if keys is None or lock in state.opened or any(
+                key in state.inventory for key in keys
+            ):
+                continue
+            detour = math.inf
+            for room in self.goal_rooms:
+                for key in keys:
+                    for key_room in self.thing_rooms[key]:
+                        if key_room in hops:
+                            detour = min(
+                                detour,
+                                hops[key_room] + self.taking(state, key_room, key)
+                                + self.hops(key_room).get(room, math.inf) + 1,
+                            )
+            distance = max(distance, detour)
+        if distance == math.inf:
+            return math.inf
+
+        fight = min(
+            (
+                sum(
+                    self.fewest_attacks(hp, enemy[4])
+                    for hp, enemy in zip(self.enemy_hps(state, room), self.room_enemies[room])
+                    if enemy[5] == self.goal_id and hp > 0
+                )
+                for room in self.goal_rooms
+            ),
+            default=0,
+        )
+        return distance + fight + 2
+
+
+class SolverResult(object):
+    def __init__(self, commands, hp, chance, expanded, seconds, exhausted=False):
+        self.commands = commands
+        self.hp = hp
+        # The chance to win, by the solver's reckoning
+        self.chance = chance
+        self.expanded = expanded
+        self.seconds = seconds
+        # Whether every plan was tried, rather than giving up on the limits
+        self.exhausted = exhausted
+
+
+def solve(template, goal="peace", mode="expected", weight=5.0,
+          max_expanded=200000, time_limit=None, win_chance=0.4):
+    """
+    Search for the shortest winning script. Returns a SolverResult, with
+    commands set to None if no win was found. A weight above 1 trades
+    the shortest script for a faster search: the script found is at most
+    that many times longer than the shortest.
+    """
+
+    model = SolverModel(template, goal, mode, win_chance)
+    # Only surviving matters in worst mode, not how long it takes
+    any_length = mode == "worst"
+    started = time.perf_counter()
+    start = model.start()
+    tie = 0
+    # Every state queued, by f = commands so far + heuristic
+    frontier = [(model.heuristic(start), tie, start)]
+    # The states queued with f within weight times the lowest f, the
+    # readiest for the goal fight first, then by f, deepest first
+    focal = [((model.priority(start), frontier[0][0], 0), tie, start)]
+    # States taken off focal while their f was too high, by f
+    waiting = []
+    costs = {start: (0, frontier[0][0])}
+    parents = {start: None}
+    # state key -> [(commands so far, hp, risk, odds, spells, state)] that
+    # nothing else beats
+    best = {model.key(start): [
+        (0, start.hp, start.risk, start.odds, model.spells_held(start), start)
+    ]}
+    # States expanded, or found to be beaten after they were queued
+    done = set()
+    expanded = 0
+
+    def dominates(seen, other):
+        """
+        Whether a state is at least as good as another with the same key
+        """
+
+        return (
+            (any_length or seen[0] <= other[0])
+            and seen[1] >= other[1] - HP_SLACK
+            and math.sqrt(seen[2]) <= math.sqrt(other[2]) + HP_SLACK
+            and seen[3] >= other[3] - ODDS_SLACK
+            and _contains(seen[4], other[4])
+        )
+
+    while True:
+        while frontier and frontier[0][2] in done:
+            heapq.heappop(frontier)
+        if not frontier:
+            break
+        bound = weight * frontier[0][0]
+        while waiting and waiting[0][0] <= bound:
+            _, entry = heapq.heappop(waiting)
+            heapq.heappush(focal, entry)
+        while True:
+            entry = heapq.heappop(focal)
+            state = entry[2]
+            if state in done:
+                continue
+            if costs[state][1] > bound:
+                heapq.heappush(waiting, (costs[state][1], entry))
+                continue
+            break
+        done.add(state)
+        g = costs[state][0]
+
+        expanded += 1
+        if expanded > max_expanded or (
+            time_limit and time.perf_counter() - started > time_limit
+        ):
+            return SolverResult(None, None, None, expanded, time.perf_counter() - started)
+        for commands, next_state in model.successors(state):
+            if next_state is None:
+                script = commands
+                node = state
+                while parents[node] is not None:
+                    node, step = parents[node]
+                    script = step + script
+                return SolverResult(
+                    script, state.hp, model.chance(state), expanded,
+                    time.perf_counter() - started,
+                )
+            next_g = g + len(commands)
+            entry = (
+                next_g, next_state.hp, next_state.risk, next_state.odds,
+                model.spells_held(next_state), next_state,
+            )
+            front = best.setdefault(model.key(next_state), [])
+            if any(dominates(seen, entry) for seen in front):
+                continue
+            h = model.heuristic(next_state)
+            if h == math.inf:
+                continue
+            kept = []
+            for seen in front:
+                if dominates(entry, seen):
+                    done.add(seen[5])
+                else:
+                    kept.append(seen)
+            kept.append(entry)
+            front[:] = kept
+            parents[next_state] = (state, commands)
+            f = next_g + h
+            costs[next_state] = (next_g, f)
+            tie += 1
+            heapq.heappush(frontier, (f, tie, next_state))
+            heapq.heappush(
+                focal, ((model.priority(next_state), f, -next_g), tie, next_state)
+            )
+
+    return SolverResult(
+        None, None, None, expanded, time.perf_counter() - started, exhausted=True
+    )
+
+
+def check(template, commands, games):
+    """
+    Play a script through the game with seeds 0 to games - 1, returning
+    how many games ended each way
+    """
+
+    outcomes = Counter()
+    for seed in range(games):
+        result = GameEngine(template, NullSink(), seed=seed).run(commands)
+        outcomes[result.outcome or "unfinished"] += 1
+    return outcomes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("map")
+    parser.add_argument("--goal", default="peace",
+                        help="the spell that wins the game")
+    parser.add_argument("--mode", choices=("expected", "worst"),
+                        default="expected")
+    parser.add_argument("--weight", type=float, default=5.0,
+                        help="heuristic weight: 1 finds the shortest script, "
+                             "above 1 is faster but up to that many times longer")
+    parser.add_argument("--time-limit", type=float, default=60,
+                        help="give up after this many seconds")
+    parser.add_argument("--max-expanded", type=int, default=200000, metavar="STATES",
+                        help="give up after expanding this many states")
+    parser.add_argument("--win-chance", type=float, default=0.4, metavar="P",
+                        help="only plan steps that leave at least this chance to win")
+    parser.add_argument("--check", type=int, default=0, metavar="GAMES",
+                        help="also play the script through this many games")
+    parser.add_argument("--output", help="write the winning script here")
+    args = parser.parse_args(argv)
+
+    template = load_map(args.map)
+    result = solve(
+        template, args.goal, args.mode, args.weight, args.max_expanded,
+        args.time_limit, args.win_chance,
+    )
+    if result.commands is None:
+        if result.exhausted:
+            print(
+                f"No win in {args.mode} mode: every plan tried dies or gets "
+                f"stuck ({result.expanded} states expanded in {result.seconds:.2f}s)."
+            )
+        else:
+            print(
+                f"No win found before giving up, after expanding "
+                f"{result.expanded} states in {result.seconds:.2f}s."
+            )
+        sys.exit(1)
+
+    script = "\n".join(result.commands + ["quit"]) + "\n"
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(script)
+    else:
+        sys.stdout.write(script)
+    print(
+        f"Planned a win in {len(result.commands)} commands with {result.hp:.1f} hp "
+        f"to spare, winning {result.chance:.0%} of games by the plan's reckoning "
+        f"({result.expanded} states expanded in {result.seconds:.2f}s).",
+        file=sys.stderr,
+    )
+    if args.check:
+        outcomes = check(template, result.commands + ["quit"], args.check)
+        print(
+            f"Played {args.check} games: won {outcomes['won']} "
+            f"({outcomes['won'] / args.check:.0%}), died {outcomes['died']}.",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from adventure import load_map  # noqa: E402
+from simulate import read_script  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def square():
+    return load_map(os.path.join(ROOT, "square.map"))
+
+
+@pytest.fixture(scope="session")
+def ideal_script():
+    return read_script(os.path.join(ROOT, "ideal_run.sh"))
@@ -0,0 +1,126 @@
+import json
+
+import pytest
+
+from adventure import (
+    EnemyRoster, EventSink, GameEngine, GameSnapshot, NullSink, World,
+)
+
+
+def engine_on(template, tmp_path=None, **kwargs):
+    save_dir = str(tmp_path) if tmp_path is not None else "."
+    return GameEngine(template, NullSink(), seed=1, save_dir=save_dir, **kwargs)
+
+
+def state(engine):
+    """
+    A session's state as plain JSON data, to compare two sessions
+    """
+
+    return json.loads(json.dumps(engine.snapshot().as_dict(engine.template)))
+
+
+def test_turns_count_only_commands_that_take_one(square, tmp_path):
+    engine = engine_on(square, tmp_path, undo_limit=5)
+    engine.run(["look", "hp", "dance", "save game.sav", "load game.sav"])
+    assert engine.turns == 2
+
+    engine.execute("get stick")
+    assert engine.turns == 3
+    engine.execute("undo")
+    assert engine.turns == 2
+
+
+def test_confirmation_answers_are_not_turns(square, ideal_script):
+    engine = engine_on(square)
+    engine.run(ideal_script[:19])
+    turns = engine.turns
+    engine.execute(ideal_script[19])
+    assert engine.pending_confirmation is not None
+    engine.execute("n")
+    assert engine.turns == turns + 1
+
+
+def test_undo_puts_everything_back(square, ideal_script):
+    engine = engine_on(square, undo_limit=3)
+    engine.run(ideal_script[:21])
+    before = state(engine)
+    engine.execute(ideal_script[21])
+    engine.execute("undo")
+    assert state(engine) == before
+
+
+def test_save_and_load_round_trip(square, tmp_path, ideal_script):
+    engine = engine_on(square, tmp_path)
+    engine.run(ideal_script[:30])
+    engine.execute("save game.sav")
+    saved = state(engine)
+
+    later = []
+    engine.sink = EventSink(later.append)
+    for command in ideal_script[30:50]:
+        engine.execute(command)
+        engine.sink.flush()
+
+    loaded = engine_on(square, tmp_path)
+    loaded.start()
+    loaded.execute("load game.sav")
+    assert state(loaded) == saved
+
+    replayed = []
+    loaded.sink = EventSink(replayed.append)
+    for command in ideal_script[30:50]:
+        loaded.execute(command)
+        loaded.sink.flush()
+    assert replayed == later
+
+
+def test_snapshot_file_is_for_one_map(square, tmp_path):
+    engine = engine_on(square)
+    engine.start()
+    path = str(tmp_path / "game.sav")
+    engine.snapshot().write(path, square)
+    restored = GameSnapshot.read(path, square)
+    assert restored.current_index == engine.current_index
+
+
+def test_world_takes_negative_indexes(square):
+    world = World(square)
+    assert world[-1].index == len(square) - 1
+    assert world[-1] is world[len(square) - 1]
+
+
+def horde(size):
+    return {
+        f"goblin{i}": {"hp": 1 + i % 7, "attack": 1, "chance": 1, "type": "goblin"}
+        for i in range(size)
+    }
+
+
+def test_roster_copies_are_independent():
+    roster = EnemyRoster(horde(100))
+    copy = roster.copy()
+    roster.damage("goblin3", 2)
+    del roster["goblin5"]
+    killed = roster.area_damage(3)
+
+    assert len(copy) == 100
+    assert copy["goblin3"]["hp"] == 4
+    assert "goblin5" in copy
+    assert copy.area_damage(1) == [f"goblin{i}" for i in range(0, 100, 7)]
+    assert all(name not in roster for name in killed)
+    assert len(roster) == 100 - 1 - len(killed)
+
+
+@pytest.mark.parametrize("size", [60, 500])
+def test_roster_reads_like_the_enemies_dict(size):
+    enemies = horde(size)
+    roster = EnemyRoster(enemies)
+    roster.damage("goblin1", 1)
+    roster.area_damage(2)
+    expected = {
+        name: dict(enemy, hp=enemy["hp"] - 2 - (name == "goblin1"))
+        for name, enemy in enemies.items()
+    }
+    expected = {name: enemy for name, enemy in expected.items() if enemy["hp"] > 0}
+    assert roster.as_dict() == expected
@@ -0,0 +1,26 @@
+"""
+The ideal run plays exactly like the original single-file game did.
+The files in data/ are what the game printed for ideal_run.sh before any
+of the engine was rewritten, with the global dice seeded with 1, 2 and 3.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_output_matches_baseline(seed, ideal_script):
+    played = subprocess.run(
+        [sys.executable, "adventure.py", "square.map", "--seed", str(seed)],
+        input="\n".join(ideal_script) + "\n",
+        capture_output=True, text=True, cwd=ROOT, timeout=60,
+    )
+    with open(os.path.join(DATA, f"ideal_seed_{seed}.txt")) as f:
+        assert played.stdout == f.read()
@@ -0,0 +1,59 @@
+import json
+import random
+
+import pytest
+
+from adventure import GameEngine, Journal, NullSink, read_journal
+
+
+def state(engine):
+    """
+    A session's state as plain JSON data. The dice are left out: a
+    journal records what they rolled, not the state they're in.
+    """
+
+    data = engine.snapshot().as_dict(engine.template)
+    del data["rng"]
+    return json.loads(json.dumps(data))
+
+
+@pytest.mark.parametrize("compact_every", [None, 7])
+@pytest.mark.parametrize("seed", range(12))
+def test_replay_matches_live_session(square, ideal_script, tmp_path, seed, compact_every):
+    path = str(tmp_path / "game.journal")
+    journal = Journal(path, square, compact_every)
+    stop = random.Random(seed).randint(5, len(ideal_script) - 2)
+    live = GameEngine(square, NullSink(), seed=seed, journal=journal)
+    live.run(ideal_script[:stop] + ["look", "hp"])
+    journal.close()
+
+    recovered = GameEngine(square, NullSink(), seed=seed)
+    with open(path, 'rb') as f:
+        recovered.recover(read_journal(f))
+    assert state(recovered) == state(live)
+
+
+def test_replay_counts_turns_that_changed_nothing(square, tmp_path):
+    path = str(tmp_path / "game.journal")
+    journal = Journal(path, square)
+    live = GameEngine(square, NullSink(), seed=1, journal=journal)
+    live.run(["look", "hp", "inventory", "items"])
+    journal.close()
+
+    recovered = GameEngine(square, NullSink(), seed=1)
+    with open(path, 'rb') as f:
+        recovered.recover(read_journal(f))
+    assert recovered.turns == live.turns == 4
+
+
+def test_replay_after_undo(square, ideal_script, tmp_path):
+    path = str(tmp_path / "game.journal")
+    journal = Journal(path, square)
+    live = GameEngine(square, NullSink(), seed=3, journal=journal, undo_limit=5)
+    live.run(ideal_script[:12] + ["undo", "undo"] + ideal_script[10:14])
+    journal.close()
+
+    recovered = GameEngine(square, NullSink(), seed=3)
+    with open(path, 'rb') as f:
+        recovered.recover(read_journal(f))
+    assert state(recovered) == state(live)
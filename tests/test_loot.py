@@ -0,0 +1,73 @@
+import random
+from collections import Counter
+
+import pytest
+
+from adventure import LocationMapError, LootTable, compile_loot
+
+DRAWS = 200000
+
+
+def frequencies(table, rng, draws=DRAWS):
+    counts = Counter(table.pick(rng) for _ in range(draws))
+    return [counts[index] / draws for index in range(len(table.entries))]
+
+
+@pytest.mark.parametrize("weights", [
+    [1, 1, 1, 1],
+    [1, 2, 7],
+    [0.05, 0.9, 0.05],
+    [5, 0, 3, 2],
+    [1] + [100] * 9,
+])
+def test_alias_table_draws_by_weight(weights):
+    table = LootTable([f"thing{i}" for i in range(len(weights))], weights)
+    total = sum(weights)
+    drawn = frequencies(table, random.Random(0))
+    for weight, frequency in zip(weights, drawn):
+        assert frequency == pytest.approx(weight / total, abs=0.005)
+
+
+def test_zero_weight_is_never_drawn():
+    table = LootTable(["never", "always"], [0, 3])
+    rng = random.Random(1)
+    assert all(table.pick(rng) == 1 for _ in range(10000))
+
+
+def test_unique_draws_never_repeat():
+    table = LootTable(list("abcdef"), [50, 20, 10, 10, 5, 5], rolls=4, unique=True)
+    rng = random.Random(2)
+    for _ in range(2000):
+        things = table.draw(rng)
+        assert len(things) == 4
+        assert len(set(things)) == 4
+
+
+def test_unique_draws_stop_at_what_can_be_drawn():
+    table = LootTable(list("abc"), [1, 0, 1], rolls=5, unique=True)
+    assert sorted(table.draw(random.Random(3))) == ["a", "c"]
+
+
+def test_nested_and_named_tables():
+    named = {"gems": {"items": ["ruby", "opal"], "chances": [1, 3]}}
+    table = compile_loot({
+        "items": [{"table": "gems"}, None],
+        "chances": [1, 1],
+        "rolls": 1,
+    }, named)
+    counts = Counter()
+    rng = random.Random(4)
+    for _ in range(DRAWS):
+        counts.update(table.draw(rng) or ["nothing"])
+    assert counts["nothing"] / DRAWS == pytest.approx(0.5, abs=0.005)
+    assert counts["ruby"] / DRAWS == pytest.approx(0.125, abs=0.005)
+    assert counts["opal"] / DRAWS == pytest.approx(0.375, abs=0.005)
+
+
+def test_bad_tables_are_map_errors():
+    with pytest.raises(LocationMapError):
+        LootTable(["a", "b"], [1])
+    with pytest.raises(LocationMapError):
+        LootTable(["a", "b"], [1, -1])
+    with pytest.raises(LocationMapError):
+        compile_loot({"table": "loop"}, {"loop": {"items": [{"table": "loop"}]}})
@@ -0,0 +1,89 @@
+import random
+from collections import deque
+
+import pytest
+
+from adventure import World, load_map
+from generate_map import main as generate_map
+
+
+def breadth_first(world, source):
+    """
+    The length of the shortest way from source to every location it can
+    reach, without going into a locked one
+    """
+
+    analysis = world.template.analysis
+    distances = {source: 0}
+    queue = deque([source])
+    while queue:
+        index = queue.popleft()
+        for _, target in analysis.exits(index):
+            if target not in distances and not world[target].get("locked"):
+                distances[target] = distances[index] + 1
+                queue.append(target)
+    return distances
+
+
+def walk(world, source, route):
+    """
+    Where a route ends up, checking every step is a real open exit
+    """
+
+    exits = world.template.analysis.exits
+    index = source
+    for direction, target in route:
+        assert (direction, target) in set(exits(index))
+        assert not world[target].get("locked")
+        index = target
+    return index
+
+
+@pytest.fixture(scope="module")
+def generated(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("maps") / "generated.map")
+    generate_map([path, "--rooms", "300", "--seed", "1", "--locks", "0.15"])
+    return load_map(path)
+
+
+@pytest.mark.parametrize("map_name", ["square", "generated"])
+def test_routes_are_as_short_as_breadth_first(map_name, request):
+    template = request.getfixturevalue(map_name)
+    world = World(template)
+    # Players are never inside a locked location
+    sources = [
+        index for index in range(len(template)) if not world[index].get("locked")
+    ]
+    sources = random.Random(0).sample(sources, min(len(sources), 20))
+    for source in sources:
+        distances = breadth_first(world, source)
+        for target in range(len(template)):
+            route = world.route(source, target)
+            if target not in distances or world[target].get("locked"):
+                assert route is None
+                continue
+            assert len(route) == distances[target]
+            assert walk(world, source, route) == target
+
+
+def test_routes_change_when_a_door_opens(generated):
+    world = World(generated)
+    locks = [
+        index for index in generated.analysis.locks if world[index].get("locked")
+    ]
+    rng = random.Random(1)
+    sources = [index for index in range(len(generated)) if index not in locks]
+    pairs = [
+        (rng.choice(sources), rng.randrange(len(generated))) for _ in range(200)
+    ]
+    for source, target in pairs:
+        world.route(source, target)
+    for index in locks[:5]:
+        world.unlock(index)
+        for source, target in pairs:
+            route = world.route(source, target)
+            distances = breadth_first(world, source)
+            if target in distances:
+                assert len(route) == distances[target]
+            else:
+                assert route is None
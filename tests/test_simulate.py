@@ -0,0 +1,25 @@
+import simulate
+from adventure import MapTemplate
+from simulate import run_script, summarize
+
+
+def test_scripts_replay_the_same_with_a_seed(square, ideal_script):
+    first = run_script(square, ideal_script, seed=5).as_dict()
+    second = run_script(square, ideal_script, seed=5).as_dict()
+    assert first == second
+    assert first["outcome"] in ("won", "lost", "quit")
+
+
+def test_broken_map_is_an_error_result(monkeypatch):
+    broken = MapTemplate([{"name": "Nowhere", "desc": "", "exits": {"north": 7}}])
+    monkeypatch.setattr(simulate, "_worker_map", broken)
+    index, result = simulate._run_job((3, ["look"], 11, None))
+    assert index == 3
+    assert result["outcome"] == "error"
+    assert result["seed"] == 11
+    assert result["error"]
+
+    summary = summarize([result, {"outcome": "won", "hp": 40, "seed": 12}])
+    assert summary["outcomes"] == {"error": 1, "won": 1}
+    assert summary["average_hp"] == 40
+    assert summary["errors"] == {result["error"]: 1}
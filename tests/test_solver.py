@@ -0,0 +1,23 @@
+from adventure import load_map
+from generate_map import main as generate_map
+from solver import check, solve
+
+
+def test_square_is_solved_at_the_defaults(square):
+    result = solve(square, time_limit=30)
+    assert result.commands is not None
+    assert result.commands[-1] == "use peace"
+    assert result.chance >= 0.4
+    outcomes = check(square, result.commands, 50)
+    assert outcomes["won"] >= 10
+
+
+def test_generated_map_with_a_locked_goal_is_solved(tmp_path):
+    # The boss's room on this map is locked, and its key is dropped in
+    # another locked room
+    path = str(tmp_path / "generated.map")
+    generate_map([path, "--rooms", "300", "--seed", "1"])
+    template = load_map(path)
+    result = solve(template, time_limit=30)
+    assert result.commands is not None
+    assert result.chance >= 0.4